@@ -10,7 +10,15 @@ python manage.py makemigrations authentication --noinput
 python manage.py makemigrations chat --noinput
 python manage.py makemigrations player --noinput
 python manage.py makemigrations pong --noinput
+# Duplicate blocks would fail the unique constraint added by the migration
+python manage.py dedupe_player_pairs --blocks-only
 python manage.py migrate --noinput
+# Merge the duplicate pairs and fill in the pair keys of the existing rows
+python manage.py dedupe_player_pairs
+# Convert the legacy read receipts into read watermarks, once
+python manage.py backfill_read_state
+# Convert the legacy hidden message flags into clear watermarks, once
+python manage.py backfill_cleared_before
 
 # Start gunicorn server
 gunicorn -c config/gunicorn.conf.py --reload pong_service.wsgi:application
\ No newline at end of file
@@ -2,6 +2,7 @@ from django.conf import settings
 from storages.backends.gcloud import GoogleCloudStorage
 from storages.utils import setting
 from urllib.parse import urljoin
+from pong_service.helpers import get_gs_credentials
 
 class GoogleCloudMediaStorage(GoogleCloudStorage):
     """
@@ -26,4 +27,12 @@ class GoogleCloudMediaStorage(GoogleCloudStorage):
         Returns:
             str: The URL of the media file.
         """
-        return urljoin(settings.MEDIA_URL, name)
\ No newline at end of file
+        return urljoin(settings.MEDIA_URL, name)
+
+    def get_default_settings(self):
+        """
+        Use the lazily loaded service account credentials instead of a GS_CREDENTIALS setting.
+        """
+        default_settings = super().get_default_settings()
+        default_settings['credentials'] = get_gs_credentials()
+        return default_settings
\ No newline at end of file
@@ -1,17 +1,28 @@
-import random
+import io
+import base64
+import hashlib
 import bleach
 import logging
+import qrcode
 import requests
+from qrcode.image.svg import SvgPathImage
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 from rest_framework import serializers, status
 from .models import Player
-from google.cloud import storage
+from pong_service.helpers import get_gs_client
 from django.conf import settings
 from rest_framework.response import Response
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+QR_CODE_FORMATS = {
+	'png': 'image/png',
+	'svg': 'image/svg+xml',
+}
+
 def sanitize_and_validate_data(validated_data):
 	"""
 	Sanitizes and validates the given data by cleaning specific fields using bleach.
@@ -52,20 +63,25 @@ def create_player(validated_data):
 
 	Returns:
 		Player: The newly created player object.
+
+	Raises:
+		IntegrityError: If a unique field was taken concurrently. The insert runs
+			in its own savepoint so the surrounding transaction stays usable.
 	"""
 	validated_data.pop('password_confirm')
 	validated_data = handle_avatar(validated_data)
 	validated_data = sanitize_and_validate_data(validated_data)
 
-	return Player.objects.create_user(
-		username=validated_data['username'],
-		api_user_id=validated_data.get('api_user_id', None),
-		first_name=validated_data['first_name'],
-		last_name=validated_data['last_name'],
-		tournament_name=validated_data['tournament_name'],
-		password=validated_data['password'],
-		avatar_url=validated_data.get('avatar_url', None)
-	)
+	with transaction.atomic():
+		return Player.objects.create_user(
+			username=validated_data['username'],
+			api_user_id=validated_data.get('api_user_id', None),
+			first_name=validated_data['first_name'],
+			last_name=validated_data['last_name'],
+			tournament_name=validated_data['tournament_name'],
+			password=validated_data['password'],
+			avatar_url=validated_data.get('avatar_url', None)
+		)
 
 def get_player_representation(player):
 	"""
@@ -130,8 +146,7 @@ def upload_to_google_cloud(image , instance):
 	Returns:
 		str: The public URL of the uploaded image.
 	"""
-	client = storage.Client(credentials=settings.GS_CREDENTIALS, project=settings.GS_PROJECT_ID)
-	bucket = client.bucket(settings.GS_BUCKET_NAME)
+	bucket = get_gs_client().bucket(settings.GS_BUCKET_NAME)
 	extension = image.name.split('.')[-1]
 	blob_name = f"avatars/{instance.username}.{extension}"
 	blob = bucket.blob(blob_name)
@@ -177,6 +192,87 @@ def clear_temp_tokens(request):
     del request.session['temp_refresh_token']
     request.session.flush()
 
+def store_temp_tokens(request, access_token, refresh_token):
+    """
+    Keep the tokens of a login waiting for 2FA in the session until the code is verified.
+
+    The session lives in the cache and expires on its own after TWO_FACTOR_CHALLENGE_TTL.
+    """
+    request.session['temp_access_token'] = access_token
+    request.session['temp_refresh_token'] = refresh_token
+    request.session.set_expiry(settings.TWO_FACTOR_CHALLENGE_TTL)
+
+def _two_factor_attempts_key(username):
+    return f'2fa_attempts:{username}'
+
+def register_two_factor_attempt(username):
+    """
+    Count a 2FA verification attempt for the given user in the cache.
+
+    Returns:
+        int: The number of attempts made within the current challenge window.
+    """
+    key = _two_factor_attempts_key(username)
+    cache.add(key, 0, settings.TWO_FACTOR_CHALLENGE_TTL)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # The key expired between add() and incr()
+        cache.set(key, 1, settings.TWO_FACTOR_CHALLENGE_TTL)
+        return 1
+
+def reset_two_factor_attempts(username):
+    """
+    Forget the 2FA attempts of the given user after a successful verification.
+    """
+    cache.delete(_two_factor_attempts_key(username))
+
+def _qr_code_cache_key(player, image_format):
+    """
+    Build the cache key of a rendered QR code. The secret is hashed into the key,
+    so a new secret never hits the image rendered for the previous one.
+    """
+    secret_digest = hashlib.sha256(player.two_factor_secret.encode()).hexdigest()[:16]
+    return f'2fa_qr:{player.id}:{secret_digest}:{image_format}'
+
+def render_qr_code(data, image_format):
+    """
+    Render the given data as a QR code data URI.
+
+    Args:
+        data (str): The data to encode, usually a provisioning URI.
+        image_format (str): One of QR_CODE_FORMATS.
+
+    Returns:
+        str: The base64 encoded data URI of the image.
+    """
+    buffered = io.BytesIO()
+    if image_format == 'svg':
+        qrcode.make(data, image_factory=SvgPathImage).save(buffered)
+    else:
+        qrcode.make(data).save(buffered, format="PNG")
+    qr_base64 = base64.b64encode(buffered.getvalue()).decode()
+    return f"data:{QR_CODE_FORMATS[image_format]};base64,{qr_base64}"
+
+def get_two_factor_qr_code(player, image_format='png'):
+    """
+    Return the provisioning QR code of the player's 2FA secret, rendering it only on a cache miss.
+    """
+    key = _qr_code_cache_key(player, image_format)
+    qr_code = cache.get(key)
+    if qr_code is None:
+        uri = player.get_totp().provisioning_uri(player.username, issuer_name="Pong Talk")
+        qr_code = render_qr_code(uri, image_format)
+        cache.set(key, qr_code, settings.TWO_FACTOR_QR_CACHE_TTL)
+    return qr_code
+
+def invalidate_two_factor_qr_code(player):
+    """
+    Drop the cached QR codes of the player's current 2FA secret before it is replaced or cleared.
+    """
+    if player.two_factor_secret:
+        cache.delete_many([_qr_code_cache_key(player, image_format) for image_format in QR_CODE_FORMATS])
+
 def error_response(message, status_code):
     """
 	Create an error response with the given message and status code.
@@ -240,30 +336,59 @@ def construct_user_data(user_data):
     
     return data
 
+def _taken_suffixes(field, prefix):
+	"""
+	Collect the numeric suffixes already used after the given prefix.
+
+	Fetches every value of `field` starting with `prefix` in a single
+	indexed query and parses the trailing digits in memory.
+
+	Args:
+		field (str): The Player field to look up ('username' or 'tournament_name').
+		prefix (str): The base name the suffixes are appended to.
+
+	Returns:
+		tuple: (bool telling if the bare prefix is taken, set of used integer suffixes)
+	"""
+	taken = Player.objects.filter(
+		**{f'{field}__startswith': prefix}
+	).values_list(field, flat=True)
+
+	prefix_taken = False
+	suffixes = set()
+	for name in taken:
+		rest = name[len(prefix):]
+		if rest == '':
+			prefix_taken = True
+		elif rest.isdigit() and not rest.startswith('0'):
+			suffixes.add(int(rest))
+	return prefix_taken, suffixes
+
+def _first_free_name(field, prefix):
+	"""
+	Return `prefix` if it is free, otherwise `prefix` followed by the
+	smallest positive integer suffix that is not taken yet.
+	"""
+	prefix_taken, suffixes = _taken_suffixes(field, prefix)
+	if not prefix_taken:
+		return prefix
+
+	suffix = 1
+	while suffix in suffixes:
+		suffix += 1
+	return f'{prefix}{suffix}'
+
 def get_unique_username(username, api_user_id):
-	username_exists = Player.objects.filter(username=username).exists()
-	api_user_id_exists = Player.objects.filter(api_user_id=api_user_id).exists()
-	
-	if not api_user_id_exists and not username_exists:
-		return username
-	
-	if not api_user_id_exists and username_exists:
-		while Player.objects.filter(username=username).exists():
-			username = f'{username}{random.randint(0, 100)}'
-		return username
+	existing_username = Player.objects.filter(
+		api_user_id=api_user_id
+	).values_list('username', flat=True).first()
 
-	if api_user_id_exists:
-		player = Player.objects.get(api_user_id=api_user_id)
-		return player.username
+	if existing_username is not None:
+		return existing_username
+	return _first_free_name('username', username)
 
 def get_unique_tournament_name(username):
-	if not Player.objects.filter(tournament_name=username).exists():
-		return username
-
-	tournament_name = f'{username}{random.randint(0, 100)}'
-	while Player.objects.filter(tournament_name=tournament_name).exists():
-		tournament_name = f'{username}{random.randint(0, 100)}'
-	return tournament_name
+	return _first_free_name('tournament_name', username)
 
 def user_already_exists(user_data):
     return Player.objects.filter(api_user_id=user_data['api_user_id']).exists()
@@ -1,12 +1,12 @@
 from django.core.validators import RegexValidator
 from rest_framework import serializers
 from .models import Player
-from pong_service.apps.chat.models import Friendship
+from pong_service.apps.chat import presence, social_graph
 import pong_service.apps.authentication.validators as validators
 import pong_service.apps.authentication.helpers as helpers
 from django.contrib.auth.password_validation import validate_password
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
-from django.db.models import Q
+from django.db import IntegrityError
 
 # Error messages
 GENERAL_ERROR = "An error occurred. Please try again."
@@ -54,7 +54,7 @@ class PlayerRegistrationSerializer(serializers.ModelSerializer):
     tournament_name = serializers.CharField(
         required=True,
         max_length=30,
-        validators=[validators.tournament_name_validator]
+        validators=[validators.tournament_name_format_validator]
     )
 
     class Meta:
@@ -73,11 +73,13 @@ class PlayerRegistrationSerializer(serializers.ModelSerializer):
             dict: The validated data.
 
         Raises:
-            serializers.ValidationError: If the password and password_confirm fields do not match.
+            serializers.ValidationError: If the password and password_confirm fields do not match,
+                or if the username or tournament name is already taken.
         """
         if data['password'] != data['password_confirm']:
             print(PASSWORD_ERROR)
             raise serializers.ValidationError(PASSWORD_ERROR)
+        validators.validate_unique_player_fields(data)
         return data
 
     def create(self, validated_data):
@@ -91,10 +93,14 @@ class PlayerRegistrationSerializer(serializers.ModelSerializer):
             Player: The created player object.
 
         Raises:
-            serializers.ValidationError: If there is an error creating the player.
+            serializers.ValidationError: If there is an error creating the player. Unique
+                violations caught by the database are reported on the offending field.
         """
         try:
             return helpers.create_player(validated_data)
+        except IntegrityError as e:
+            raise serializers.ValidationError(
+                validators.integrity_error_to_field_errors(e))
         except Exception as e:
             raise serializers.ValidationError(
                 f"{GENERAL_ERROR}: {str(e)}")
@@ -118,6 +124,7 @@ class PlayerListSerializer(serializers.ModelSerializer):
     """
 
     isFriend = serializers.SerializerMethodField()
+    online = serializers.SerializerMethodField()
 
     class Meta:
         model = Player
@@ -134,11 +141,29 @@ class PlayerListSerializer(serializers.ModelSerializer):
         Returns:
             bool: True if the player is a friend, False otherwise.
         """
+        # List views put the friend ids in the context to avoid one query per row
+        friend_ids = self.context.get('friend_ids')
+        if friend_ids is not None:
+            return obj.id in friend_ids
+
         user = self.context['request'].user
-        return Friendship.objects.filter(
-            (Q(player1=user) & Q(player2=obj) & Q(friendshipAccepted=True)) |
-            (Q(player1=obj) & Q(player2=user) & Q(friendshipAccepted=True))
-        ).exists()
+        return social_graph.are_friends(user, obj)
+
+    def get_online(self, obj):
+        """
+        Gets the online field for the player from the presence in Redis.
+
+        Args:
+            obj (Player): The player object.
+
+        Returns:
+            bool: True if the player has an open notification socket.
+        """
+        # List views put the online ids in the context to avoid one lookup per row
+        online_ids = self.context.get('online_ids')
+        if online_ids is not None:
+            return obj.id in online_ids
+        return presence.is_online(obj.id)
 
 class LoginSerializer(serializers.ModelSerializer):
     """
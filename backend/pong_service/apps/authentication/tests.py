@@ -0,0 +1,123 @@
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.test import TestCase
+from rest_framework.test import APIClient
+from pong_service.apps.authentication import helpers
+from pong_service.apps.authentication.helpers import _first_free_name
+from pong_service.apps.authentication.models import Player
+from pong_service.apps.chat import presence
+from pong_service.apps.authentication.validators import (
+    GENERAL_UNIQUE_ERROR, UNIQUE_FIELD_ERRORS, integrity_error_to_field_errors)
+
+
+class FirstFreeNameTests(TestCase):
+    def test_free_prefix_is_kept(self):
+        self.assertEqual(_first_free_name('username', 'alice'), 'alice')
+
+    def test_taken_prefix_gets_the_smallest_free_suffix(self):
+        for username in ('alice', 'alice1', 'alice2', 'alice4', 'alice07', 'alicebob'):
+            Player.objects.create(username=username)
+
+        self.assertEqual(_first_free_name('username', 'alice'), 'alice3')
+
+    def test_suffixes_of_tournament_names(self):
+        Player.objects.create(username='p1', tournament_name='bob')
+        Player.objects.create(username='p2', tournament_name='bob1')
+
+        self.assertEqual(_first_free_name('tournament_name', 'bob'), 'bob2')
+
+
+class IntegrityErrorMappingTests(TestCase):
+    def unique_violation(self, **fields):
+        try:
+            with transaction.atomic():
+                Player.objects.create(**fields)
+        except IntegrityError as e:
+            return e
+        self.fail('The player was created despite the unique violation')
+
+    def test_taken_username_is_reported_on_its_field(self):
+        Player.objects.create(username='alice')
+
+        error = self.unique_violation(username='alice')
+
+        self.assertEqual(integrity_error_to_field_errors(error),
+                         {'username': [UNIQUE_FIELD_ERRORS['username']]})
+
+    def test_taken_tournament_name_is_reported_on_its_field(self):
+        Player.objects.create(username='alice', tournament_name='ace')
+
+        error = self.unique_violation(username='bob', tournament_name='ace')
+
+        self.assertEqual(integrity_error_to_field_errors(error),
+                         {'tournament_name': [UNIQUE_FIELD_ERRORS['tournament_name']]})
+
+    def test_unknown_violation_is_a_general_error(self):
+        error = IntegrityError('duplicate key value violates unique constraint')
+
+        self.assertEqual(integrity_error_to_field_errors(error),
+                         {'non_field_errors': [GENERAL_UNIQUE_ERROR]})
+
+
+class TwoFactorQrCodeCacheTests(TestCase):
+    def setUp(self):
+        self.player = Player.objects.create(username='alice')
+        self.player.two_factor_secret = self.player.generate_two_factor_secret()
+        self.addCleanup(helpers.invalidate_two_factor_qr_code, self.player)
+
+    def cached_qr_code(self, image_format='png'):
+        return cache.get(helpers._qr_code_cache_key(self.player, image_format))
+
+    def test_qr_code_is_cached_per_format(self):
+        png = helpers.get_two_factor_qr_code(self.player, 'png')
+        svg = helpers.get_two_factor_qr_code(self.player, 'svg')
+
+        self.assertTrue(png.startswith('data:image/png;base64,'))
+        self.assertTrue(svg.startswith('data:image/svg+xml;base64,'))
+        self.assertEqual(self.cached_qr_code('png'), png)
+        self.assertEqual(self.cached_qr_code('svg'), svg)
+
+    def test_new_secret_does_not_get_the_old_qr_code(self):
+        old_qr_code = helpers.get_two_factor_qr_code(self.player)
+
+        helpers.invalidate_two_factor_qr_code(self.player)
+        self.assertIsNone(self.cached_qr_code())
+        self.player.two_factor_secret = self.player.generate_two_factor_secret()
+
+        self.assertNotEqual(helpers.get_two_factor_qr_code(self.player), old_qr_code)
+
+
+class PlayerPresenceListTests(TestCase):
+    def setUp(self):
+        self.player = Player.objects.create(username='alice')
+        self.client = APIClient()
+        self.client.force_authenticate(self.player)
+        self.players = [Player.objects.create(username=f'player{index}') for index in range(5)]
+        for player in self.players[:3]:
+            self.connect(player)
+
+    def connect(self, player):
+        presence.connect(player.id, f'socket_{player.id}')
+        self.addCleanup(presence.disconnect, player.id, f'socket_{player.id}')
+
+    def test_online_ids_are_read_page_by_page(self):
+        pages = list(presence.iter_online_ids(page_size=2))
+
+        self.assertEqual([len(page) for page in pages], [2, 1])
+        self.assertEqual({player_id for page in pages for player_id in page},
+                         {player.id for player in self.players[:3]})
+
+    def test_online_list_has_only_the_online_players(self):
+        response = self.client.get('/api/players/online/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(player['username'] for player in response.json()),
+                         ['player0', 'player1', 'player2'])
+        self.assertTrue(all(player['online'] for player in response.json()))
+
+    def test_player_list_flags_the_online_players(self):
+        response = self.client.get('/api/players/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(player['username'] for player in response.json()['data'] if player['online']),
+                         ['player0', 'player1', 'player2'])
@@ -5,6 +5,7 @@ from django.core.validators import RegexValidator
 from rest_framework import serializers
 from django.contrib.auth.password_validation import validate_password
 from django.contrib.auth import authenticate
+from django.db.models import Q
 from PIL import Image
 
 USERNAME_REGEX = r'^(?=[a-zA-Z0-9]*-?[a-zA-Z0-9]*$)[a-zA-Z][a-zA-Z0-9\-]{2,19}$'
@@ -17,6 +18,12 @@ NAME_ERROR = "First and last name must contain only letters, or a single space o
 INCLUDE_USERNAME_AND_PASSWORD = "Must include 'username' and 'password'."
 INVALID_USERNAME_OR_PASSWORD = "Invalid username or password."
 
+UNIQUE_FIELD_ERRORS = {
+    'username': "Username already exists.",
+    'tournament_name': "Nickname already exists.",
+}
+GENERAL_UNIQUE_ERROR = "A player with these details already exists."
+
 def password_validator(password):
     """
     Validates the strength of a password.
@@ -48,23 +55,20 @@ def password_validator(password):
 
 def username_validator(username):
     """
-    Validates the given username.
+    Validates the format of the given username.
 
-    Checks if the username already exists in the database and raises a ValueError if it does.
-    Additionally, applies a regex validation to ensure the username matches a specific pattern.
+    Uniqueness is not checked here; registration checks all unique fields
+    at once with `validate_unique_player_fields`.
 
     Args:
             username (str): The username to be validated.
 
     Raises:
-            ValueError: If the username already exists in the database.
+            ValidationError: If the username does not match the regex pattern.
 
     Returns:
             None
     """
-    
-    if Player.objects.filter(username=username).exists():
-        raise ValidationError('Username already exists.')
 
     regex_validator = RegexValidator(
         regex=USERNAME_REGEX,
@@ -72,31 +76,97 @@ def username_validator(username):
     )
     regex_validator(username)
     
-def tournament_name_validator(nickname):
+def tournament_name_format_validator(nickname):
     """
-    Validates the given username.
-
-    Checks if the username already exists in the database and raises a ValueError if it does.
-    Additionally, applies a regex validation to ensure the username matches a specific pattern.
+    Validates the format of the given tournament name.
 
     Args:
-            username (str): The username to be validated.
+            nickname (str): The tournament name to be validated.
 
     Raises:
-            ValueError: If the username already exists in the database.
+            ValidationError: If the tournament name does not match the regex pattern.
 
     Returns:
             None
     """
-    
-    if Player.objects.filter(tournament_name=nickname).exists():
-        raise ValidationError('Nickname already exists.')
+
     regex_validator = RegexValidator(
         regex=USERNAME_REGEX,
         message=TOURNAMENT_NAME_ERROR
     )
     regex_validator(nickname)
 
+def tournament_name_validator(nickname):
+    """
+    Validates the given tournament name.
+
+    Checks if the tournament name already exists in the database and raises a ValidationError if it does.
+    Additionally, applies a regex validation to ensure the tournament name matches a specific pattern.
+
+    Args:
+            nickname (str): The tournament name to be validated.
+
+    Raises:
+            ValidationError: If the tournament name already exists in the database.
+
+    Returns:
+            None
+    """
+    
+    if Player.objects.filter(tournament_name=nickname).exists():
+        raise ValidationError(UNIQUE_FIELD_ERRORS['tournament_name'])
+    tournament_name_format_validator(nickname)
+
+def validate_unique_player_fields(data):
+    """
+    Checks every unique registration field against the database in a single query.
+
+    Args:
+            data (dict): The registration data containing 'username' and 'tournament_name'.
+
+    Raises:
+            ValidationError: A dict of field errors for each value that is already taken.
+
+    Returns:
+            None
+    """
+
+    username = data.get('username')
+    tournament_name = data.get('tournament_name')
+
+    clashes = Player.objects.filter(
+        Q(username=username) | Q(tournament_name=tournament_name)
+    ).values_list('username', 'tournament_name')[:2]
+
+    errors = {}
+    for taken_username, taken_tournament_name in clashes:
+        if taken_username == username:
+            errors['username'] = [UNIQUE_FIELD_ERRORS['username']]
+        if taken_tournament_name == tournament_name:
+            errors['tournament_name'] = [UNIQUE_FIELD_ERRORS['tournament_name']]
+    if errors:
+        raise ValidationError(errors)
+
+def integrity_error_to_field_errors(error):
+    """
+    Maps a unique violation raised by the database to serializer field errors.
+
+    Postgres reports the offending column as "Key (<column>)=(<value>) already exists.",
+    which is used to find the field; unknown violations fall back to a general error.
+
+    Args:
+            error (IntegrityError): The error raised while inserting the player.
+
+    Returns:
+            dict: The field errors to raise in a ValidationError.
+    """
+
+    match = re.search(r'Key \((\w+)\)=', str(error))
+    field = match.group(1) if match else None
+    if field in UNIQUE_FIELD_ERRORS:
+        return {field: [UNIQUE_FIELD_ERRORS[field]]}
+    return {'non_field_errors': [GENERAL_UNIQUE_ERROR]}
+
 def name_validator(name):
     """
     Validates the given name using a regex pattern.
@@ -12,7 +12,7 @@ from django.shortcuts import redirect
 from django.http import JsonResponse
 from pong_service.permissions import IsUnauthenticated
 
-from pong_service.apps.chat.models import BlockedUsers
+from pong_service.apps.chat import presence, social_graph
 from django.db.models import Q
 from django.http import Http404
 from .helpers import set_cookie
@@ -25,9 +25,6 @@ from rest_framework_simplejwt.views import (
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.conf import settings
 from .forms import TwoFactorAuthForm, BackupCodeForm
-import qrcode
-import io
-import base64
 import jwt
 from .helpers import (
     set_cookie,
@@ -207,8 +204,11 @@ class LoginView(TokenObtainPairView):
                 if response.status_code == status.HTTP_200_OK:
                     player = Player.objects.get(username=request.data['username'])
                     if player.two_factor_enabled:
-                        request.session['temp_access_token'] = response.data['access']
-                        request.session['temp_refresh_token'] = response.data['refresh']
+                        helpers.store_temp_tokens(
+                            request,
+                            response.data['access'],
+                            response.data['refresh']
+                        )
                         return Response({'require_2fa': True}, status=status.HTTP_202_ACCEPTED)
                     
                     response = set_cookie(
@@ -294,12 +294,27 @@ class PlayerListView(ListAPIView):
         """
         Exclude blocked users from the queryset.
         """
-        blocked_users = BlockedUsers.objects.filter(
-            Q(player=self.request.user) | Q(blockedUser=self.request.user)
-        )
-        blocked_user_ids = blocked_users.values_list('blockedUser', flat=True)
+        blocked_user_ids = social_graph.get_block_ids(self.request.user)
         return Player.objects.exclude(id__in=blocked_user_ids)
 
+    def get_serializer_context(self):
+        """
+        Add the friend ids to the serializer context, so each row doesn't look
+        them up on its own.
+        """
+        context = super().get_serializer_context()
+        context['friend_ids'] = social_graph.get_friend_ids(self.request.user)
+        return context
+
+    def get_serializer(self, players, **kwargs):
+        """
+        Add the online ids among the listed players to the serializer context,
+        looked up in one round trip.
+        """
+        kwargs['context'] = self.get_serializer_context()
+        kwargs['context']['online_ids'] = presence.online_ids_among(player.id for player in players)
+        return super().get_serializer(players, **kwargs)
+
 class PlayerOnlineListView(ListAPIView):
     """
     API view that returns a list of online players.
@@ -331,10 +346,7 @@ class PlayerOnlineListView(ListAPIView):
         Exclude blocked users, players in active games or tournaments, and filter for online players.
         """
         # Get blocked users
-        blocked_users = BlockedUsers.objects.filter(
-            Q(player=self.request.user) | Q(blockedUser=self.request.user)
-        )
-        blocked_user_ids = set(blocked_users.values_list('blockedUser', flat=True))
+        blocked_user_ids = social_graph.get_block_ids(self.request.user)
 
         # Get players in active games (Pending or Started)
         active_game_players = PongGame.objects.filter(
@@ -355,8 +367,21 @@ class PlayerOnlineListView(ListAPIView):
             
         exclude_player_ids.add(self.request.user.id)
 
-        # Exclude blocked and active players, and filter for online players
-        return Player.objects.exclude(id__in=exclude_player_ids).filter(online=True)
+        # Exclude blocked and active players, page by page of the online players
+        players = []
+        for online_ids in presence.iter_online_ids():
+            players.extend(Player.objects.exclude(id__in=exclude_player_ids).filter(id__in=online_ids))
+        return players
+
+    def get_serializer(self, players, **kwargs):
+        """
+        Add the friend ids and the online ids to the serializer context, so each row
+        doesn't look them up on its own. The listed players are the online ones.
+        """
+        kwargs['context'] = self.get_serializer_context()
+        kwargs['context']['friend_ids'] = social_graph.get_friend_ids(self.request.user)
+        kwargs['context']['online_ids'] = {player.id for player in players}
+        return super().get_serializer(players, **kwargs)
 
 class PlayerPublicProfileView(generics.RetrieveAPIView):
     """
@@ -371,13 +396,10 @@ class PlayerPublicProfileView(generics.RetrieveAPIView):
         """
         Exclude blocked users from the queryset.
         """
-        username = self.kwargs['username']
-        if BlockedUsers.objects.filter(
-            Q(player=self.request.user, blockedUser__username=username) |
-            Q(player__username=username, blockedUser=self.request.user)
-        ).exists():
+        player = super().get_object()
+        if social_graph.is_blocked_between(self.request.user, player):
             raise Http404("Player not found")
-        return super().get_object()
+        return player
 
 class SetupTwoFactorView(APIView):
     """
@@ -385,22 +407,22 @@ class SetupTwoFactorView(APIView):
  
 	This view handles the setup of 2FA for a player. It generates a 2FA secret for the player,
 	generates a QR code for the player to scan with their 2FA app, and returns the secret and QR code.
+	The rendered QR code is cached per secret; pass `?qr_format=svg` to get a smaller SVG image instead of a PNG.
     """
     permission_classes = [IsAuthenticated]
     def get(self, request):
+        image_format = request.query_params.get('qr_format', 'png')
+        if image_format not in helpers.QR_CODE_FORMATS:
+            return error_response('Unsupported QR code format', status.HTTP_400_BAD_REQUEST)
+
         player = request.user
         if not player.two_factor_secret:
             player.two_factor_secret = player.generate_two_factor_secret()
             player.save()
-        totp = player.get_totp()
-        qr = qrcode.make(totp.provisioning_uri(player.username, issuer_name="Pong Talk"))
-        buffered = io.BytesIO()
-        qr.save(buffered, format="PNG")
-        qr_base64 = base64.b64encode(buffered.getvalue()).decode()
         
         return Response({
             'secret': player.two_factor_secret,
-            'qr_code': f"data:image/png;base64,{qr_base64}"
+            'qr_code': helpers.get_two_factor_qr_code(player, image_format)
         })
         
     def post(self, request):
@@ -427,6 +449,7 @@ class DisableTwoFactorView(APIView):
 
     def post(self, request):
         player = request.user
+        helpers.invalidate_two_factor_qr_code(player)
         player.two_factor_enabled = False
         player.two_factor_secret = None
         player.backup_codes = []
@@ -461,6 +484,14 @@ class BaseTwoFactorView(APIView):
         
         return username
 
+    def handle_rate_limit(self, request, username):
+        attempts = helpers.register_two_factor_attempt(username)
+        if attempts > settings.TWO_FACTOR_MAX_ATTEMPTS:
+            # Drop the pending login so the password has to be entered again
+            request.session.flush()
+            return error_response('Too many attempts, please log in again', status.HTTP_429_TOO_MANY_REQUESTS)
+        return None
+
     def handle_player_retrieval(self, username):
         try:
             player = Player.objects.get(username=username)
@@ -479,6 +510,10 @@ class VerifyTwoFactorView(BaseTwoFactorView):
         if isinstance(username, Response):
             return username
 
+        rate_limited = self.handle_rate_limit(request, username)
+        if rate_limited:
+            return rate_limited
+
         form = TwoFactorAuthForm(request.data)
         if not form.is_valid():
             return error_response(form.errors, status.HTTP_400_BAD_REQUEST)
@@ -489,7 +524,8 @@ class VerifyTwoFactorView(BaseTwoFactorView):
 
         if not player.verify_two_factor_code(form.cleaned_data['code']):
             return error_response('Invalid 2FA code', status.HTTP_400_BAD_REQUEST)
-        
+
+        helpers.reset_two_factor_attempts(username)
         return handle_successful_verification(request)
 
 
@@ -502,6 +538,10 @@ class UseBackupCodeView(BaseTwoFactorView):
         if isinstance(username, Response):
             return username
 
+        rate_limited = self.handle_rate_limit(request, username)
+        if rate_limited:
+            return rate_limited
+
         form = BackupCodeForm(request.data)
         if not form.is_valid():
             return error_response(form.errors, status.HTTP_400_BAD_REQUEST)
@@ -513,6 +553,7 @@ class UseBackupCodeView(BaseTwoFactorView):
         if not player.use_backup_code(form.cleaned_data['code']):
             return error_response('Invalid backup code', status.HTTP_400_BAD_REQUEST)
 
+        helpers.reset_two_factor_attempts(username)
         return handle_successful_verification(request)
 
 class PlayerProfileView(generics.RetrieveAPIView):
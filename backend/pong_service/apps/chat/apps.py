@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'pong_service.apps.chat'
+
+    def ready(self):
+        import pong_service.apps.chat.signals  # noqa: F401
@@ -1,250 +1,234 @@
-import json
 import logging
-from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync, sync_to_async
-from pong_service.helpers import get_user_from_access_token
-from django.db.models import Q
-from django.conf import settings
+import re
+from asgiref.sync import sync_to_async
+from pong_service.streams import SingleStreamConsumer
+from pong_service.apps.chat.receipts import queue_read_receipt
+from pong_service.apps.chat.message_buffer import queue_message
+from pong_service.apps.chat.outbox import enqueue_group_send, enqueue_notification
+from pong_service.apps.chat import inbox
+from pong_service.apps.chat import disconnect_cleanup, presence
+from pong_service.apps.chat.status_fanout import queue_status_change
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        self.cookies = self.scope['cookies']
-        self.access_token = self.cookies.get(settings.AUTH_COOKIE)
-        self.user = await get_user_from_access_token(self.access_token)
+NOTIFICATION_ID_RE = re.compile(r'^\d+-\d+$')
 
-        if self.user is None:
-            await self.close()
-            return None
+class ChatStream:
+    """
+    The chat stream: the user's new messages and the acks of the messages they
+    sent, and the messages and read receipts sent by the client.
+    """
 
-        self.room_name = f'chat_{self.user.id}'
+    async def chat_open(self, params):
         await self.channel_layer.group_add(
-            self.room_name,
+            f'chat_{self.user.id}',
             self.channel_name
         )
-        await self.accept()
-
-    async def disconnect(self, close_code):
-        if self.user is None:
-            return None
 
+    async def chat_close(self):
         await self.channel_layer.group_discard(
-            self.room_name,
+            f'chat_{self.user.id}',
             self.channel_name
         )
 
-    async def receive(self, text_data):
-        pass
+    async def chat_receive(self, data):
+        if data.get('type') == 'read':
+            try:
+                conversation_id = int(data['conversation_id'])
+                message_id = int(data['message_id'])
+            except (KeyError, TypeError, ValueError):
+                return
+            queue_read_receipt(conversation_id, self.user.id, message_id)
+        elif data.get('type') == 'message':
+            await self.receive_chat_message(data)
+
+    async def receive_chat_message(self, data):
+        """
+        Accept a message sent over the socket. It is acked with the stored message,
+        or with an error, once the write-behind buffer has flushed it.
+        """
+        from pong_service.apps.chat.serializers import MessagesSerializer
+
+        client_id = data.get('client_id')
+        if not isinstance(client_id, str) or not client_id or len(client_id) > 64:
+            return
+        try:
+            conversation_id = int(data['conversation_id'])
+        except (KeyError, TypeError, ValueError):
+            await self.send_ack({'client_id': client_id, 'error': 'A valid conversation id is required.'})
+            return
 
-    async def chat_message(self, event):
-        message = event['message']
-        await self.send(text_data=json.dumps({
-            'message': message
-        }))
+        serializer = MessagesSerializer(data={'content': data.get('content')})
+        if not serializer.is_valid():
+            await self.send_ack({'client_id': client_id, 'error': serializer.errors})
+            return
 
+        queue_message(self.user, conversation_id, client_id,
+                      serializer.validated_data['content'], self.channel_name)
 
-def send_message(user_id, conversationID, message):
-    channel_layer = get_channel_layer()
-
-    if not channel_layer:
-        # Log error or raise an exception as needed
-        print("Channel layer is not available.")
-        return
-
-    try:
-        async_to_sync(channel_layer.group_send)(
-            f'chat_{user_id}',
-            {
-                'type': 'chat_message',
-                'message': {
-                    'conversation_id': conversationID,
-                    'data': message
-                }
-            }
-        )
-    except Exception as e:
-        # Handle exceptions, possibly logging or retrying
-        print(f"Failed to send message via WebSocket: {e}")
+    async def send_ack(self, ack):
+        await self.send_stream('chat', {
+            'ack': ack
+        })
+
+    async def chat_ack(self, event):
+        await self.send_ack(event['ack'])
 
+    async def chat_message(self, event):
+        message = event['message']
+        await self.send_stream('chat', {
+            'message': message
+        })
 
-class NotificationConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        # settings.configure()
 
-        self.cookies = self.scope['cookies']
-        self.access_token = self.cookies.get(settings.AUTH_COOKIE)
-        self.user = await get_user_from_access_token(self.access_token)
+class ChatConsumer(ChatStream, SingleStreamConsumer):
+    stream = 'chat'
+    # an ack of no message
+    ping_payload = {'ack': {}}
 
-        if self.user is None:
-            await self.close()
-            return None
 
-        self.room_name = f'notification_{self.user.id}'
+def send_message(user_id, conversationID, message):
+    enqueue_group_send(f'chat_{user_id}', {
+        'type': 'chat_message',
+        'message': {
+            'conversation_id': conversationID,
+            'data': message
+        }
+    })
+
+
+class NotificationStream:
+    """
+    The notification stream: the user's notifications, replayed from their inbox
+    after `last_id` when the stream is opened, and the status changes of their
+    friends. Opening it brings the user online.
+    """
+    presence_digests = False
+
+    async def notification_open(self, params):
         await self.channel_layer.group_add(
-            self.room_name,
+            f'notification_{self.user.id}',
             self.channel_name
         )
-        await self.accept()
-
-        self.user.online = True
-        await sync_to_async(self.user.save)()
-        await self.sendOnlineStatusToFriends()
 
-    async def disconnect(self, close_code):
-        from pong_service.apps.authentication.models import Player
-        from pong_service.apps.pong.models import GameRequest, Tournament
-
-        if self.user is None:
-            return None
-
-        # Check if the user in a game request and remove it
-        game_request = await sync_to_async(GameRequest.objects.filter)(Q(requester=self.user) | Q(opponent=self.user))
-        if await sync_to_async(game_request.exists)():
-            await sync_to_async(game_request.delete)()
+        # Joined the group first, so nothing is missed between the replay and the live notifications
+        last_id = params.get('last_id')
+        if not isinstance(last_id, str) or not NOTIFICATION_ID_RE.match(last_id):
+            last_id = None
+        try:
+            await self.replay_notifications(last_id)
+        except Exception as e:
+            logger.error(f'Failed to replay the notifications of {self.user.id}: {e}')
 
-         # Fetch the tournament queryset asynchronously
-        await sync_to_async(Tournament.objects.filter(player1=self.user, status=Tournament.Status.STARTED).delete)()
+        # Only the first socket of the user brings them online, a user back
+        # within the disconnect grace window was never announced as offline
+        if await presence.register(self.user.id, self.channel_name) and \
+                not disconnect_cleanup.cancel_cleanup(self.user.id):
+            await self.sendOnlineStatusToFriends(True)
 
-        player = await sync_to_async(Player.objects.get)(id=self.user.id)
-        player.online = False
-        self.user.online = False
-        await sync_to_async(player.save)()
-        await self.sendOnlineStatusToFriends()
+    async def notification_close(self):
+        # The user stays online while another of their sockets is open. Once the
+        # last one is closed, their game requests and started tournaments are
+        # removed and friends notified after a grace window, in a background sweep
+        if await presence.unregister(self.user.id, self.channel_name):
+            disconnect_cleanup.queue_cleanup(self.user.id, self.user.username)
 
         await self.channel_layer.group_discard(
-            self.room_name,
+            f'notification_{self.user.id}',
             self.channel_name
         )
 
-    async def receive(self, text_data):
-        pass
+    async def replay_notifications(self, last_id):
+        """
+        Send the notifications of the user's inbox that are newer than `last_id`.
+        A client that has not seen any notification yet gets the current position
+        of the inbox instead, to resume from on its next connection.
+        """
+        if last_id is None:
+            await self.send_stream('notification', {
+                'message': {
+                    'type': 'inbox_position',
+                    'id': await sync_to_async(inbox.last_id)(self.user.id)
+                }
+            })
+            return
+
+        notifications = await sync_to_async(inbox.read_after)(self.user.id, last_id)
+        for notification_id, notification in notifications:
+            notification['id'] = notification_id
+            await self.send_stream('notification', {
+                'message': notification
+            })
+
+    async def notification_receive(self, data):
+        # Clients opt in to receive the status changes of their friends as digests
+        if data.get('type') == 'presence_digest':
+            self.presence_digests = bool(data.get('enabled'))
 
     async def notification_message(self, event):
         message = event['message']
-        await self.send(text_data=json.dumps({
+        await self.send_stream('notification', {
             'message': message
-        }))
-
-    async def sendOnlineStatusToFriends(self):
-        from pong_service.apps.chat.models import Friendship
-
-        friends = await sync_to_async(list)(Friendship.objects.filter(
-            Q(player1=self.user, friendshipAccepted=True) |
-            Q(player2=self.user, friendshipAccepted=True)
-        ).values_list('player1_id', 'player2_id'))
-
-        for friend in friends:
-            friend_id = friend[1] if friend[0] == self.user.id else friend[0]
-            await self.channel_layer.group_send(
-                f'notification_{friend_id}',
-                {
-                    'type': 'notification_message',
-                    'message': {
-                        'type': 'online_status',
-                        'username': self.user.username,
-                        'online': self.user.online
-                    }
+        })
+
+    async def presence_digest(self, event):
+        """
+        Send the status changes of the user's friends, as a single digest if the
+        client asked for it, or as one online_status message per friend otherwise.
+        """
+        if self.presence_digests:
+            await self.send_stream('notification', {
+                'message': {
+                    'type': 'presence_digest',
+                    'statuses': event['statuses']
                 }
-            )
+            })
+            return
+        for status in event['statuses']:
+            await self.send_stream('notification', {
+                'message': {
+                    'type': 'online_status',
+                    'username': status['username'],
+                    'online': status['online']
+                }
+            })
 
-    @staticmethod
-    def sendFriendRequestNotification(user_id, friend_id):
-        channel_layer = get_channel_layer()
+    async def sendOnlineStatusToFriends(self, online):
+        queue_status_change(self.user.id, self.user.username, online)
 
-        if not channel_layer:
-            # Log error or raise an exception as needed
-            print("Channel layer is not available.")
-            return
 
-        try:
-            async_to_sync(channel_layer.group_send)(
-                f'notification_{friend_id}',
-                {
-                    'type': 'notification_message',
-                    'message': {
-                        'type': 'friend_request',
-                        'user_id': user_id
-                    }
-                }
-            )
-        except Exception as e:
-            # Handle exceptions, possibly logging or retrying
-            print(f"Failed to send message via WebSocket: {e}")
+class NotificationConsumer(NotificationStream, SingleStreamConsumer):
+    stream = 'notification'
+    ping_payload = {'message': {'type': 'ping'}}
 
     @staticmethod
-    def sendGameRequestNotification(user_id, opponent_id, request_id):
-        channel_layer = get_channel_layer()
+    def sendFriendRequestNotification(user_id, friend_id):
+        enqueue_notification(friend_id, {
+            'type': 'friend_request',
+            'user_id': user_id
+        })
 
-        if not channel_layer:
-            # Log error or raise an exception as needed
-            print("Channel layer is not available.")
-            return
+    @staticmethod
+    def sendGameRequestNotification(user_id, opponent_id, request_id):
+        enqueue_notification(opponent_id, {
+            'type': 'game_request',
+            'request_id': request_id,
+            'requester_name': user_id.username,
+            'avatar_url': user_id.avatar_url,
+        })
 
-        try:
-            async_to_sync(channel_layer.group_send)(
-                f'notification_{opponent_id}',
-                {
-                    'type': 'notification_message',
-                    'message': {
-                        'type': 'game_request',
-                        'request_id': request_id,
-                        'requester_name': user_id.username,
-                        'avatar_url': user_id.avatar_url,
-                    }
-                }
-            )
-        except Exception as e:
-            # Handle exceptions, possibly logging or retrying
-            print(f"Failed to send message via WebSocket: {e}")
-    
     @staticmethod
     def sendGameRequestResponseNotification(requester_id, game_id):
-        channel_layer = get_channel_layer()
+        enqueue_notification(requester_id, {
+            'type': 'game_request_response',
+            'game_id': game_id,
+        })
 
-        if not channel_layer:
-            # Log error or raise an exception as needed
-            print("Channel layer is not available.")
-            return
-
-        try:
-            async_to_sync(channel_layer.group_send)(
-                f'notification_{requester_id}',
-                {
-                    'type': 'notification_message',
-                    'message': {
-                        'type': 'game_request_response',
-                        'game_id': game_id,
-                    }
-                }
-            )
-        except Exception as e:
-            # Handle exceptions, possibly logging or retrying
-            print(f"Failed to send message via WebSocket: {e}")
-            
     @staticmethod
     def sendTournamentNotification(requester_username ,player):
-        channel_layer = get_channel_layer()
-
-        if not channel_layer:
-            # Log error or raise an exception as needed
-            print("Channel layer is not available.")
-            return
-
-        try:
-            async_to_sync(channel_layer.group_send)(
-                f'notification_{player.id}',
-                {
-                    'type': 'notification_message',
-                    'message': {
-                        'type': 'tournament_request',
-                        'message': 'You have been invited to a tournament',
-                        'requester': requester_username
-                    }
-                }
-            )
-        except Exception as e:
-            # Handle exceptions, possibly logging or retrying
-            print(f"Failed to send message via WebSocket: {e}")
+        enqueue_notification(player.id, {
+            'type': 'tournament_request',
+            'message': 'You have been invited to a tournament',
+            'requester': requester_username
+        })
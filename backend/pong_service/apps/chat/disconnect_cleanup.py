@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import time
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from pong_service.apps.chat import presence
+from pong_service.apps.chat.status_fanout import queue_status_change
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# user_id -> (username, time after which the user's cleanup runs)
+pending_cleanups = {}
+_sweeper = None
+
+
+def queue_cleanup(user_id, username):
+    """
+    Schedule the side effects of a user going offline: their game requests and
+    started tournaments are deleted and their friends are told they are offline.
+
+    Nothing happens before NOTIFICATION_DISCONNECT_GRACE seconds, so a user that
+    reconnects in time, e.g. after a reload or a network blip, keeps them. The
+    due cleanups are run in batches by a background sweeper.
+    """
+    global _sweeper
+
+    pending_cleanups[user_id] = (username, time.monotonic() + settings.NOTIFICATION_DISCONNECT_GRACE)
+
+    if _sweeper is None or _sweeper.done():
+        _sweeper = asyncio.get_running_loop().create_task(_sweep_loop())
+
+
+def cancel_cleanup(user_id):
+    """
+    Cancel the pending cleanup of a user that reconnected.
+
+    Returns:
+        bool: True if a cleanup was pending, i.e. the user was never announced as offline.
+    """
+    return pending_cleanups.pop(user_id, None) is not None
+
+
+async def _sweep_loop():
+    while pending_cleanups:
+        await asyncio.sleep(settings.NOTIFICATION_CLEANUP_INTERVAL)
+        await sweep()
+
+
+async def sweep():
+    """
+    Run every due cleanup, skipping the users that came back online through
+    another process in the meantime.
+    """
+    now = time.monotonic()
+    due = {user_id: username for user_id, (username, deadline) in pending_cleanups.items() if deadline <= now}
+    if not due:
+        return
+    for user_id in due:
+        del pending_cleanups[user_id]
+
+    try:
+        online = await sync_to_async(presence.are_online)(due)
+        offline = {user_id: username for user_id, username in due.items() if not online[user_id]}
+        if offline:
+            await database_sync_to_async(cleanup_players)(list(offline))
+    except Exception as e:
+        logger.error(f'Failed to clean up {len(due)} disconnected players: {e}')
+        return
+
+    for user_id, username in offline.items():
+        queue_status_change(user_id, username, False)
+
+
+def cleanup_players(player_ids):
+    """
+    Delete the game requests and the started tournaments of the given players,
+    with one DELETE per table.
+    """
+    from pong_service.apps.pong.models import GameRequest, Tournament
+
+    with transaction.atomic():
+        GameRequest.objects.filter(Q(requester_id__in=player_ids) | Q(opponent_id__in=player_ids)).delete()
+        Tournament.objects.filter(player1_id__in=player_ids, status=Tournament.Status.STARTED).delete()
@@ -0,0 +1,63 @@
+import json
+from django.conf import settings
+from pong_service.helpers import get_redis_client
+
+# Seconds the stream id of an appended outbox event is remembered, so a retried
+# event is not appended twice
+APPENDED_EVENT_TTL = 60 * 60
+
+# KEYS: inbox, appended event marker
+# ARGV: max length, message, ttl
+_APPEND_ONCE_SCRIPT = """
+local stream_id = redis.call('GET', KEYS[2])
+if stream_id then
+    return stream_id
+end
+stream_id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'message', ARGV[2])
+redis.call('SET', KEYS[2], stream_id, 'EX', ARGV[3])
+return stream_id
+"""
+
+
+def _key(user_id):
+    return f'notifications:{user_id}'
+
+
+def _appended_key(event_id):
+    return f'notifications:appended:{event_id}'
+
+
+def append(user_id, message, event_id):
+    """
+    Append the notification of an outbox event to the user's inbox, a Redis Stream
+    capped to about NOTIFICATION_INBOX_SIZE entries. An event is only appended once,
+    a retry of it gets the stream id of its first append.
+
+    Returns:
+        str: The stream id of the notification.
+    """
+    stream_id = get_redis_client().eval(
+        _APPEND_ONCE_SCRIPT, 2, _key(user_id), _appended_key(event_id),
+        settings.NOTIFICATION_INBOX_SIZE, json.dumps(message), APPENDED_EVENT_TTL)
+    return stream_id.decode()
+
+
+def read_after(user_id, last_id):
+    """
+    Return the notifications of the user's inbox that are newer than `last_id`,
+    oldest first, at most NOTIFICATION_REPLAY_LIMIT of them.
+
+    Returns:
+        list: (stream id, message) tuples.
+    """
+    entries = get_redis_client().xrange(
+        _key(user_id), min=f'({last_id}', max='+', count=settings.NOTIFICATION_REPLAY_LIMIT)
+    return [(stream_id.decode(), json.loads(fields[b'message'])) for stream_id, fields in entries]
+
+
+def last_id(user_id):
+    """
+    Return the stream id of the newest notification of the user, or '0-0' if the inbox is empty.
+    """
+    entries = get_redis_client().xrevrange(_key(user_id), count=1)
+    return entries[0][0].decode() if entries else '0-0'
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Max, Q
+from django.db.models.functions import Greatest
+from pong_service.apps.chat.models import Conversations, Messages
+
+
+class Command(BaseCommand):
+    """
+    Convert the legacy per-message IsVisibleToPlayerN flags into the clear
+    watermarks of every conversation. The entrypoint runs it after migrating,
+    the converted flags are reset so it is a no-op once done.
+
+    Clearing used to hide every message of the conversation, so a participant's
+    watermark is raised to the newest message hidden from them. A watermark is
+    never lowered: one set since the deploy comes from a newer clear.
+    """
+    help = 'Convert hidden message flags into conversation clear watermarks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        conversation_ids = list(Messages.objects.filter(Q(IsVisibleToPlayer1=False) | Q(IsVisibleToPlayer2=False))
+                                .order_by().values_list('atConversation', flat=True).distinct())
+        updated = 0
+        for start in range(0, len(conversation_ids), batch_size):
+            updated += self._convert(conversation_ids[start:start + batch_size])
+
+        self.stdout.write(self.style.SUCCESS(f'Updated {updated} conversations.'))
+
+    def _convert(self, conversation_ids):
+        hidden = Messages.objects.filter(atConversation__in=conversation_ids) \
+            .filter(Q(IsVisibleToPlayer1=False) | Q(IsVisibleToPlayer2=False))
+
+        with transaction.atomic():
+            rows = hidden.values('atConversation').order_by() \
+                .annotate(player1=Max('messageID', filter=Q(IsVisibleToPlayer1=False)),
+                          player2=Max('messageID', filter=Q(IsVisibleToPlayer2=False)))
+            for row in rows:
+                update = {
+                    field: Greatest(F(field), row[player])
+                    for field, player in (('clearedBeforePlayer1', 'player1'), ('clearedBeforePlayer2', 'player2'))
+                    if row[player] is not None
+                }
+                Conversations.objects.filter(pk=row['atConversation']).update(**update)
+            hidden.update(IsVisibleToPlayer1=True, IsVisibleToPlayer2=True)
+        return len(conversation_ids)
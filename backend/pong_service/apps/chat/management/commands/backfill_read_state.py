@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, Min, Q
+from django.db.models.functions import Greatest
+from pong_service.apps.chat.models import Conversations, MessageReadStatus
+
+
+class Command(BaseCommand):
+    """
+    Convert the legacy MessageReadStatus rows into the per-participant read
+    watermarks and unread counters of every conversation. The entrypoint runs it
+    after migrating, the converted rows are deleted so it is a no-op once done.
+
+    A participant's watermark is set just below their oldest unread message,
+    or to the last message of the conversation when nothing is unread. Only the
+    participants without a watermark yet are converted: one set since the deploy
+    comes from a read receipt and is newer than the legacy rows. Their legacy
+    unread messages are added to the counter, which already counts the messages
+    sent since.
+    """
+    help = 'Convert MessageReadStatus rows into conversation read watermarks and unread counters.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        conversation_ids = list(MessageReadStatus.objects.order_by()
+                                .values_list('atMessage__atConversation', flat=True).distinct())
+        updated = 0
+        for start in range(0, len(conversation_ids), batch_size):
+            updated += self._convert(conversation_ids[start:start + batch_size])
+
+        self.stdout.write(self.style.SUCCESS(f'Updated {updated} conversations.'))
+
+    def _convert(self, conversation_ids):
+        unread = {
+            (row['atMessage__atConversation'], row['receiver']): (row['count'], row['oldest'])
+            for row in MessageReadStatus.objects.filter(atMessage__atConversation__in=conversation_ids)
+            .values('atMessage__atConversation', 'receiver').order_by()
+            .annotate(count=Count('pk', filter=Q(IsRead=False)), oldest=Min('atMessage', filter=Q(IsRead=False)))
+        }
+
+        with transaction.atomic():
+            conversations = Conversations.objects.select_for_update() \
+                .filter(pk__in=conversation_ids).only('conversationID', 'player1', 'player2', 'lastMessage')
+            for conversation in conversations:
+                for player_id in (conversation.player1_id, conversation.player2_id):
+                    if player_id is None:
+                        continue
+                    count, oldest = unread.get((conversation.conversationID, player_id), (0, None))
+                    last_read_field = conversation.last_read_field(player_id)
+                    count_field = conversation.unread_count_field(player_id)
+                    Conversations.objects.filter(pk=conversation.pk, **{last_read_field: 0}).update(**{
+                        last_read_field: Greatest(F(last_read_field),
+                                                  oldest - 1 if oldest else conversation.lastMessage_id or 0),
+                        count_field: F(count_field) + count,
+                    })
+            MessageReadStatus.objects.filter(atMessage__atConversation__in=conversation_ids).delete()
+        return len(conversation_ids)
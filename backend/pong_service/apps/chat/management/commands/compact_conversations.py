@@ -0,0 +1,60 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Least
+from pong_service.apps.chat.models import Conversations, Messages
+
+
+class Command(BaseCommand):
+    """
+    Delete the messages both participants have cleared and the conversations both
+    participants have deleted. Clearing and deleting only move watermarks, so this
+    is where the rows are physically removed, one batch per transaction.
+
+    Without --interval a single pass is made; with it the command keeps running
+    and makes a pass every `interval` seconds.
+    """
+    help = 'Delete cleared messages and deleted conversations in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--interval', type=float, default=None)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        interval = options['interval']
+
+        while True:
+            messages = self._compact_messages(batch_size)
+            conversations = self._compact_conversations(batch_size)
+            if messages or conversations or interval is None:
+                self.stdout.write(self.style.SUCCESS(
+                    f'Deleted {messages} messages and {conversations} conversations.'))
+            if interval is None:
+                return
+            time.sleep(interval)
+
+    def _compact_messages(self, batch_size):
+        cleared = Messages.objects.filter(messageID__lte=Least(
+            F('atConversation__clearedBeforePlayer1'), F('atConversation__clearedBeforePlayer2')))
+        deleted = 0
+        while True:
+            batch = list(cleared.values_list('messageID', flat=True)[:batch_size])
+            if not batch:
+                return deleted
+            with transaction.atomic():
+                Messages.objects.filter(messageID__in=batch).delete()
+            deleted += len(batch)
+
+    def _compact_conversations(self, batch_size):
+        # Visibility is checked again on delete, a new message may have revived the conversation
+        hidden = Conversations.objects.filter(IsVisibleToPlayer1=False, IsVisibleToPlayer2=False)
+        deleted = 0
+        while True:
+            batch = list(hidden.values_list('conversationID', flat=True)[:batch_size])
+            if not batch:
+                return deleted
+            with transaction.atomic():
+                hidden.filter(conversationID__in=batch).delete()
+            deleted += len(batch)
@@ -0,0 +1,126 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count, Max, Min
+from django.db.models.functions import Greatest, Least
+from pong_service.apps.chat.models import BlockedUsers, Conversations, Friendship, Messages
+
+
+class Command(BaseCommand):
+    """
+    Remove the duplicate rows that predate the canonical pair keys, then fill in
+    the pairLow and pairHigh columns of every Conversations, Friendship and
+    BlockedUsers row. Run it after migrating to the pair key columns, it is a
+    no-op once the pairs are clean.
+
+    The unique constraint on blocks is added by the same migration as the pair
+    keys, so their duplicates must be removed before migrating: `--blocks-only`
+    does just that, without touching the columns the migration has yet to add.
+
+    - Duplicate conversations are merged into the oldest one: their messages are
+      moved to it, their unread counters are added to it and it keeps the newest
+      read and clear watermarks of each participant.
+    - Duplicate friendships keep the accepted one, or the oldest one.
+    - Duplicate blocks (same player blocking the same user twice) keep the oldest one.
+    """
+    help = 'Dedupe conversations, friendships and blocks and fill in their pair keys.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--blocks-only', action='store_true',
+            help='Only remove the duplicate blocks, before migrating to the pair keys.')
+
+    def handle(self, *args, **options):
+        if options['blocks_only']:
+            with transaction.atomic():
+                blocks = self._dedupe_blocks()
+            self.stdout.write(self.style.SUCCESS(f'Removed {blocks} blocks.'))
+            return
+
+        with transaction.atomic():
+            conversations = self._dedupe_conversations()
+            friendships = self._dedupe_friendships()
+            blocks = self._dedupe_blocks()
+            self._fill_pair_keys(Conversations, 'player1', 'player2')
+            self._fill_pair_keys(Friendship, 'player1', 'player2')
+            self._fill_pair_keys(BlockedUsers, 'player', 'blockedUser')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Removed {conversations} conversations, {friendships} friendships and {blocks} blocks.'))
+
+    def _duplicates(self, queryset, first_field, second_field):
+        """
+        Groups of rows with the same unordered pair, as lists of primary keys in creation order.
+        """
+        pairs = queryset.annotate(low=Least(first_field, second_field), high=Greatest(first_field, second_field)) \
+            .values('low', 'high').order_by().annotate(count=Count('pk')).filter(count__gt=1)
+        groups = []
+        for pair in pairs:
+            groups.append(list(queryset.annotate(
+                low=Least(first_field, second_field), high=Greatest(first_field, second_field)
+            ).filter(low=pair['low'], high=pair['high']).order_by('pk').values_list('pk', flat=True)))
+        return groups
+
+    def _dedupe_conversations(self):
+        removed = 0
+        for keep_id, *duplicate_ids in self._duplicates(
+                Conversations.objects.exclude(player1=None).exclude(player2=None), 'player1', 'player2'):
+            keep = Conversations.objects.get(pk=keep_id)
+            duplicates = list(Conversations.objects.filter(pk__in=duplicate_ids))
+
+            # Duplicates may list the players in the other order
+            for duplicate in duplicates:
+                for player_id in (keep.player1_id, keep.player2_id):
+                    count_field = keep.unread_count_field(player_id)
+                    setattr(keep, count_field, getattr(keep, count_field) +
+                            getattr(duplicate, duplicate.unread_count_field(player_id)))
+                    for field in ('last_read_field', 'cleared_before_field'):
+                        keep_field = getattr(keep, field)(player_id)
+                        setattr(keep, keep_field, max(getattr(keep, keep_field),
+                                                      getattr(duplicate, getattr(duplicate, field)(player_id))))
+
+            Messages.objects.filter(atConversation__in=duplicate_ids).update(atConversation=keep_id)
+            Conversations.objects.filter(pk__in=duplicate_ids).delete()
+
+            keep.lastMessage_id = Messages.objects.filter(atConversation=keep_id) \
+                .aggregate(last=Max('messageID'))['last']
+            keep.save(update_fields=['lastMessage', 'unreadCountPlayer1', 'unreadCountPlayer2',
+                                     'lastReadMessagePlayer1', 'lastReadMessagePlayer2',
+                                     'clearedBeforePlayer1', 'clearedBeforePlayer2'])
+            removed += len(duplicate_ids)
+        return removed
+
+    def _dedupe_friendships(self):
+        removed = 0
+        for group in self._duplicates(Friendship.objects.all(), 'player1', 'player2'):
+            accepted = Friendship.objects.filter(pk__in=group, friendshipAccepted=True) \
+                .aggregate(first=Min('pk'))['first']
+            removed += Friendship.objects.filter(pk__in=group).exclude(pk=accepted or group[0]).delete()[0]
+        return removed
+
+    def _dedupe_blocks(self):
+        """
+        Delete every block but the oldest of each (player, blockedUser), in SQL
+        naming only the columns that predate the pair keys. Nothing references
+        blocks, so there is nothing to cascade.
+        """
+        meta = BlockedUsers._meta
+        if meta.db_table not in connection.introspection.table_names():
+            # Fresh database, migrate creates the table with its constraints
+            return 0
+
+        quote = connection.ops.quote_name
+        table = quote(meta.db_table)
+        pk = quote(meta.pk.column)
+        player = quote(meta.get_field('player').column)
+        blocked_user = quote(meta.get_field('blockedUser').column)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {table} AS duplicate USING {table} AS kept '
+                f'WHERE duplicate.{player} = kept.{player} '
+                f'AND duplicate.{blocked_user} = kept.{blocked_user} '
+                f'AND duplicate.{pk} > kept.{pk}')
+            return cursor.rowcount
+
+    def _fill_pair_keys(self, model, first_field, second_field):
+        model.objects.filter(pairLow=None).exclude(**{first_field: None}).exclude(**{second_field: None}) \
+            .update(pairLow=Least(first_field, second_field), pairHigh=Greatest(first_field, second_field))
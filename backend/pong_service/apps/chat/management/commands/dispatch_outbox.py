@@ -0,0 +1,36 @@
+import asyncio
+import logging
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from pong_service.apps.chat.outbox import dispatch_outbox_batch
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Deliver the websocket events recorded by the sync views in the outbox.
+
+    Run a single instance of it next to the websocket server. The outbox is polled
+    every OUTBOX_POLL_INTERVAL seconds, and drained without waiting while full
+    batches are waiting.
+    """
+    help = 'Deliver outbox events to the channel layer.'
+
+    def handle(self, *args, **options):
+        channel_layer = get_channel_layer()
+        if not channel_layer:
+            self.stderr.write('Channel layer is not available.')
+            return
+        asyncio.run(self.dispatch(channel_layer))
+
+    async def dispatch(self, channel_layer):
+        while True:
+            try:
+                fetched = await dispatch_outbox_batch(channel_layer)
+            except Exception as e:
+                logger.error(f'Failed to dispatch outbox events: {e}')
+                fetched = 0
+            if fetched < settings.OUTBOX_BATCH_SIZE:
+                await asyncio.sleep(settings.OUTBOX_POLL_INTERVAL)
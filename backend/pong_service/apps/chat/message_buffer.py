@@ -0,0 +1,215 @@
+import asyncio
+import logging
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Messages sent over the chat websocket, waiting to be written in one batch
+pending_messages = []
+_flusher = None
+# Flushes run one at a time, so a message resent while its first copy is being
+# written finds the client id of that copy
+_flush_lock = asyncio.Lock()
+
+SEND_ERROR = 'You cannot send a message to this conversation.'
+
+
+def _client_id_key(player_id, client_id):
+    return f'chat_client_id:{player_id}:{client_id}'
+
+
+def queue_message(sender, conversation_id, client_id, content, reply_channel):
+    """
+    Buffer a message sent over the chat websocket.
+
+    The buffer is written with a single bulk_create by a background flusher, either
+    every CHAT_MESSAGE_FLUSH_INTERVAL seconds or as soon as CHAT_MESSAGE_BATCH_SIZE
+    messages are waiting. The sender is acked on `reply_channel` once the message
+    is persisted.
+    """
+    global _flusher
+
+    pending_messages.append({
+        'sender': sender,
+        'conversation_id': conversation_id,
+        'client_id': client_id,
+        'content': content,
+        'reply_channel': reply_channel,
+    })
+
+    if len(pending_messages) >= settings.CHAT_MESSAGE_BATCH_SIZE:
+        asyncio.get_running_loop().create_task(flush_messages())
+    if _flusher is None or _flusher.done():
+        _flusher = asyncio.get_running_loop().create_task(_flush_loop())
+
+
+async def _flush_loop():
+    while pending_messages:
+        await asyncio.sleep(settings.CHAT_MESSAGE_FLUSH_INTERVAL)
+        await flush_messages()
+
+
+async def flush_messages():
+    """
+    Persist every buffered message, then ack the senders and deliver the messages.
+    """
+    async with _flush_lock:
+        await _flush_pending()
+
+
+async def _flush_pending():
+    if not pending_messages:
+        return
+    batch = pending_messages[:]
+    pending_messages.clear()
+
+    try:
+        acks, deliveries = await database_sync_to_async(persist_messages)(batch)
+    except Exception as e:
+        logger.error(f'Failed to persist {len(batch)} chat messages: {e}')
+        acks = [(entry['reply_channel'], {'client_id': entry['client_id'], 'error': 'Message could not be sent.'})
+                for entry in batch]
+        deliveries = []
+
+    channel_layer = get_channel_layer()
+    for reply_channel, ack in acks:
+        await channel_layer.send(reply_channel, {'type': 'chat_ack', 'ack': ack})
+    for receiver_id, conversation_id, data in deliveries:
+        await channel_layer.group_send(
+            f'chat_{receiver_id}',
+            {
+                'type': 'chat_message',
+                'message': {
+                    'conversation_id': conversation_id,
+                    'data': data
+                }
+            }
+        )
+
+
+def persist_messages(batch):
+    """
+    Validate and write a batch of buffered messages in one transaction.
+
+    Messages whose client id was already persisted are acked with the stored
+    message instead of being written twice, so clients can safely resend. A copy
+    resent within the same batch gets the ack of the first one, on its own reply
+    channel, as the channel of the first copy may be gone with a reconnect.
+
+    Returns:
+        tuple: (acks as (reply_channel, ack) pairs, deliveries as (receiver_id, conversation_id, data))
+    """
+    from pong_service.apps.chat.models import Conversations, Messages
+    from pong_service.apps.chat.serializers import MessagesSerializer
+
+    conversations = Conversations.objects.in_bulk({entry['conversation_id'] for entry in batch})
+    known_ids = cache.get_many([_client_id_key(entry['sender'].id, entry['client_id']) for entry in batch])
+    known_messages = Messages.objects.select_related('sender').in_bulk(known_ids.values())
+
+    acks = []
+    accepted = []
+    # client id key -> entries resent before the first copy was flushed
+    resent = {}
+    for entry in batch:
+        key = _client_id_key(entry['sender'].id, entry['client_id'])
+        if key in resent:
+            resent[key].append(entry)
+            continue
+        resent[key] = []
+        if key in known_ids and known_ids[key] in known_messages:
+            acks.append((entry, {
+                'client_id': entry['client_id'],
+                'message': MessagesSerializer(known_messages[known_ids[key]]).data,
+            }))
+            continue
+
+        conversation = conversations.get(entry['conversation_id'])
+        if not _can_send(conversation, entry['sender']):
+            acks.append((entry, {'client_id': entry['client_id'], 'error': SEND_ERROR}))
+            continue
+        accepted.append((entry, conversation))
+
+    deliveries = []
+    if accepted:
+        deliveries = _write_messages(accepted, acks)
+
+    return [
+        (copy['reply_channel'], ack)
+        for entry, ack in acks
+        for copy in [entry] + resent[_client_id_key(entry['sender'].id, entry['client_id'])]
+    ], deliveries
+
+
+def _write_messages(accepted, acks):
+    """
+    Write the accepted messages with one bulk_create, and ack them.
+
+    Returns:
+        list: The deliveries as (receiver_id, conversation_id, data).
+    """
+    from pong_service.apps.chat.models import Messages
+    from pong_service.apps.chat.serializers import MessagesSerializer
+
+    with transaction.atomic():
+        messages = Messages.objects.bulk_create([
+            Messages(atConversation=conversation, sender_id=entry['sender'].id, content=entry['content'])
+            for entry, conversation in accepted
+        ])
+        _update_conversations(accepted, messages)
+
+    cache.set_many({
+        _client_id_key(entry['sender'].id, entry['client_id']): message.messageID
+        for (entry, _), message in zip(accepted, messages)
+    }, settings.CHAT_CLIENT_ID_TTL)
+
+    deliveries = []
+    for (entry, conversation), message in zip(accepted, messages):
+        # The sender is the socket user, not a loaded Player
+        data = MessagesSerializer(message, context={'sender_username': entry['sender'].username}).data
+        receiver_id = conversation.player1_id if entry['sender'].id == conversation.player2_id else conversation.player2_id
+        acks.append((entry, {'client_id': entry['client_id'], 'message': data}))
+        deliveries.append((receiver_id, conversation.conversationID, data))
+    return deliveries
+
+
+def _can_send(conversation, sender):
+    if conversation is None or not conversation.is_participant(sender.id):
+        return False
+    if sender.id == conversation.player1_id and not conversation.IsVisibleToPlayer1:
+        return False
+    if sender.id == conversation.player2_id and not conversation.IsVisibleToPlayer2:
+        return False
+    return not (conversation.IsBlockedByPlayer1 or conversation.IsBlockedByPlayer2)
+
+
+def _update_conversations(accepted, messages):
+    """
+    Point each conversation at its newest message, make it visible to the receivers
+    again and bump their unread counters, with one UPDATE per conversation.
+    """
+    from pong_service.apps.chat.models import Conversations
+
+    updates = {}
+    for (entry, conversation), message in zip(accepted, messages):
+        receiver_id = conversation.player1_id if entry['sender'].id == conversation.player2_id else conversation.player2_id
+        update = updates.setdefault(conversation.conversationID, {'unread': {}})
+        update['lastMessage_id'] = message.messageID
+        update['IsVisibleToPlayer1' if receiver_id == conversation.player1_id else 'IsVisibleToPlayer2'] = True
+        unread_count_field = conversation.unread_count_field(receiver_id)
+        update['unread'][unread_count_field] = update['unread'].get(unread_count_field, 0) + 1
+
+    now = timezone.now()
+    for conversation_id, update in updates.items():
+        unread = update.pop('unread')
+        Conversations.objects.filter(pk=conversation_id).update(
+            lastMessageTimeStamp=now,
+            **update,
+            **{field: F(field) + count for field, count in unread.items()}
+        )
@@ -1,9 +1,61 @@
+import uuid
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest, Least
 from pong_service.apps.authentication.models import Player
 
 # Create your models here.
 
-class Conversations(models.Model):
+def pair_key(player_a, player_b):
+	"""
+	Canonical key of an unordered pair of players: their ids as (lowest, highest).
+
+	Args:
+		player_a (Player | UUID | str): A player or a player id.
+		player_b (Player | UUID | str): The other player or player id.
+
+	Returns:
+		tuple: The (pairLow, pairHigh) key of the pair.
+	"""
+	ids = [player.pk if isinstance(player, Player) else player for player in (player_a, player_b)]
+	ids = [player_id if isinstance(player_id, uuid.UUID) else uuid.UUID(str(player_id)) for player_id in ids]
+	return tuple(sorted(ids))
+
+class PairQuerySet(models.QuerySet):
+	def between(self, player_a, player_b):
+		"""
+		Rows that link the two players, in either direction, as a single probe of
+		the (pairLow, pairHigh) index.
+		"""
+		pair_low, pair_high = pair_key(player_a, player_b)
+		return self.filter(pairLow=pair_low, pairHigh=pair_high)
+
+class PairModel(models.Model):
+	"""
+	Base for the models that link two players. The pair key is set once, when the
+	row is created, from the fields named by `pair_fields`. It is not editable,
+	so model serializers leave it out.
+	"""
+	pairLow = models.UUIDField(null=True, editable=False)
+	pairHigh = models.UUIDField(null=True, editable=False)
+
+	objects = PairQuerySet.as_manager()
+
+	pair_fields = ('player1', 'player2')
+
+	class Meta:
+		abstract = True
+
+	def save(self, *args, **kwargs):
+		if self._state.adding:
+			self.pairLow, self.pairHigh = pair_key(
+				*(getattr(self, f'{field}_id') for field in self.pair_fields))
+		super().save(*args, **kwargs)
+
+class Conversations(PairModel):
 	conversationID = models.BigAutoField(primary_key=True)
 	player1 = models.ForeignKey(Player, models.SET_NULL, null=True, related_name='conversations_as_player1')
 	player2 = models.ForeignKey(Player, models.SET_NULL, null=True, related_name='conversations_as_player2')
@@ -12,32 +64,169 @@ class Conversations(models.Model):
 	IsVisibleToPlayer2 = models.BooleanField(default=True)
 	IsBlockedByPlayer1 = models.BooleanField(default=False)
 	IsBlockedByPlayer2 = models.BooleanField(default=False)
+	unreadCountPlayer1 = models.PositiveIntegerField(default=0)
+	unreadCountPlayer2 = models.PositiveIntegerField(default=0)
+	# messageID of the newest message each participant has read
+	lastReadMessagePlayer1 = models.BigIntegerField(default=0)
+	lastReadMessagePlayer2 = models.BigIntegerField(default=0)
+	# messageID up to which each participant has cleared the conversation
+	clearedBeforePlayer1 = models.BigIntegerField(default=0)
+	clearedBeforePlayer2 = models.BigIntegerField(default=0)
 	lastMessageTimeStamp = models.DateTimeField(auto_now=True)
 
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=['pairLow', 'pairHigh'], name='conversation_pair_unique'),
+		]
+
+	def unread_count_field(self, player_id):
+		"""
+		Name of the unread counter column that belongs to the given participant.
+		"""
+		return 'unreadCountPlayer1' if self.player1_id == player_id else 'unreadCountPlayer2'
+
+	def last_read_field(self, player_id):
+		"""
+		Name of the read watermark column that belongs to the given participant.
+		"""
+		return 'lastReadMessagePlayer1' if self.player1_id == player_id else 'lastReadMessagePlayer2'
+
+	def cleared_before_field(self, player_id):
+		"""
+		Name of the clear watermark column that belongs to the given participant.
+		"""
+		return 'clearedBeforePlayer1' if self.player1_id == player_id else 'clearedBeforePlayer2'
+
+	def is_message_visible(self, player_id, message_id):
+		return message_id > getattr(self, self.cleared_before_field(player_id))
+
+	def visible_messages(self, player_id):
+		"""
+		Messages of the conversation that the participant has not cleared.
+		"""
+		return Messages.objects.filter(
+			atConversation=self, messageID__gt=getattr(self, self.cleared_before_field(player_id)))
+
+	def is_participant(self, player_id):
+		return player_id in (self.player1_id, self.player2_id)
+
+	def mark_as_read(self, player_id):
+		"""
+		Move the participant's read watermark up to the last message and reset their unread counter.
+		"""
+		last_read_field = self.last_read_field(player_id)
+		Conversations.objects.filter(pk=self.pk).update(**{
+			last_read_field: Greatest(F(last_read_field), self.lastMessage_id or 0),
+			self.unread_count_field(player_id): 0,
+		})
+
+	def clear_for(self, player_id):
+		"""
+		Hide every message up to the last one from the participant and mark them as read,
+		in a single UPDATE. The messages are deleted later by compact_conversations once
+		both participants have cleared them.
+		"""
+		cleared_before_field = self.cleared_before_field(player_id)
+		last_read_field = self.last_read_field(player_id)
+		last_message_id = Coalesce(F('lastMessage'), 0)
+		Conversations.objects.filter(pk=self.pk).update(**{
+			cleared_before_field: Greatest(F(cleared_before_field), last_message_id),
+			last_read_field: Greatest(F(last_read_field), last_message_id),
+			self.unread_count_field(player_id): 0,
+		})
+
+	def mark_as_read_up_to(self, player_id, message_id):
+		"""
+		Move the participant's read watermark up to the given message and recount the
+		messages above it, in a single UPDATE. Older message ids are ignored, and ids
+		past the last message of the conversation are capped at it, so a bogus id
+		cannot hold the watermark above the messages still to come.
+
+		Returns:
+			bool: True if the watermark moved.
+		"""
+		last_read_field = self.last_read_field(player_id)
+		read_up_to = Least(Value(message_id), Coalesce(F('lastMessage'), 0))
+		unread_messages_count = Messages.objects.filter(
+			atConversation=OuterRef('pk'), messageID__gt=message_id
+		).exclude(sender_id=player_id).order_by().values('atConversation') \
+			.annotate(count=Count('pk')).values('count')
+		return bool(Conversations.objects.filter(
+			pk=self.pk, **{f'{last_read_field}__lt': read_up_to}
+		).update(**{
+			last_read_field: read_up_to,
+			self.unread_count_field(player_id): Coalesce(Subquery(unread_messages_count), 0),
+		}))
+
+# Text search configuration of message content, without stemming since chats mix languages
+MESSAGE_SEARCH_CONFIG = 'simple'
+
+def message_search_vector():
+	"""
+	The tsvector of a message's content. It matches the expression of the
+	message_search_idx GIN index, so filtering on it is served by the index.
+	"""
+	return SearchVector('content', config=MESSAGE_SEARCH_CONFIG)
+
 class Messages(models.Model):
 	messageID = models.BigAutoField(primary_key=True)
 	atConversation = models.ForeignKey(Conversations, on_delete=models.CASCADE)
 	sender = models.ForeignKey(Player, models.SET_NULL, null=True)
 	content = models.TextField()
+	# Legacy per-message visibility, replaced by the clear watermarks on Conversations
 	IsVisibleToPlayer1 = models.BooleanField(default=True)
 	IsVisibleToPlayer2 = models.BooleanField(default=True)
 	messageTimestamp = models.DateTimeField(auto_now_add=True)
 
+	class Meta:
+		indexes = [
+			models.Index(fields=['atConversation', 'messageTimestamp', 'messageID'],
+						 name='message_history_idx'),
+			GinIndex(message_search_vector(), name='message_search_idx'),
+		]
+
 class MessageReadStatus(models.Model):
+	# Legacy per-message read state, replaced by the read watermarks on Conversations.
+	# It is no longer written and is only kept so backfill_read_state can convert old rows.
 	messageReadStatusID = models.BigAutoField(primary_key=True)
 	atMessage = models.ForeignKey(Messages, on_delete=models.CASCADE)
 	receiver = models.ForeignKey(Player, on_delete=models.CASCADE)
 	IsRead = models.BooleanField(default=False)
 
-class Friendship(models.Model):
+class Friendship(PairModel):
 	friendshipID = models.BigAutoField(primary_key=True)
 	player1 = models.ForeignKey(Player, models.CASCADE, related_name='friendships_as_player1')
 	player2 = models.ForeignKey(Player, models.CASCADE, related_name='friendships_as_player2')
 	friendshipTimestamp = models.DateTimeField(auto_now_add=True)
 	friendshipAccepted = models.BooleanField(default=False)
 
-class BlockedUsers(models.Model):
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=['pairLow', 'pairHigh'], name='friendship_pair_unique'),
+		]
+
+class BlockedUsers(PairModel):
 	blockID = models.BigAutoField(primary_key=True)
 	player = models.ForeignKey(Player, models.CASCADE)
 	blockedUser = models.ForeignKey(Player, models.CASCADE, related_name='blocked_user')
 	blockTimestamp = models.DateTimeField(auto_now_add=True)
+
+	pair_fields = ('player', 'blockedUser')
+
+	class Meta:
+		# Two players may block each other, so the pair key is only indexed here
+		# and each direction is unique instead
+		indexes = [
+			models.Index(fields=['pairLow', 'pairHigh'], name='blocked_users_pair_idx'),
+		]
+		constraints = [
+			models.UniqueConstraint(fields=['player', 'blockedUser'], name='blocked_users_unique'),
+		]
+
+class OutboxEvent(models.Model):
+	# A channel layer group_send recorded by a sync view, delivered by dispatch_outbox
+	outboxEventID = models.BigAutoField(primary_key=True)
+	group = models.CharField(max_length=255)
+	# events carry player and game ids, which are UUIDs
+	message = models.JSONField(encoder=DjangoJSONEncoder)
+	eventTimestamp = models.DateTimeField(auto_now_add=True)
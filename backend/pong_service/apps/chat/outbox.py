@@ -0,0 +1,119 @@
+import asyncio
+import logging
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from pong_service.apps.chat import inbox
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def enqueue_group_send(group, message):
+    """
+    Record a channel layer group_send in the outbox instead of sending it inline.
+
+    The row is written in the caller's transaction, so the event is only delivered
+    if that transaction commits. Delivery is done by the dispatch_outbox command.
+
+    Args:
+        group (str): The channel layer group to send to.
+        message (dict): The JSON serializable event, including its 'type'.
+    """
+    from pong_service.apps.chat.models import OutboxEvent
+
+    OutboxEvent.objects.create(group=group, message=message)
+
+
+def enqueue_notification(user_id, notification):
+    """
+    Record a notification for the user in the outbox. When it is dispatched it is
+    appended to the user's inbox, so it can be replayed later, and then sent to
+    their notification sockets with its inbox id.
+
+    Args:
+        user_id (UUID | str): The recipient.
+        notification (dict): The JSON serializable notification, including its 'type'.
+    """
+    enqueue_group_send(f'notification_{user_id}', {
+        'type': 'notification_message',
+        'message': notification,
+        'inbox': str(user_id),
+    })
+
+
+def _store_in_inbox(event_id, message):
+    """
+    Append a notification event to the inbox of its recipient, once per outbox
+    event, so a retried event is not replayed twice.
+
+    Returns:
+        dict: The event to send, with the notification stamped with its inbox id.
+    """
+    user_id = message.get('inbox')
+    if user_id is None:
+        return message
+    notification = dict(message['message'])
+    notification['id'] = inbox.append(user_id, message['message'], event_id)
+    return {'type': message['type'], 'message': notification}
+
+
+def _fetch_events(limit):
+    from pong_service.apps.chat.models import OutboxEvent
+
+    return list(OutboxEvent.objects.order_by('outboxEventID')
+                .values_list('outboxEventID', 'group', 'message')[:limit])
+
+
+def _delete_events(event_ids):
+    from pong_service.apps.chat.models import OutboxEvent
+
+    OutboxEvent.objects.filter(outboxEventID__in=event_ids).delete()
+
+
+async def _send_group_events(channel_layer, group, events):
+    """
+    Send the events of one group in order, stopping at the first failure so the
+    remaining events are retried in order on the next batch.
+
+    Returns:
+        list: The ids of the events that were sent.
+    """
+    sent = []
+    for event_id, message in events:
+        try:
+            message = await sync_to_async(_store_in_inbox)(event_id, message)
+            await channel_layer.group_send(group, message)
+        except Exception as e:
+            logger.error(f'Failed to dispatch outbox event {event_id} to {group}: {e}')
+            break
+        sent.append(event_id)
+    return sent
+
+
+async def dispatch_outbox_batch(channel_layer):
+    """
+    Deliver the oldest OUTBOX_BATCH_SIZE outbox events and delete the ones that were sent.
+
+    Events are grouped by channel layer group: each group is sent to in order,
+    while different groups are sent to concurrently.
+
+    Returns:
+        int: The number of events fetched from the outbox.
+    """
+    events = await database_sync_to_async(_fetch_events)(settings.OUTBOX_BATCH_SIZE)
+    if not events:
+        return 0
+
+    groups = {}
+    for event_id, group, message in events:
+        groups.setdefault(group, []).append((event_id, message))
+
+    results = await asyncio.gather(*(
+        _send_group_events(channel_layer, group, group_events)
+        for group, group_events in groups.items()
+    ))
+    sent = [event_id for group_sent in results for event_id in group_sent]
+    if sent:
+        await database_sync_to_async(_delete_events)(sent)
+    return len(events)
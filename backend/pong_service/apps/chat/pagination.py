@@ -0,0 +1,28 @@
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+
+class MessageCursorPagination(CursorPagination):
+    """
+    Cursor pagination over the message history of a conversation, newest first.
+
+    DRF positions the cursor on the first ordering field only: a page starts at
+    the messages older than the messageTimestamp of the previous page's last
+    message, on the composite (atConversation, messageTimestamp, messageID)
+    index, and skips the messages sharing that timestamp with an offset. Ties
+    are rare, so the offset stays small however deep the page. messageID only
+    keeps the order of the messages with the same timestamp stable.
+    """
+    ordering = ('-messageTimestamp', '-messageID')
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+
+class MessageSearchPagination(PageNumberPagination):
+    """
+    Page number pagination over message search results, which are ordered by
+    rank and so cannot be paginated with a keyset cursor.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
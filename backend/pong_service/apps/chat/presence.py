@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import time
+import uuid
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from pong_service.helpers import get_redis_client
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Sorted set of online user ids, scored by the time their presence expires
+ONLINE_KEY = 'presence:online'
+# Online user ids read from the sorted set at once when listing them
+ONLINE_PAGE_SIZE = 500
+
+# channel_name -> user_id of the notification sockets served by this process
+local_connections = {}
+_heartbeat = None
+
+# KEYS: connections of the user, online users
+# ARGV: channel name, now, expiry, ttl, user id
+_CONNECT_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('ZADD', KEYS[2], 'GT', ARGV[3], ARGV[5])
+return redis.call('ZCARD', KEYS[1])
+"""
+
+# KEYS: connections of the user, online users
+# ARGV: channel name, now, user id
+_DISCONNECT_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+local removed = redis.call('ZREM', KEYS[1], ARGV[1])
+if redis.call('ZCARD', KEYS[1]) == 0 then
+    redis.call('ZREM', KEYS[2], ARGV[3])
+    return removed
+end
+return 0
+"""
+
+
+def _connections_key(user_id):
+    return f'presence:connections:{user_id}'
+
+
+def connect(user_id, channel_name):
+    """
+    Register a notification socket of the user.
+
+    Each socket is a member of the user's connection set, scored by its expiry,
+    so a user with several tabs stays online until the last one closes, and the
+    sockets of a crashed process expire after PRESENCE_TTL seconds.
+
+    Returns:
+        bool: True if this is the user's only live connection, i.e. the user just came online.
+    """
+    now = time.time()
+    connections = get_redis_client().eval(
+        _CONNECT_SCRIPT, 2, _connections_key(user_id), ONLINE_KEY,
+        channel_name, now, now + settings.PRESENCE_TTL, settings.PRESENCE_TTL, str(user_id))
+    return connections == 1
+
+
+def disconnect(user_id, channel_name):
+    """
+    Unregister a notification socket of the user.
+
+    Returns:
+        bool: True if it was the user's last live connection, i.e. the user just went offline.
+    """
+    return bool(get_redis_client().eval(
+        _DISCONNECT_SCRIPT, 2, _connections_key(user_id), ONLINE_KEY,
+        channel_name, time.time(), str(user_id)))
+
+
+def heartbeat(connections):
+    """
+    Extend the presence of the given sockets by PRESENCE_TTL seconds, in one pipeline,
+    and drop the users whose presence expired.
+
+    Args:
+        connections (dict): channel_name -> user_id of the sockets to keep alive.
+    """
+    now = time.time()
+    expiry = now + settings.PRESENCE_TTL
+    pipe = get_redis_client().pipeline(transaction=False)
+    for channel_name, user_id in connections.items():
+        key = _connections_key(user_id)
+        pipe.zadd(key, {channel_name: expiry})
+        pipe.expire(key, settings.PRESENCE_TTL)
+        pipe.zadd(ONLINE_KEY, {str(user_id): expiry}, gt=True)
+    pipe.zremrangebyscore(ONLINE_KEY, '-inf', now)
+    pipe.execute()
+
+
+def get_online_ids():
+    """
+    Return the ids of every online user, as UUIDs.
+    """
+    members = get_redis_client().zrangebyscore(ONLINE_KEY, time.time(), '+inf')
+    return {uuid.UUID(member.decode()) for member in members}
+
+
+def iter_online_ids(page_size=ONLINE_PAGE_SIZE):
+    """
+    Page through the online users, so the whole set is never loaded at once.
+
+    Yields:
+        list: The ids of the next page of online users, as UUIDs.
+    """
+    client = get_redis_client()
+    now = time.time()
+    offset = 0
+    while True:
+        members = client.zrangebyscore(ONLINE_KEY, now, '+inf', start=offset, num=page_size)
+        if members:
+            yield [uuid.UUID(member.decode()) for member in members]
+        if len(members) < page_size:
+            return
+        offset += page_size
+
+
+def are_online(user_ids):
+    """
+    Look up the presence of several users in a single round trip.
+
+    Returns:
+        dict: user_id -> True if the user is online.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+    now = time.time()
+    scores = get_redis_client().zmscore(ONLINE_KEY, [str(user_id) for user_id in user_ids])
+    return {user_id: score is not None and score > now for user_id, score in zip(user_ids, scores)}
+
+
+def online_ids_among(user_ids):
+    """
+    Return the ids of the online users among the given ones, in a single round trip.
+    """
+    return {user_id for user_id, online in are_online(set(user_ids)).items() if online}
+
+
+def is_online(user_id):
+    score = get_redis_client().zscore(ONLINE_KEY, str(user_id))
+    return score is not None and score > time.time()
+
+
+def persist_online_status():
+    """
+    Copy the presence of every player to Player.online, with two UPDATEs. This also
+    marks offline the players whose sockets were lost with a crashed process.
+    """
+    from pong_service.apps.authentication.models import Player
+
+    online_ids = get_online_ids()
+    Player.objects.filter(online=True).exclude(id__in=online_ids).update(online=False)
+    Player.objects.filter(id__in=online_ids, online=False).update(online=True)
+
+
+async def register(user_id, channel_name):
+    """
+    Register a socket served by this process, and start the heartbeat of the
+    process on the running event loop if it is not running yet.
+
+    Returns:
+        bool: True if the user just came online.
+    """
+    global _heartbeat
+
+    local_connections[channel_name] = user_id
+    if _heartbeat is None or _heartbeat.done():
+        _heartbeat = asyncio.get_running_loop().create_task(_heartbeat_loop())
+    return await sync_to_async(connect)(user_id, channel_name)
+
+
+async def unregister(user_id, channel_name):
+    """
+    Unregister a socket served by this process.
+
+    Returns:
+        bool: True if the user just went offline.
+    """
+    local_connections.pop(channel_name, None)
+    return await sync_to_async(disconnect)(user_id, channel_name)
+
+
+async def _heartbeat_loop():
+    next_persist = time.monotonic() + settings.PRESENCE_PERSIST_INTERVAL
+    while True:
+        await asyncio.sleep(settings.PRESENCE_HEARTBEAT_INTERVAL)
+        try:
+            await sync_to_async(heartbeat)(dict(local_connections))
+            if time.monotonic() >= next_persist:
+                next_persist = time.monotonic() + settings.PRESENCE_PERSIST_INTERVAL
+                await database_sync_to_async(persist_online_status)()
+        except Exception as e:
+            logger.error(f'Presence heartbeat failed: {e}')
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# (conversation_id, player_id) -> highest message id read, waiting to be flushed
+pending_receipts = {}
+_flusher = None
+
+
+def queue_read_receipt(conversation_id, player_id, message_id):
+    """
+    Buffer a read receipt sent over the chat websocket.
+
+    Receipts for the same conversation and player are debounced: only the highest
+    message id is kept, and the buffer is written to the database in one batch by
+    a background flusher running on the consumer's event loop.
+    """
+    global _flusher
+
+    key = (conversation_id, player_id)
+    if message_id > pending_receipts.get(key, 0):
+        pending_receipts[key] = message_id
+
+    if _flusher is None or _flusher.done():
+        _flusher = asyncio.get_running_loop().create_task(_flush_loop())
+
+
+async def _flush_loop():
+    while pending_receipts:
+        await asyncio.sleep(settings.CHAT_READ_RECEIPT_FLUSH_INTERVAL)
+        await flush_read_receipts()
+
+
+async def flush_read_receipts():
+    """
+    Write every buffered read receipt to the database.
+    """
+    if not pending_receipts:
+        return
+    receipts = dict(pending_receipts)
+    pending_receipts.clear()
+    try:
+        await database_sync_to_async(apply_read_receipts)(receipts)
+    except Exception as e:
+        logger.error(f'Failed to flush {len(receipts)} read receipts: {e}')
+
+
+def apply_read_receipts(receipts):
+    """
+    Move the read watermarks of a batch of receipts, ignoring players that are not
+    participants of the conversation.
+    """
+    from pong_service.apps.chat.models import Conversations
+
+    conversations = Conversations.objects.only('conversationID', 'player1', 'player2') \
+        .in_bulk({conversation_id for conversation_id, _ in receipts})
+    with transaction.atomic():
+        for (conversation_id, player_id), message_id in receipts.items():
+            conversation = conversations.get(conversation_id)
+            if conversation and conversation.is_participant(player_id):
+                conversation.mark_as_read_up_to(player_id, message_id)
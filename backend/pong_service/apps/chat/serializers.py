@@ -1,29 +1,23 @@
 from .models import *
 from rest_framework import serializers
 from pong_service.apps.authentication.serializers import PlayerListSerializer
-from django.db.models import Q
 from django.utils.html import escape
 
 
-class MessageReadStatusSerializer(serializers.ModelSerializer):
-
-    class Meta:
-        model = MessageReadStatus
-        fields = '__all__'
-
-
 class MessagesSerializer(serializers.ModelSerializer):
-    read_status = MessageReadStatusSerializer(many=True, read_only=True)
     sender = serializers.SerializerMethodField()
  
     class Meta:
         model = Messages
         fields = ['messageID', 'atConversation', 'sender', 'content',
-                  'IsVisibleToPlayer1', 'IsVisibleToPlayer2', 'messageTimestamp', 'read_status']
+                  'IsVisibleToPlayer1', 'IsVisibleToPlayer2', 'messageTimestamp']
         read_only_fields = ['atConversation', 'sender',
                             'IsVisibleToPlayer1', 'IsVisibleToPlayer2']
 
     def get_sender(self, obj):
+        sender_username = self.context.get('sender_username')
+        if sender_username is not None:
+            return sender_username
         return obj.sender.username
     
     def validate_content(self, value):
@@ -66,8 +60,7 @@ class ConversationSerializer(serializers.ModelSerializer):
         if isinstance(obj, Conversations):
             user = self.context['request'].user
             if obj.lastMessage:
-                if (user == obj.player1 and obj.lastMessage.IsVisibleToPlayer1) or \
-                        (user == obj.player2 and obj.lastMessage.IsVisibleToPlayer2):
+                if obj.is_message_visible(user.id, obj.lastMessage_id):
                     return obj.lastMessage.content
             return None
 
@@ -77,12 +70,7 @@ class ConversationSerializer(serializers.ModelSerializer):
     def get_unread_messages_count(self, obj):
         if isinstance(obj, Conversations):
             user = self.context['request'].user
-            unread_messages_count = MessageReadStatus.objects.filter(
-                Q(atMessage__atConversation=obj) &
-                Q(receiver=user) &
-                Q(IsRead=False)
-            ).count()
-            return unread_messages_count
+            return getattr(obj, obj.unread_count_field(user.id))
 
         raise TypeError(f"Expected Conversations instance but got {type(obj)}")
 
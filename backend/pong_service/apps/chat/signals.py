@@ -0,0 +1,17 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from pong_service.apps.chat import social_graph
+from pong_service.apps.chat.models import BlockedUsers, Friendship
+
+
+@receiver([post_save, post_delete], sender=Friendship)
+def invalidate_friendship(sender, instance, **kwargs):
+    player_ids = (instance.player1_id, instance.player2_id)
+    transaction.on_commit(lambda: social_graph.invalidate(*player_ids))
+
+
+@receiver([post_save, post_delete], sender=BlockedUsers)
+def invalidate_block(sender, instance, **kwargs):
+    player_ids = (instance.player_id, instance.blockedUser_id)
+    transaction.on_commit(lambda: social_graph.invalidate(*player_ids))
@@ -0,0 +1,173 @@
+import logging
+import uuid
+from django.conf import settings
+from django.db.models import Q
+from redis import RedisError
+from pong_service.helpers import get_redis_client
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Stored in every cached set so an empty adjacency list is still a cache hit
+_LOADED = '-'
+
+FRIENDS = 'friends'
+BLOCKS = 'blocks'
+
+# KEYS: adjacency set, generation
+# ARGV: generation when the set was queried, ttl, members
+# Writes the set back only if it was not invalidated since it was queried
+_STORE_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] or redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('SADD', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+def _key(relation, user_id):
+    return f'social:{relation}:{user_id}'
+
+
+def _generation_key(relation, user_id):
+    return f'social:{relation}:{user_id}:generation'
+
+
+def _query_friend_ids(user_id):
+    from pong_service.apps.chat.models import Friendship
+
+    friendships = Friendship.objects.filter(
+        Q(player1_id=user_id) | Q(player2_id=user_id),
+        friendshipAccepted=True
+    ).values_list('player1_id', 'player2_id')
+    return {player2_id if str(player1_id) == str(user_id) else player1_id
+            for player1_id, player2_id in friendships}
+
+
+def _query_block_ids(user_id):
+    from pong_service.apps.chat.models import BlockedUsers
+
+    blocks = BlockedUsers.objects.filter(
+        Q(player_id=user_id) | Q(blockedUser_id=user_id)
+    ).values_list('player_id', 'blockedUser_id')
+    return {blocked_id if str(player_id) == str(user_id) else player_id
+            for player_id, blocked_id in blocks}
+
+
+_QUERIES = {
+    FRIENDS: _query_friend_ids,
+    BLOCKS: _query_block_ids,
+}
+
+
+def _load(relation, user_id):
+    """
+    Query an adjacency set from the database and cache it.
+
+    The generation of the set is read before querying it: if the set is
+    invalidated while it is being queried, the result may predate the change and
+    is not cached, the next use loads it again.
+    """
+    client = get_redis_client()
+    generation_key = _generation_key(relation, user_id)
+    generation = client.get(generation_key) or b'0'
+    ids = _QUERIES[relation](user_id)
+    client.eval(_STORE_SCRIPT, 2, _key(relation, user_id), generation_key,
+                generation, settings.SOCIAL_GRAPH_CACHE_TTL, _LOADED, *(str(player_id) for player_id in ids))
+    return {uuid.UUID(str(player_id)) for player_id in ids}
+
+
+def _members(relation, user_id):
+    try:
+        members = get_redis_client().smembers(_key(relation, user_id))
+        if members:
+            return {uuid.UUID(member.decode()) for member in members if member.decode() != _LOADED}
+        return _load(relation, user_id)
+    except RedisError as e:
+        logger.warning(f'Social graph cache unavailable, querying the database: {e}')
+        return {uuid.UUID(str(player_id)) for player_id in _QUERIES[relation](user_id)}
+
+
+def _is_member(relation, user_id, other_id):
+    """
+    Check if `other_id` is in the adjacency set of `user_id` with a single round trip
+    on a cache hit.
+    """
+    key = _key(relation, user_id)
+    try:
+        pipe = get_redis_client().pipeline()
+        pipe.exists(key)
+        pipe.sismember(key, str(other_id))
+        exists, is_member = pipe.execute()
+        if exists:
+            return bool(is_member)
+    except RedisError as e:
+        logger.warning(f'Social graph cache unavailable, querying the database: {e}')
+        return uuid.UUID(str(other_id)) in {uuid.UUID(str(player_id)) for player_id in _QUERIES[relation](user_id)}
+    return uuid.UUID(str(other_id)) in _load(relation, user_id)
+
+
+def _id(player):
+    return getattr(player, 'pk', player)
+
+
+def get_friend_ids(user):
+    """
+    Return the ids of every player with an accepted friendship with the given user.
+
+    Args:
+        user (Player | UUID | str): A player or a player id.
+
+    Returns:
+        set: The friends' ids, as UUIDs.
+    """
+    return _members(FRIENDS, _id(user))
+
+
+def get_block_ids(user):
+    """
+    Return the ids of every player that blocked, or was blocked by, the given user.
+
+    Args:
+        user (Player | UUID | str): A player or a player id.
+
+    Returns:
+        set: The players' ids, as UUIDs.
+    """
+    return _members(BLOCKS, _id(user))
+
+
+def are_friends(player_a, player_b):
+    return _is_member(FRIENDS, _id(player_a), _id(player_b))
+
+
+def is_blocked_between(player_a, player_b):
+    """
+    Check if either player blocked the other, in the database: a block must take
+    effect at once, while the cache is only refreshed after the commit. It is a
+    single probe of the pair index.
+    """
+    from pong_service.apps.chat.models import BlockedUsers
+
+    return BlockedUsers.objects.between(_id(player_a), _id(player_b)).exists()
+
+
+def invalidate(*user_ids):
+    """
+    Drop the cached adjacency sets of the given users, they are reloaded on next use.
+    Their generation is bumped, so a load that queried them before the change does
+    not cache its result.
+    """
+    pipe = get_redis_client().pipeline()
+    for user_id in user_ids:
+        for relation in (FRIENDS, BLOCKS):
+            generation_key = _generation_key(relation, user_id)
+            pipe.delete(_key(relation, user_id))
+            pipe.incr(generation_key)
+            pipe.expire(generation_key, settings.SOCIAL_GRAPH_CACHE_TTL)
+    try:
+        pipe.execute()
+    except RedisError as e:
+        logger.error(f'Failed to invalidate the social graph cache of {user_ids}: {e}')
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import time
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from pong_service.apps.chat import social_graph
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# user_id -> status change waiting to be sent to the user's friends
+pending_changes = {}
+_flusher = None
+
+# Totals since the process started, the last flush is also logged
+fanout_metrics = {
+    'flushes': 0,
+    'changes': 0,
+    'flaps_dropped': 0,
+    'recipients': 0,
+    'max_recipients': 0,
+    'last_latency_ms': 0,
+}
+
+
+def queue_status_change(user_id, username, online):
+    """
+    Buffer an online status change of a user to be sent to their friends.
+
+    Changes are debounced for PRESENCE_FANOUT_DEBOUNCE seconds: only the latest
+    status of each user is sent, and a user that went back to the status they had
+    before the window is not announced at all.
+    """
+    global _flusher
+
+    change = pending_changes.get(user_id)
+    if change is None:
+        pending_changes[user_id] = {
+            'username': username,
+            'online': online,
+            'was_online': not online,
+            'queued_at': time.monotonic(),
+        }
+    else:
+        change['online'] = online
+
+    if _flusher is None or _flusher.done():
+        _flusher = asyncio.get_running_loop().create_task(_flush_loop())
+
+
+async def _flush_loop():
+    while pending_changes:
+        await asyncio.sleep(settings.PRESENCE_FANOUT_DEBOUNCE)
+        await flush_status_changes()
+
+
+def _digests(changes):
+    """
+    Group the status changes by recipient.
+
+    Returns:
+        dict: friend_id -> list of {'username', 'online'} statuses.
+    """
+    digests = {}
+    for user_id, change in changes.items():
+        status = {'username': change['username'], 'online': change['online']}
+        for friend_id in social_graph.get_friend_ids(user_id):
+            digests.setdefault(friend_id, []).append(status)
+    return digests
+
+
+async def flush_status_changes():
+    """
+    Send every buffered status change, with a single group_send per recipient
+    carrying all the changes of their friends. The sends run concurrently.
+    """
+    if not pending_changes:
+        return
+    changes = dict(pending_changes)
+    pending_changes.clear()
+
+    flaps = [user_id for user_id, change in changes.items() if change['online'] == change['was_online']]
+    for user_id in flaps:
+        del changes[user_id]
+    fanout_metrics['flaps_dropped'] += len(flaps)
+    if not changes:
+        return
+
+    channel_layer = get_channel_layer()
+    try:
+        digests = await sync_to_async(_digests)(changes)
+        results = await asyncio.gather(*(
+            channel_layer.group_send(f'notification_{friend_id}', {
+                'type': 'presence_digest',
+                'statuses': statuses,
+            })
+            for friend_id, statuses in digests.items()
+        ), return_exceptions=True)
+    except Exception as e:
+        logger.error(f'Failed to send {len(changes)} status changes: {e}')
+        return
+
+    failures = sum(isinstance(result, Exception) for result in results)
+    latency_ms = int((time.monotonic() - min(change['queued_at'] for change in changes.values())) * 1000)
+    fanout_metrics['flushes'] += 1
+    fanout_metrics['changes'] += len(changes)
+    fanout_metrics['recipients'] += len(digests)
+    fanout_metrics['max_recipients'] = max(fanout_metrics['max_recipients'], len(digests))
+    fanout_metrics['last_latency_ms'] = latency_ms
+    logger.info(f'Sent {len(changes)} status changes to {len(digests)} recipients '
+                f'in {latency_ms}ms ({failures} failed, {len(flaps)} flaps dropped)')
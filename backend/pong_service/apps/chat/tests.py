@@ -1,3 +1,549 @@
-from django.test import TestCase
+import asyncio
+from io import StringIO
+from unittest import mock
+from asgiref.sync import ThreadSensitiveContext
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from pong_service import keepalive
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from pong_service.asgi import application
+from pong_service.helpers import get_redis_client
+from pong_service.apps.authentication.models import Player
+from pong_service.apps.chat import inbox, message_buffer, outbox, social_graph
+from pong_service.apps.chat.models import (
+    BlockedUsers, Conversations, Friendship, MessageReadStatus, Messages, OutboxEvent)
 
-# Create your tests here.
+
+def create_conversation(player1, player2, *contents):
+    """
+    Create a conversation between two players, with messages sent by player2.
+    """
+    conversation = Conversations.objects.create(player1=player1, player2=player2)
+    for content in contents:
+        message = Messages.objects.create(atConversation=conversation, sender=player2, content=content)
+        conversation.lastMessage = message
+        conversation.unreadCountPlayer1 += 1
+    conversation.save()
+    return conversation
+
+
+def connect_socket(player, path):
+    """
+    Open a websocket authenticated as the player.
+    """
+    return WebsocketCommunicator(application, path, headers=[
+        (b'cookie', f'{settings.AUTH_COOKIE}={AccessToken.for_user(player)}'.encode()),
+    ])
+
+
+class ChatAPITestCase(TestCase):
+    def setUp(self):
+        self.player = Player.objects.create(username='alice')
+        self.client = APIClient()
+        self.client.force_authenticate(self.player)
+
+    def create_player(self, username):
+        return Player.objects.create(username=username)
+
+
+class ConversationListTests(ChatAPITestCase):
+    def add_conversations(self, count):
+        for _ in range(count):
+            other = self.create_player(f'player{Player.objects.count()}')
+            create_conversation(self.player, other, 'hello', 'there')
+
+    def list_conversations(self):
+        response = self.client.get('/api/conversations/')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_query_count_does_not_grow_with_the_conversations(self):
+        self.add_conversations(2)
+        # the friend ids are cached after the first request
+        self.list_conversations()
+        with CaptureQueriesContext(connection) as queries:
+            self.list_conversations()
+
+        self.add_conversations(8)
+        with self.assertNumQueries(len(queries)):
+            conversations = self.list_conversations()
+        self.assertEqual(len(conversations), 10)
+
+    def test_unread_count_is_read_from_the_counter(self):
+        create_conversation(self.player, self.create_player('bob'), 'one', 'two', 'three')
+
+        [conversation] = self.list_conversations()
+
+        self.assertEqual(conversation['unread_messages_count'], 3)
+        self.assertEqual(conversation['last_message'], 'three')
+
+
+    def test_conversation_created_concurrently_is_reopened(self):
+        other = self.create_player('bob')
+        between = Conversations.objects.between
+        # Another request creates the conversation after this one checked for it
+        existing = Conversations.objects.create(player1=other, player2=self.player, IsVisibleToPlayer2=False)
+
+        with mock.patch.object(Conversations.objects, 'between',
+                               side_effect=[Conversations.objects.none(), between(self.player, other)]):
+            response = self.client.post('/api/conversations/', {'player2_username': 'bob'})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['conversationID'], existing.pk)
+        existing.refresh_from_db()
+        self.assertTrue(existing.IsVisibleToPlayer2)
+
+class ReadWatermarkTests(ChatAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = self.create_player('bob')
+        self.conversation = create_conversation(self.player, self.other, 'one', 'two', 'three')
+        self.message_ids = list(self.conversation.visible_messages(self.player.id)
+                                .order_by('messageID').values_list('messageID', flat=True))
+
+    def read_up_to(self, message_id):
+        return self.client.post(f'/api/conversations/{self.conversation.pk}/read', {'message_id': message_id})
+
+    def test_read_receipt_recounts_the_unread_messages(self):
+        self.assertEqual(self.read_up_to(self.message_ids[0]).status_code, 204)
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.lastReadMessagePlayer1, self.message_ids[0])
+        self.assertEqual(self.conversation.unreadCountPlayer1, 2)
+        self.assertEqual(self.conversation.unreadCountPlayer2, 0)
+
+    def test_older_read_receipt_does_not_move_the_watermark_back(self):
+        self.read_up_to(self.message_ids[2])
+        self.read_up_to(self.message_ids[1])
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.lastReadMessagePlayer1, self.message_ids[2])
+        self.assertEqual(self.conversation.unreadCountPlayer1, 0)
+
+    def test_clear_hides_the_messages_only_from_the_player(self):
+        response = self.client.post(f'/api/conversations/{self.conversation.pk}/clear')
+        self.assertEqual(response.status_code, 204)
+        Messages.objects.create(atConversation=self.conversation, sender=self.other, content='four')
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.clearedBeforePlayer1, self.message_ids[2])
+        self.assertEqual(self.conversation.unreadCountPlayer1, 0)
+        self.assertEqual([message.content for message in self.conversation.visible_messages(self.player.id)],
+                         ['four'])
+        self.assertEqual(self.conversation.visible_messages(self.other.id).count(), 4)
+
+    def test_read_receipt_past_the_last_message_is_capped(self):
+        self.read_up_to(10 ** 12)
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.lastReadMessagePlayer1, self.message_ids[2])
+
+        message = Messages.objects.create(atConversation=self.conversation, sender=self.other, content='four')
+        Conversations.objects.filter(pk=self.conversation.pk).update(lastMessage=message)
+        self.read_up_to(message.messageID)
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.lastReadMessagePlayer1, message.messageID)
+
+
+class WriteBehindTests(ChatAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = self.create_player('bob')
+        self.conversation = create_conversation(self.player, self.other)
+        self.addCleanup(cache.delete_many, [
+            message_buffer._client_id_key(self.player.id, client_id) for client_id in ('c1', 'c2')])
+
+    def entry(self, client_id, content, reply_channel):
+        return {
+            'sender': self.player,
+            'conversation_id': self.conversation.pk,
+            'client_id': client_id,
+            'content': content,
+            'reply_channel': reply_channel,
+        }
+
+    def test_message_resent_after_the_flush_is_not_written_twice(self):
+        acks, deliveries = message_buffer.persist_messages([self.entry('c1', 'hello', 'socket1')])
+        [(_, first_ack)] = acks
+        self.assertEqual(len(deliveries), 1)
+
+        acks, deliveries = message_buffer.persist_messages([self.entry('c1', 'hello', 'socket2')])
+
+        self.assertEqual(acks, [('socket2', first_ack)])
+        self.assertEqual(deliveries, [])
+        self.assertEqual(self.conversation.visible_messages(self.player.id).count(), 1)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.unreadCountPlayer2, 1)
+
+    def test_every_copy_resent_within_a_batch_is_acked(self):
+        acks, deliveries = message_buffer.persist_messages([
+            self.entry('c1', 'hello', 'socket1'),
+            self.entry('c2', 'there', 'socket1'),
+            self.entry('c1', 'hello', 'socket2'),
+        ])
+
+        self.assertEqual(self.conversation.visible_messages(self.player.id).count(), 2)
+        self.assertEqual(len(deliveries), 2)
+        self.assertEqual(sorted((reply_channel, ack['client_id']) for reply_channel, ack in acks),
+                         [('socket1', 'c1'), ('socket1', 'c2'), ('socket2', 'c1')])
+        acked_c1 = [ack['message'] for _, ack in acks if ack['client_id'] == 'c1']
+        self.assertEqual(acked_c1[0], acked_c1[1])
+
+
+class OutboxInboxTests(ChatAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(get_redis_client().delete, inbox._key(self.player.id), inbox._appended_key(1))
+
+    def test_retried_event_is_stored_in_the_inbox_once(self):
+        event = {'type': 'notification_message', 'message': {'type': 'friend_request'}, 'inbox': str(self.player.id)}
+
+        first = outbox._store_in_inbox(1, event)
+        retried = outbox._store_in_inbox(1, event)
+
+        self.assertEqual(retried, first)
+        self.assertEqual(inbox.read_after(self.player.id, '0-0'), [(first['message']['id'], {'type': 'friend_request'})])
+
+
+class SocialGraphCacheTests(ChatAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = self.create_player('bob')
+        self.addCleanup(get_redis_client().delete, *(
+            key for relation in (social_graph.FRIENDS, social_graph.BLOCKS) for player in (self.player, self.other)
+            for key in (social_graph._key(relation, player.id), social_graph._generation_key(relation, player.id))))
+
+    def test_set_invalidated_while_it_is_loaded_is_not_cached(self):
+        query = social_graph._QUERIES[social_graph.BLOCKS]
+
+        def query_before_a_block(user_id):
+            ids = query(user_id)
+            # A block commits after the query read the blocks
+            BlockedUsers.objects.create(player=self.player, blockedUser=self.other)
+            social_graph.invalidate(self.player.id, self.other.id)
+            return ids
+
+        with mock.patch.dict(social_graph._QUERIES, {social_graph.BLOCKS: query_before_a_block}):
+            self.assertEqual(social_graph.get_block_ids(self.player), set())
+
+        self.assertEqual(social_graph.get_block_ids(self.player), {self.other.id})
+
+    def test_block_is_checked_in_the_database(self):
+        self.assertEqual(social_graph.get_block_ids(self.other), set())
+
+        BlockedUsers.objects.create(player=self.player, blockedUser=self.other)
+
+        self.assertTrue(social_graph.is_blocked_between(self.other, self.player))
+
+
+class FriendRequestTests(ChatAPITestCase):
+    def test_friend_request_notifies_the_other_player(self):
+        other = self.create_player('bob')
+
+        response = self.client.post('/api/friendships/', {'player2_username': 'bob'})
+
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertTrue(Friendship.objects.filter(player1=self.player, player2=other,
+                                                  friendshipAccepted=False).exists())
+        event = OutboxEvent.objects.get()
+        self.assertEqual(event.group, f'notification_{other.id}')
+        self.assertEqual(event.message['message'],
+                         {'type': 'friend_request', 'user_id': str(self.player.id)})
+
+
+class DedupePlayerPairsTests(ChatAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = self.create_player('bob')
+
+    def dedupe(self, *args):
+        call_command('dedupe_player_pairs', *args, stdout=StringIO())
+
+    def test_duplicate_blocks_are_removed_before_migrating(self):
+        # Rows written before the migration that adds the unique constraint
+        constraint = next(constraint for constraint in BlockedUsers._meta.constraints
+                          if constraint.name == 'blocked_users_unique')
+        with connection.schema_editor() as schema_editor:
+            schema_editor.remove_constraint(BlockedUsers, constraint)
+        first, _ = BlockedUsers.objects.bulk_create([
+            BlockedUsers(player=self.player, blockedUser=self.other),
+            BlockedUsers(player=self.player, blockedUser=self.other),
+        ])
+        BlockedUsers.objects.create(player=self.other, blockedUser=self.player)
+
+        self.dedupe('--blocks-only')
+
+        self.assertEqual(BlockedUsers.objects.filter(player=self.player).get().pk, first.pk)
+        self.assertEqual(BlockedUsers.objects.filter(player=self.other).count(), 1)
+
+    def test_pair_keys_of_existing_rows_are_filled_in(self):
+        create_conversation(self.player, self.other, 'hello')
+        Friendship.objects.create(player1=self.player, player2=self.other)
+        for model in (Conversations, Friendship):
+            model.objects.update(pairLow=None, pairHigh=None)
+
+        self.dedupe()
+
+        for model in (Conversations, Friendship):
+            self.assertEqual(model.objects.between(self.other, self.player).count(), 1)
+
+
+    def test_merged_conversation_keeps_the_newest_watermarks(self):
+        # Rows written before the pair keys, with the players in either order
+        Conversations.objects.bulk_create([
+            Conversations(player1=self.player, player2=self.other,
+                          lastReadMessagePlayer1=5, clearedBeforePlayer2=3),
+            Conversations(player1=self.other, player2=self.player,
+                          lastReadMessagePlayer2=8, clearedBeforePlayer1=9, lastReadMessagePlayer1=2),
+        ])
+
+        self.dedupe()
+
+        conversation = Conversations.objects.between(self.player, self.other).get()
+        self.assertEqual((conversation.lastReadMessagePlayer1, conversation.lastReadMessagePlayer2), (8, 2))
+        self.assertEqual((conversation.clearedBeforePlayer1, conversation.clearedBeforePlayer2), (0, 9))
+
+class BackfillReadStateTests(ChatAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = self.create_player('bob')
+        # Written before the deploy: the counters and watermarks are not set yet
+        self.conversation = create_conversation(self.player, self.other, 'one', 'two', 'three')
+        Conversations.objects.filter(pk=self.conversation.pk).update(unreadCountPlayer1=0)
+        self.messages = list(self.conversation.visible_messages(self.player.id).order_by('messageID'))
+        for message, read in zip(self.messages, (True, False, False)):
+            MessageReadStatus.objects.create(atMessage=message, receiver=self.player, IsRead=read)
+
+    def backfill(self):
+        call_command('backfill_read_state', stdout=StringIO())
+        self.conversation.refresh_from_db()
+
+    def test_legacy_read_state_is_converted_once(self):
+        self.backfill()
+
+        self.assertEqual(self.conversation.lastReadMessagePlayer1, self.messages[0].messageID)
+        self.assertEqual(self.conversation.unreadCountPlayer1, 2)
+        self.assertEqual(self.conversation.lastReadMessagePlayer2, self.messages[2].messageID)
+        self.assertFalse(MessageReadStatus.objects.exists())
+
+        Conversations.objects.filter(pk=self.conversation.pk).update(unreadCountPlayer1=5)
+        self.backfill()
+        self.assertEqual(self.conversation.unreadCountPlayer1, 5)
+
+    def test_read_state_since_the_deploy_is_kept(self):
+        self.client.post(f'/api/conversations/{self.conversation.pk}/read',
+                         {'message_id': self.messages[2].messageID})
+        Messages.objects.create(atConversation=self.conversation, sender=self.player, content='four')
+        Conversations.objects.filter(pk=self.conversation.pk).update(unreadCountPlayer2=1)
+
+        self.backfill()
+
+        self.assertEqual(self.conversation.lastReadMessagePlayer1, self.messages[2].messageID)
+        self.assertEqual(self.conversation.unreadCountPlayer1, 0)
+        self.assertEqual(self.conversation.unreadCountPlayer2, 1)
+
+
+class BackfillClearedBeforeTests(ChatAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = self.create_player('bob')
+        self.conversation = create_conversation(self.player, self.other, 'one', 'two', 'three')
+        self.messages = list(self.conversation.visible_messages(self.player.id).order_by('messageID'))
+        # Cleared by alice before the deploy, when clearing hid every message
+        Messages.objects.filter(pk__in=[message.pk for message in self.messages[:2]]).update(IsVisibleToPlayer1=False)
+
+    def backfill(self):
+        call_command('backfill_cleared_before', stdout=StringIO())
+        self.conversation.refresh_from_db()
+
+    def test_legacy_flags_are_converted_once(self):
+        self.backfill()
+
+        self.assertEqual(self.conversation.clearedBeforePlayer1, self.messages[1].messageID)
+        self.assertEqual(self.conversation.clearedBeforePlayer2, 0)
+        self.assertFalse(Messages.objects.filter(IsVisibleToPlayer1=False).exists())
+
+    def test_newer_watermarks_are_kept(self):
+        Conversations.objects.filter(pk=self.conversation.pk).update(
+            clearedBeforePlayer1=self.messages[2].messageID, clearedBeforePlayer2=self.messages[0].messageID)
+
+        self.backfill()
+
+        self.assertEqual(self.conversation.clearedBeforePlayer1, self.messages[2].messageID)
+        self.assertEqual(self.conversation.clearedBeforePlayer2, self.messages[0].messageID)
+
+
+class MessageSearchTests(ChatAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = self.create_player('bob')
+        self.conversation = create_conversation(self.player, self.other, 'pizza tonight?', 'no pizza, tacos')
+
+    def search(self, text, **params):
+        response = self.client.get('/api/messages/search', {'q': text, **params})
+        self.assertEqual(response.status_code, 200)
+        return [message['content'] for message in response.json()['results']]
+
+    def test_only_the_conversations_of_the_player_are_searched(self):
+        create_conversation(self.create_player('carol'), self.create_player('dave'), 'pizza for everyone')
+
+        self.assertEqual(sorted(self.search('pizza')), ['no pizza, tacos', 'pizza tonight?'])
+
+    def test_cleared_messages_are_not_found(self):
+        self.client.post(f'/api/conversations/{self.conversation.pk}/clear')
+        Messages.objects.create(atConversation=self.conversation, sender=self.other, content='pizza again')
+
+        self.assertEqual(self.search('pizza'), ['pizza again'])
+        self.client.force_authenticate(self.other)
+        self.assertEqual(len(self.search('pizza')), 3)
+
+    def test_search_within_a_conversation(self):
+        create_conversation(self.player, self.create_player('carol'), 'tacos on friday')
+
+        self.assertEqual(self.search('tacos', conversation_id=self.conversation.pk), ['no pizza, tacos'])
+        self.assertEqual(len(self.search('tacos')), 2)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ChatSocketTestCase(TransactionTestCase):
+    # Consumers close the database connection of the thread between their queries,
+    # so they cannot run inside the transaction of a TestCase
+    def setUp(self):
+        self.player = Player.objects.create(username='alice')
+
+
+class MultiplexSocketTests(ChatSocketTestCase):
+    async def send_chat_message(self, content):
+        await get_channel_layer().group_send(f'chat_{self.player.id}', {
+            'type': 'chat_message',
+            'message': {'conversation_id': 1, 'data': content},
+        })
+
+    async def test_messages_are_only_sent_on_open_streams(self):
+        socket = connect_socket(self.player, '/ws/')
+        connected, _ = await socket.connect()
+        self.assertTrue(connected)
+
+        await socket.send_json_to({'stream': 'chat', 'payload': {'type': 'message', 'client_id': 'c1'}})
+        await socket.send_json_to({'stream': 'chat', 'open': True})
+        # The invalid message is only answered on the open stream
+        await socket.send_json_to({'stream': 'chat', 'payload': {'type': 'message', 'client_id': 'c2'}})
+        self.assertEqual(await socket.receive_json_from(), {
+            'stream': 'chat',
+            'payload': {'ack': {'client_id': 'c2', 'error': 'A valid conversation id is required.'}},
+        })
+
+        await self.send_chat_message('hello')
+        self.assertEqual(await socket.receive_json_from(), {
+            'stream': 'chat',
+            'payload': {'message': {'conversation_id': 1, 'data': 'hello'}},
+        })
+
+        await socket.send_json_to({'stream': 'chat', 'close': True})
+        await socket.send_json_to({'stream': 'unknown', 'open': True})
+        self.assertTrue(await socket.receive_nothing())
+        await self.send_chat_message('there')
+        self.assertTrue(await socket.receive_nothing())
+        await socket.disconnect()
+
+    async def test_socket_without_a_valid_token_is_closed(self):
+        socket = WebsocketCommunicator(application, '/ws/', headers=[(b'cookie', b'access=invalid')])
+
+        connected, _ = await socket.connect()
+
+        self.assertFalse(connected)
+
+
+class ConcurrentFlushTests(ChatSocketTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = Player.objects.create(username='bob')
+        self.conversation = Conversations.objects.create(player1=self.player, player2=self.other)
+        self.addCleanup(cache.delete, message_buffer._client_id_key(self.player.id, 'c1'))
+
+    async def flush(self, reply_channel):
+        # Flushes started by different sockets write from threads of their own
+        async with ThreadSensitiveContext():
+            message_buffer.pending_messages.append({
+                'sender': self.player,
+                'conversation_id': self.conversation.pk,
+                'client_id': 'c1',
+                'content': 'hello',
+                'reply_channel': reply_channel,
+            })
+            await message_buffer.flush_messages()
+
+    async def flush_twice(self):
+        channel_layer = get_channel_layer()
+        reply_channels = [await channel_layer.new_channel() for _ in range(2)]
+        await asyncio.gather(*(self.flush(reply_channel) for reply_channel in reply_channels))
+        return [(await channel_layer.receive(reply_channel))['ack'] for reply_channel in reply_channels]
+
+    def test_message_resent_during_a_flush_is_written_once(self):
+        # Run outside of async_to_sync, which would write from the test thread only
+        acks = asyncio.run(self.flush_twice())
+
+        self.assertEqual(Messages.objects.count(), 1)
+        self.assertEqual(acks[0], acks[1])
+
+
+@override_settings(CHAT_MESSAGE_BATCH_SIZE=1)
+class SocketChatMessageTests(ChatSocketTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = Player.objects.create(username='bob')
+        self.conversation = Conversations.objects.create(player1=self.player, player2=self.other)
+        self.addCleanup(cache.delete, message_buffer._client_id_key(self.player.id, 'c1'))
+
+    async def test_message_is_acked_and_delivered(self):
+        sender = connect_socket(self.player, '/ws/chat/')
+        receiver = connect_socket(self.other, '/ws/')
+        await sender.connect()
+        await receiver.connect()
+        await receiver.send_json_to({'stream': 'chat', 'open': True})
+        self.assertTrue(await receiver.receive_nothing())
+
+        await sender.send_json_to({
+            'type': 'message',
+            'conversation_id': self.conversation.pk,
+            'client_id': 'c1',
+            'content': 'hello <b>bob</b>',
+        })
+
+        ack = (await sender.receive_json_from(timeout=2))['ack']
+        self.assertEqual(ack['client_id'], 'c1')
+        self.assertEqual(ack['message']['sender'], 'alice')
+        self.assertEqual(ack['message']['content'], 'hello &lt;b&gt;bob&lt;/b&gt;')
+        delivery = await receiver.receive_json_from(timeout=2)
+        self.assertEqual(delivery['payload']['message'], {
+            'conversation_id': self.conversation.pk,
+            'data': ack['message'],
+        })
+
+        message = await Messages.objects.select_related('sender').aget()
+        self.assertEqual((message.sender, message.content), (self.player, 'hello &lt;b&gt;bob&lt;/b&gt;'))
+        await sender.disconnect()
+        await receiver.disconnect()
+
+
+@override_settings(WEBSOCKET_PING_INTERVAL=0, WEBSOCKET_IDLE_TIMEOUT=0)
+class SocketKeepaliveTests(ChatSocketTestCase):
+    async def test_legacy_sockets_are_pinged_but_not_reaped(self):
+        legacy = connect_socket(self.player, '/ws/chat/')
+        multiplexed = connect_socket(self.player, '/ws/')
+        await legacy.connect()
+        await multiplexed.connect()
+
+        self.assertEqual(await keepalive.reap_idle_connections(), 1)
+
+        self.assertEqual(await legacy.receive_json_from(), {'ack': {}})
+        self.assertEqual(await multiplexed.receive_output(), {'type': 'websocket.close', 'code': 4408})
+        await legacy.disconnect()
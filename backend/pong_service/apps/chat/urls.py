@@ -70,6 +70,9 @@ urlpatterns = [
     path('conversations/<int:conversation_id>/messages/<int:pk>', message_detail, name='message_detail'),
     path('conversations/<int:conversation_id>/messages/<int:pk>/mark_as_read/',
          message_mark_as_read, name='message_mark_as_read'),
+    path('messages/search', MessageSearchView.as_view(), name='message_search'),
+    path('conversations/<int:conversation_id>/read',
+         ConversationReadView.as_view(), name='conversation_read'),
     path('conversations/<int:conversation_id>/clear',
          ConversationClearView.as_view(), name='conversation_clear'),
     path('conversations/<int:conversation_id>/delete',
@@ -6,12 +6,17 @@ from rest_framework import viewsets, status, generics
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from .permissions import IsParticipantInConversation
+from .pagination import MessageCursorPagination, MessageSearchPagination
 from rest_framework import serializers
 from django.shortcuts import get_object_or_404
 from rest_framework.decorators import action
 from django.http import Http404
 from .consumers import send_message
 from .consumers import NotificationConsumer
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from pong_service.apps.chat import presence, social_graph
 
 # Create your views here.
 
@@ -40,7 +45,32 @@ class ConversationViewSet(viewsets.ModelViewSet):
         """
         user = self.request.user
         return Conversations.objects.filter(models.Q(player1=user, IsVisibleToPlayer1=True) |
-                                            models.Q(player2=user, IsVisibleToPlayer2=True)).order_by('-lastMessageTimeStamp')
+                                            models.Q(player2=user, IsVisibleToPlayer2=True)) \
+            .select_related('player1', 'player2', 'lastMessage') \
+            .order_by('-lastMessageTimeStamp')
+
+    def get_serializer_context(self):
+        """
+        Add the friend ids of the current user to the serializer context, so the
+        nested player serializers don't run one friendship query per conversation.
+        """
+        context = super().get_serializer_context()
+        if self.request.user.is_authenticated:
+            context['friend_ids'] = social_graph.get_friend_ids(self.request.user)
+        return context
+
+    def get_serializer(self, *args, **kwargs):
+        """
+        Add the online ids among the players of the serialized conversations to the
+        serializer context, looked up in one round trip.
+        """
+        if args:
+            conversations = args[0] if kwargs.get('many') else [args[0]]
+            kwargs['context'] = self.get_serializer_context()
+            kwargs['context']['online_ids'] = presence.online_ids_among(
+                player_id for conversation in conversations
+                for player_id in (conversation.player1_id, conversation.player2_id) if player_id is not None)
+        return super().get_serializer(*args, **kwargs)
 
     def get_object(self):
         """
@@ -86,29 +116,33 @@ class ConversationViewSet(viewsets.ModelViewSet):
                 'Player with the provided username does not exist.')
 
         # Check if the user has blocked the other player or vice versa
-        if BlockedUsers.objects.filter(Q(player=user, blockedUser=player2) | Q(player=player2, blockedUser=user)).exists():
+        if social_graph.is_blocked_between(user, player2):
             raise serializers.ValidationError(
                 'You cannot start a conversation with this player.')
 
         # Check if a conversation already exists between these two players
-        existing_conversation = Conversations.objects.filter(
-            models.Q(player1=user, player2=player2) |
-            models.Q(player1=player2, player2=user)
-        ).first()
-
-        if existing_conversation:
-            # If conversation exists, update its visibility
-            if user == existing_conversation.player1:
-                existing_conversation.IsVisibleToPlayer1 = True
-            elif user == existing_conversation.player2:
-                existing_conversation.IsVisibleToPlayer2 = True
-            existing_conversation.save()
-
-            # Update the serializer instance with the existing conversation
-            serializer.instance = existing_conversation
-        else:
+        existing_conversation = Conversations.objects.between(user, player2).first()
+
+        if not existing_conversation:
             # Create the new conversation if it doesn't exist
-            serializer.save(player1=user, player2=player2)
+            try:
+                with transaction.atomic():
+                    serializer.save(player1=user, player2=player2)
+                return
+            except IntegrityError:
+                # A concurrent request created it first, reopen that one
+                existing_conversation = Conversations.objects.between(user, player2).get()
+
+        # If conversation exists, update its visibility
+        if user == existing_conversation.player1:
+            existing_conversation.IsVisibleToPlayer1 = True
+        elif user == existing_conversation.player2:
+            existing_conversation.IsVisibleToPlayer2 = True
+        existing_conversation.save(
+            update_fields=['IsVisibleToPlayer1', 'IsVisibleToPlayer2'])
+
+        # Update the serializer instance with the existing conversation
+        serializer.instance = existing_conversation
 
 
 class MessageViewSet(viewsets.ModelViewSet):
@@ -116,22 +150,27 @@ class MessageViewSet(viewsets.ModelViewSet):
     API view for listing and creating messages in a conversation.
 
     This API view provides the following actions:
-    - list: Get a list of messages in a conversation.
+    - list: Get a page of messages in a conversation, newest first. Older pages are
+      reached through the `next` cursor; `?since=<messageID>` returns only the messages
+      newer than the given one, oldest first, for clients catching up after a reconnect.
     - create: Create a new message in a conversation.
 
     Only authenticated users who are participants in the conversation can perform these actions.
     """
     serializer_class = MessagesSerializer
     permission_classes = [IsAuthenticated, IsParticipantInConversation]
+    pagination_class = MessageCursorPagination
+    since_limit = MessageCursorPagination.max_page_size
 
     def get_queryset(self):
         """
         Returns the queryset of messages for a specific conversation.
 
         This method retrieves the user, conversation ID, and conversation object.
-        It checks the object permissions for the conversation and marks all unread
-        messages as read. Finally, it filters and returns the messages based on
-        the visibility criteria for the current user.
+        It checks the object permissions for the conversation, then filters and returns
+        the messages based on the visibility criteria for the current user. Reading
+        messages has no side effects: they are marked as read through the `read`
+        endpoint or the chat websocket.
 
         Returns:
             QuerySet: The queryset of messages for the conversation.
@@ -142,22 +181,34 @@ class MessageViewSet(viewsets.ModelViewSet):
         conversation = get_object_or_404(Conversations, pk=conversation_id)
 
         self.check_object_permissions(self.request, conversation)
-        # Mark all unread messages as read
-        MessageReadStatus.objects.filter(
-            atMessage__atConversation=conversation,
-            receiver=user,
-            IsRead=False
-        ).delete()
 
         # Check if the conversation is visible to the user
         if (user == conversation.player1 and not conversation.IsVisibleToPlayer1) or \
                 (user == conversation.player2 and not conversation.IsVisibleToPlayer2):
             raise Http404("Conversation not found or has been deleted.")
 
-        if user == conversation.player1:
-            return Messages.objects.filter(atConversation=conversation, IsVisibleToPlayer1=True)
-        else:
-            return Messages.objects.filter(atConversation=conversation, IsVisibleToPlayer2=True)
+        # Hide the messages the user has cleared
+        return conversation.visible_messages(user.id).select_related('sender')
+
+    def list(self, request, *args, **kwargs):
+        """
+        List the messages of the conversation, either as a cursor page or as the
+        messages newer than `since` when that parameter is given.
+        """
+        since = request.query_params.get('since')
+        if since is None:
+            return super().list(request, *args, **kwargs)
+
+        try:
+            since = int(since)
+        except ValueError:
+            raise serializers.ValidationError({'since': 'A valid message id is required.'})
+
+        messages = list(self.get_queryset().filter(messageID__gt=since)
+                        .order_by('messageID')[:self.since_limit + 1])
+        has_more = len(messages) > self.since_limit
+        serializer = self.get_serializer(messages[:self.since_limit], many=True)
+        return Response({'results': serializer.data, 'has_more': has_more})
 
     def perform_create(self, serializer):
         """
@@ -183,45 +234,128 @@ class MessageViewSet(viewsets.ModelViewSet):
             raise serializers.ValidationError(
                 'You cannot send a message to this conversation.')
 
-        serializer.save(sender=user,
-                        atConversation=conversation)
+        receiver = conversation.player1 if user == conversation.player2 else conversation.player2
+        unread_count_field = conversation.unread_count_field(receiver.id)
+
+        with transaction.atomic():
+            serializer.save(sender=user,
+                            atConversation=conversation)
+
+            # Update last message
+            conversation.lastMessage = serializer.instance
 
-        # Update last message
-        conversation.lastMessage = serializer.instance
+            # Check if the other player's visibility needs to be reset
+            if user == conversation.player1 and not conversation.IsVisibleToPlayer2:
+                conversation.IsVisibleToPlayer2 = True
+            elif user == conversation.player2 and not conversation.IsVisibleToPlayer1:
+                conversation.IsVisibleToPlayer1 = True
 
-        # Check if the other player's visibility needs to be reset
-        if user == conversation.player1 and not conversation.IsVisibleToPlayer2:
-            conversation.IsVisibleToPlayer2 = True
-        elif user == conversation.player2 and not conversation.IsVisibleToPlayer1:
-            conversation.IsVisibleToPlayer1 = True
+            conversation.save(update_fields=['lastMessage', 'IsVisibleToPlayer1',
+                                             'IsVisibleToPlayer2', 'lastMessageTimeStamp'])
 
-        conversation.save()
+            # The message stays unread for the other player until their watermark passes it
+            Conversations.objects.filter(pk=conversation.pk).update(
+                **{unread_count_field: F(unread_count_field) + 1})
 
-        # Mark the message as unread for the other player
-        MessageReadStatus.objects.create(
-            atMessage=serializer.instance, receiver=conversation.player1 if user == conversation.player2 else conversation.player2)
-        # send message to the other player via websocket
-        send_message(conversation.player1.id if user ==
-                     conversation.player2 else conversation.player2.id, conversation.conversationID, serializer.data)
+            # send message to the other player via websocket once the message is committed
+            send_message(receiver.id, conversation.conversationID, serializer.data)
 
     @action(detail=True, methods=['patch'], url_path='mark_as_read')
     def mark_as_read(self, request, conversation_id, pk=None):
         message = self.get_object()
         user = request.user
 
-        # delete the message read status for the user
-        MessageReadStatus.objects.filter(
-            atMessage=message, receiver=user).delete()
+        # move the user's read watermark up to this message
+        message.atConversation.mark_as_read_up_to(user.id, message.messageID)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class MessageSearchView(generics.ListAPIView):
+    """
+    API view for searching the messages of the authenticated user.
+
+    This API view provides the following action:
+    - get: List the messages matching the `q` query parameter, best match first.
+
+    Only messages of conversations the user has not deleted, and that the user has not
+    cleared, are searched. Pass `conversation_id` to search a single conversation.
+    """
+    serializer_class = MessagesSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = MessageSearchPagination
+
+    def get_queryset(self):
+        """
+        Returns the messages matching the search query, ranked by relevance.
+
+        The match is done on the message_search_idx GIN index, the visibility
+        filters only apply to the matching rows.
+
+        Returns:
+            QuerySet: The ranked queryset of matching messages.
+        """
+        user = self.request.user
+        text = self.request.query_params.get('q', '').strip()
+        if not text:
+            raise serializers.ValidationError({'q': 'A search query is required.'})
+
+        query = SearchQuery(text, config=MESSAGE_SEARCH_CONFIG, search_type='websearch')
+        vector = message_search_vector()
+        messages = Messages.objects.annotate(search=vector).filter(search=query).filter(
+            Q(atConversation__player1=user, atConversation__IsVisibleToPlayer1=True,
+              messageID__gt=F('atConversation__clearedBeforePlayer1')) |
+            Q(atConversation__player2=user, atConversation__IsVisibleToPlayer2=True,
+              messageID__gt=F('atConversation__clearedBeforePlayer2'))
+        )
+
+        conversation_id = self.request.query_params.get('conversation_id')
+        if conversation_id is not None:
+            try:
+                messages = messages.filter(atConversation=int(conversation_id))
+            except ValueError:
+                raise serializers.ValidationError({'conversation_id': 'A valid conversation id is required.'})
+
+        return messages.annotate(rank=SearchRank(vector, query)) \
+            .select_related('sender').order_by('-rank', '-messageID')
+
+
+class ConversationReadView(APIView):
+    """
+    API view for marking the messages of a conversation as read.
+
+    This API view provides the following action:
+    - post: Move the authenticated user's read watermark up to `message_id`,
+      or to the last message of the conversation when it is omitted.
+
+    Only authenticated users who are participants in the conversation can perform this action.
+    """
+    permission_classes = [IsAuthenticated, IsParticipantInConversation]
+
+    def post(self, request, conversation_id):
+        conversation = get_object_or_404(Conversations, pk=conversation_id)
+        user = request.user
+
+        self.check_object_permissions(request, conversation)
+        message_id = request.data.get('message_id')
+        if message_id is None:
+            conversation.mark_as_read(user.id)
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        try:
+            message_id = int(message_id)
+        except (TypeError, ValueError):
+            raise serializers.ValidationError({'message_id': 'A valid message id is required.'})
+        conversation.mark_as_read_up_to(user.id, message_id)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
 class ConversationClearView(APIView):
     """
     API view for clearing a conversation.
 
     This API view provides the following action:
-    - post: Clear a conversation by marking all messages as not visible to the authenticated user.
+    - post: Clear a conversation by moving the authenticated user's clear watermark up to its last message.
 
     Only authenticated users who are participants in the conversation can perform this action.
     """
@@ -232,16 +366,10 @@ class ConversationClearView(APIView):
         user = request.user
 
         self.check_object_permissions(request, conversation)
-        if user == conversation.player1:
-            Messages.objects.filter(atConversation=conversation).update(
-                IsVisibleToPlayer1=False)
-        else:
-            Messages.objects.filter(atConversation=conversation).update(
-                IsVisibleToPlayer2=False)
 
-        # Delete all messages that are not visible to both players
-        Messages.objects.filter(atConversation=conversation,
-                                IsVisibleToPlayer1=False, IsVisibleToPlayer2=False).delete()
+        # Hide the messages from the user and mark them as read, they are deleted
+        # by compact_conversations once both players have cleared them
+        conversation.clear_for(user.id)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -264,19 +392,16 @@ class ConversationDeleteView(APIView):
         self.check_object_permissions(request, conversation)
         if user == conversation.player1:
             conversation.IsVisibleToPlayer1 = False
-            Messages.objects.filter(atConversation=conversation).update(
-                IsVisibleToPlayer1=False)
         else:
-            Messages.objects.filter(atConversation=conversation).update(
-                IsVisibleToPlayer2=False)
             conversation.IsVisibleToPlayer2 = False
 
-        conversation.save(
-            update_fields=['IsVisibleToPlayer1', 'IsVisibleToPlayer2'])
+        with transaction.atomic():
+            conversation.save(
+                update_fields=['IsVisibleToPlayer1', 'IsVisibleToPlayer2'])
 
-        # If the conversation is not visible to both players, delete it
-        if not conversation.IsVisibleToPlayer1 and not conversation.IsVisibleToPlayer2:
-            conversation.delete()
+            # Hide the messages from the user, the conversation is deleted by
+            # compact_conversations once it is not visible to both players
+            conversation.clear_for(user.id)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -307,6 +432,29 @@ class FriendshipViewSet(viewsets.ModelViewSet):
         user = self.request.user
         return Friendship.objects.filter(models.Q(player1=user) | models.Q(player2=user))
 
+    def get_serializer_context(self):
+        """
+        Add the friend ids to the serializer context, so the nested player
+        serializers don't look them up for each player on their own.
+        """
+        context = super().get_serializer_context()
+        if self.request.user.is_authenticated:
+            context['friend_ids'] = social_graph.get_friend_ids(self.request.user)
+        return context
+
+    def get_serializer(self, *args, **kwargs):
+        """
+        Add the online ids among the players of the serialized friendships to the
+        serializer context, looked up in one round trip.
+        """
+        if args:
+            friendships = args[0] if kwargs.get('many') else [args[0]]
+            kwargs['context'] = self.get_serializer_context()
+            kwargs['context']['online_ids'] = presence.online_ids_among(
+                player_id for friendship in friendships
+                for player_id in (friendship.player1_id, friendship.player2_id))
+        return super().get_serializer(*args, **kwargs)
+
     def perform_create(self, serializer):
         """
         Perform creation of a new friendship request.
@@ -338,20 +486,21 @@ class FriendshipViewSet(viewsets.ModelViewSet):
                 'A pending friendship request already exists.')
 
         # Prevent duplicate friendships
-        if Friendship.objects.filter(models.Q(player1=user, player2=player2) | models.Q(player1=player2, player2=user)).exists():
+        if Friendship.objects.between(user, player2).exists():
             raise serializers.ValidationError(
                 'A friendship already exists between these players.')
 
         # Prevent sending a friend request to a blocked user or from a blocked user
-        if BlockedUsers.objects.filter(Q(player=user, blockedUser=player2) | Q(player=player2, blockedUser=user)).exists():
+        if social_graph.is_blocked_between(user, player2):
             raise serializers.ValidationError(
                 f'You are blocked or have blocked {player2_username}.')
 
-        # Create a new friendship request
-        serializer.save(player1=user, player2=player2)
+        with transaction.atomic():
+            # Create a new friendship request
+            serializer.save(player1=user, player2=player2)
 
-        # Send a notification to the other player
-        NotificationConsumer.sendFriendRequestNotification(user.id, player2.id)
+            # Send a notification to the other player
+            NotificationConsumer.sendFriendRequestNotification(user.id, player2.id)
 
     @action(detail=True, methods=['patch'], url_path='accept')
     def accept_friendship(self, request, pk=None):
@@ -439,18 +588,17 @@ class BlockedUsersViewSet(viewsets.ModelViewSet):
                 'User is already blocked.')
 
         # Remove any existing friendships between the users
-        Friendship.objects.filter(models.Q(player1=user, player2=blocked_user) |
-                                  models.Q(player1=blocked_user, player2=user)).delete()
+        Friendship.objects.between(user, blocked_user).delete()
 
         # Block the conversation between the users by setting IsBlockedByPlayer1 or IsBlockedByPlayer2 to True
-        conversation = Conversations.objects.filter(models.Q(player1=user, player2=blocked_user) |
-                                                    models.Q(player1=blocked_user, player2=user)).first()
+        conversation = Conversations.objects.between(user, blocked_user).first()
         if conversation:
             if user == conversation.player1:
                 conversation.IsBlockedByPlayer1 = True
             else:
                 conversation.IsBlockedByPlayer2 = True
-            conversation.save()
+            conversation.save(
+                update_fields=['IsBlockedByPlayer1', 'IsBlockedByPlayer2'])
 
         BlockedUsers.objects.create(player=user, blockedUser=blocked_user)
         return Response(status=status.HTTP_204_NO_CONTENT)
@@ -476,14 +624,14 @@ class BlockedUsersViewSet(viewsets.ModelViewSet):
             blocked_user.delete()
 
             # Unblock the conversation between the users by setting IsBlockedByPlayer1 or IsBlockedByPlayer2 to False
-            conversation = Conversations.objects.filter(models.Q(player1=user, player2=blocked_user.blockedUser) |
-                                                        models.Q(player1=blocked_user.blockedUser, player2=user)).first()
+            conversation = Conversations.objects.between(user, blocked_user.blockedUser_id).first()
             if conversation:
                 if user == conversation.player1:
                     conversation.IsBlockedByPlayer1 = False
                 else:
                     conversation.IsBlockedByPlayer2 = False
-                conversation.save()
+                conversation.save(
+                    update_fields=['IsBlockedByPlayer1', 'IsBlockedByPlayer2'])
 
             return Response(status=status.HTTP_204_NO_CONTENT)
         raise serializers.ValidationError('User is not blocked.')
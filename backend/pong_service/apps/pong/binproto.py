@@ -2,10 +2,13 @@ import struct
 
 
 class BinaryProtocol:
+    # ball x, ball y, paddle 1 y, paddle 2 y, score 1, score 2, server tick of the snapshot
+    GAME_STATE_FORMAT = '!ffffIII'
+
     @staticmethod
-    def encode_game_state(ball_x, ball_y, pad1_y, pad2_y, score1, score2):
-        return struct.pack('!ffffII', ball_x, ball_y, pad1_y, pad2_y, score1, score2)
+    def encode_game_state(ball_x, ball_y, pad1_y, pad2_y, score1, score2, tick):
+        return struct.pack(BinaryProtocol.GAME_STATE_FORMAT, ball_x, ball_y, pad1_y, pad2_y, score1, score2, tick)
 
     @staticmethod
     def decode_game_state(data):
-        return struct.unpack('!ffffII', data)
+        return struct.unpack(BinaryProtocol.GAME_STATE_FORMAT, data)
@@ -0,0 +1,84 @@
+import json
+import logging
+import uuid
+from django.conf import settings
+from redis import RedisError
+from pong_service.apps.pong.game_logic import PongGame
+from pong_service.helpers import SocketUser, get_redis_client
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Players who left a running game of this process: those back within the
+# reconnect grace window, and those who forfeited it
+reconnect_metrics = {'disconnects': 0, 'reconnects': 0, 'forfeits': 0}
+
+
+def reconnect_success_rate():
+    """
+    Share of the players who left a running game and came back in time.
+
+    Returns:
+        float | None: The rate, or None if no grace window has ended yet.
+    """
+    ended = reconnect_metrics['reconnects'] + reconnect_metrics['forfeits']
+    return reconnect_metrics['reconnects'] / ended if ended else None
+
+
+def _checkpoint_key(game_id):
+    return f'pong:checkpoint:{game_id}'
+
+
+def save(game_id, game, players):
+    """
+    Store a paused game in Redis, when GAME_CHECKPOINT_REDIS is enabled, for as
+    long as its players may reconnect. The game is kept in memory either way,
+    Redis only lets it be resumed after the process serving it restarted.
+
+    Args:
+        game_id (str): The game.
+        game (PongGame): Its state.
+        players (tuple): The (player1, player2) dicts of the id, username and avatar
+            of its players, shown to them when they are back.
+    """
+    if not settings.GAME_CHECKPOINT_REDIS:
+        return
+    checkpoint = game.to_checkpoint()
+    checkpoint['players'] = [{**player, 'id': str(player['id'])} for player in players]
+    try:
+        get_redis_client().set(_checkpoint_key(game_id), json.dumps(checkpoint),
+                               ex=settings.GAME_RECONNECT_GRACE)
+    except RedisError as e:
+        logger.error(f'Failed to checkpoint game {game_id}: {e}')
+
+
+def load(game_id):
+    """
+    Restore a game from its checkpoint in Redis, without querying the database.
+
+    Returns:
+        tuple | None: The game and the (player1, player2) dicts of its players, or
+            None if it has no checkpoint.
+    """
+    if not settings.GAME_CHECKPOINT_REDIS:
+        return None
+    try:
+        checkpoint = get_redis_client().get(_checkpoint_key(game_id))
+    except RedisError as e:
+        logger.error(f'Failed to load the checkpoint of game {game_id}: {e}')
+        return None
+    if checkpoint is None:
+        return None
+    checkpoint = json.loads(checkpoint)
+    players = tuple({**player, 'id': uuid.UUID(player['id'])} for player in checkpoint['players'])
+    player1, player2 = (SocketUser(player['id'], player['username']) for player in players)
+    return PongGame.from_checkpoint(checkpoint, player1, player2), players
+
+
+def delete(game_id):
+    if not settings.GAME_CHECKPOINT_REDIS:
+        return
+    try:
+        get_redis_client().delete(_checkpoint_key(game_id))
+    except RedisError as e:
+        logger.error(f'Failed to delete the checkpoint of game {game_id}: {e}')
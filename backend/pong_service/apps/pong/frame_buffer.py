@@ -0,0 +1,87 @@
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# match id -> frame counters of the game sockets of the match served by this process:
+# sent and coalesced state frames, state frames dropped unsent, and open connections
+match_frame_metrics = {}
+
+
+class FrameBuffer:
+    """
+    Outgoing frames of a game socket, written by a task of its own so the
+    channel layer handlers of the consumer return at once and its queue in the
+    channel layer does not grow behind a slow client.
+
+    Delivery is latest-state-wins: a state frame waiting to be written is replaced
+    by the next one, as it is superseded anyway. Control messages, like game_over,
+    are never replaced and are written in order with the state frames.
+    """
+
+    def __init__(self, consumer, match_id):
+        self.consumer = consumer
+        self.match_id = match_id
+        self.metrics = match_frame_metrics.setdefault(
+            match_id, {'sent': 0, 'coalesced': 0, 'dropped': 0, 'connections': 0})
+        self.metrics['connections'] += 1
+        # (is_state, send kwargs) of the frames waiting to be written
+        self.frames = deque()
+        self.writer = None
+        self.closed = False
+
+    def push_state(self, bytes_data):
+        if self.closed:
+            self.metrics['dropped'] += 1
+            return
+        if self.frames and self.frames[-1][0]:
+            self.frames[-1] = (True, {'bytes_data': bytes_data})
+            self.metrics['coalesced'] += 1
+        else:
+            self.frames.append((True, {'bytes_data': bytes_data}))
+        self._wake_writer()
+
+    def push_control(self, text_data):
+        if self.closed:
+            return
+        self.frames.append((False, {'text_data': text_data}))
+        self._wake_writer()
+
+    def _wake_writer(self):
+        # the writer only runs while frames are waiting, idle sockets have no task
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.get_running_loop().create_task(self._write())
+
+    async def _write(self):
+        while self.frames:
+            is_state, frame = self.frames.popleft()
+            try:
+                await self.consumer.send(**frame)
+            except Exception as e:
+                logger.error(f'Failed to send a frame of match {self.match_id}: {e}')
+                self.close()
+                return
+            if is_state:
+                self.metrics['sent'] += 1
+
+    def close(self):
+        """
+        Drop the frames still waiting, and log the counters of the match once its
+        last connection is closed.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.metrics['dropped'] += sum(1 for is_state, _ in self.frames if is_state)
+        self.frames.clear()
+        if self.writer is not None and self.writer is not asyncio.current_task():
+            self.writer.cancel()
+
+        self.metrics['connections'] -= 1
+        if self.metrics['connections'] == 0:
+            match_frame_metrics.pop(self.match_id, None)
+            logger.info(
+                f"Match {self.match_id}: {self.metrics['sent']} state frames sent, "
+                f"{self.metrics['coalesced']} coalesced, {self.metrics['dropped']} dropped")
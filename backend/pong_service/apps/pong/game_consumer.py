@@ -1,30 +1,47 @@
 import json
+import logging
 import struct
 import asyncio
 import time
+from collections import Counter
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from pong_service.apps.pong.binproto import BinaryProtocol
 from pong_service.apps.pong.game_logic import PongGame
-from asgiref.sync import sync_to_async
 from channels.db import database_sync_to_async
-from jwt import decode as jwt_decode
+from django.conf import settings
 from django.db import transaction
+from pong_service import keepalive
+from pong_service.apps.pong import checkpoint
+from pong_service.apps.pong.frame_buffer import FrameBuffer
+from pong_service.helpers import get_socket_user_from_access_token
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Seconds the simulation may fall behind before the missed ticks are skipped
+MAX_SIMULATION_LAG = 0.25
 
 
 class PongConsumer(AsyncWebsocketConsumer):
     games = {}
     game_loops = {}
+    # game id -> event set while the game runs, cleared while it is paused
+    game_clocks = {}
+    # game id -> sockets of each player connected to the game
+    connected_players = {}
+    # game id -> (player1, player2) usernames and avatars, kept for reconnects
+    game_players = {}
+    # (game id, player id) -> forfeit of a disconnected player, run after the grace window
+    forfeit_timers = {}
 
     async def connect(self):
-        self.cookies = self.scope['cookies']
         self.game_id = self.scope['url_route']['kwargs']['game_id']
         self.room_name = f'pong_{self.game_id}'
-        access = self.cookies.get('access')
-
-        if not access:
-            self.player = None
-        else:
-            self.player = await self.get_user_from_access_token(self.cookies.get('access'))
+        # Only the player's id and username are kept for the lifetime of the socket
+        self.player = await get_socket_user_from_access_token(self.scope['cookies'].get(settings.AUTH_COOKIE))
+        self.scope.pop('cookies', None)
+        self.scope.pop('headers', None)
 
         if not self.player:
             await self.close()
@@ -35,49 +52,176 @@ class PongConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         await self.accept()
+        keepalive.track(self)
+        self.frames = FrameBuffer(self, self.game_id)
+        self.connected_players.setdefault(self.game_id, Counter())[self.player.id] += 1
 
+        if await self.resume_game():
+            return
         await self.check_if_game_ready()
 
     async def disconnect(self, close_code):
+        keepalive.untrack(self)
         if not self.player:
             return
+        self.frames.close()
+        await self.channel_layer.group_discard(
+            self.room_name,
+            self.channel_name
+        )
 
-        if self.game_id in self.games:
-            game = self.games[self.game_id]
-
-            # Check if the game has already ended
-            if game.get_winner() is not None:
-                # Game has already ended, so we don't need to do anything
-                return
+        connected = self.connected_players.get(self.game_id, Counter())
+        connected[self.player.id] -= 1
+        if connected[self.player.id] > 0:
+            # the player is still connected from another socket
+            return
+        del connected[self.player.id]
+
+        game = self.games.get(self.game_id)
+        if game is not None and game.get_winner() is None and self.game_id in self.game_loops \
+                and self.player.id in game.scores:
+            # A running game is paused for the player to come back, it is only
+            # forfeited once the grace window is over
+            await self.pause_game(game)
+            return
+        self.release_game()
+
+    def release_game(self):
+        """
+        Forget a game nobody is connected to anymore, unless it is paused for
+        a player to come back.
+        """
+        if self.connected_players.get(self.game_id) or \
+                any(game_id == self.game_id for game_id, _ in self.forfeit_timers):
+            return
+        for games in (self.connected_players, self.game_clocks, self.game_players, self.games):
+            games.pop(self.game_id, None)
+        if self.game_id in self.game_loops:
+            self.game_loops.pop(self.game_id).cancel()
+
+    async def pause_game(self, game):
+        checkpoint.reconnect_metrics['disconnects'] += 1
+        self.game_clocks[self.game_id].clear()
+        if self.game_id not in self.game_players:
+            self.game_players[self.game_id] = await self.get_game_players()
+        await sync_to_async(checkpoint.save)(self.game_id, game, self.game_players[self.game_id])
+        await self.channel_layer.group_send(
+            self.room_name,
+            {
+                'type': 'game_paused',
+                'player': self.player.username
+            }
+        )
+        self.forfeit_timers[(self.game_id, self.player.id)] = asyncio.create_task(
+            self.forfeit_after_grace(game, self.player.id))
+
+    async def resume_game(self):
+        """
+        Bring a player back into the game they left, from its checkpoint in memory,
+        or in Redis if the process serving it restarted. The game runs again once
+        both players are back.
+
+        Returns:
+            bool: True if the player is back in a paused game.
+        """
+        game = self.games.get(self.game_id)
+        forfeit_timer = self.forfeit_timers.pop((self.game_id, self.player.id), None)
+        if game is None:
+            restored = await sync_to_async(checkpoint.load)(self.game_id)
+            if restored is None or self.player.id not in restored[0].scores:
+                return False
+            game, players = restored
+            self.restore_game(game, players)
+        elif forfeit_timer is None:
+            return False
+        else:
+            forfeit_timer.cancel()
 
-            disconnected_player = self.player.id
-            winner = game.get_winner(disconnected_player=disconnected_player)
-            winner_username = winner.username if winner else None
+        checkpoint.reconnect_metrics['reconnects'] += 1
+        self.game = game
+        await self.send(text_data=json.dumps({
+            'status': 'player_info',
+            'data': await self.get_player_info()
+        }))
 
-            # Update game status and send game over message only for the first disconnection
-            await self.update_game_status(disconnected=True, winner=winner)
+        if not any(game_id == self.game_id for game_id, _ in self.forfeit_timers):
+            await sync_to_async(checkpoint.delete)(self.game_id)
+            self.game_clocks[self.game_id].set()
             await self.channel_layer.group_send(
                 self.room_name,
                 {
-                    'type': 'game_over',
-                    'winner': winner_username,
-                    'reason': 'disconnection'
+                    'type': 'game_resumed'
                 }
             )
+        return True
+
+    def restore_game(self, game, players):
+        """
+        Run a game restored from Redis, paused until its players are back, each
+        of them forfeiting it if they are not back within the grace window.
+        """
+        self.games[self.game_id] = game
+        self.game_players[self.game_id] = players
+        self.game_clocks[self.game_id] = asyncio.Event()
+        self.game = game
+        for player in (game.player1, game.player2):
+            if player.id != self.player.id:
+                self.forfeit_timers[(self.game_id, player.id)] = asyncio.create_task(
+                    self.forfeit_after_grace(game, player.id))
+        self.game_loops[self.game_id] = asyncio.create_task(self.game_loop())
+
+    async def forfeit_after_grace(self, game, player_id):
+        await asyncio.sleep(settings.GAME_RECONNECT_GRACE)
+        self.forfeit_timers.pop((self.game_id, player_id), None)
+        checkpoint.reconnect_metrics['forfeits'] += 1
+        rate = checkpoint.reconnect_success_rate()
+        logger.info(f'Player {player_id} forfeited game {self.game_id}, reconnect success rate {rate:.0%}')
+        await self.forfeit(game, player_id)
+
+    async def forfeit(self, game, player_id):
+        self.game = game
+        winner = game.get_winner(disconnected_player=player_id)
+
+        # Update game status and send game over message only for the first forfeit
+        await self.update_game_status(disconnected=True, winner=winner)
+        await self.send_game_over(winner, 'disconnection')
+
+        # Remove the game and the forfeit of its other player, if both left
+        self.games.pop(self.game_id, None)
+        for key in [key for key in self.forfeit_timers if key[0] == self.game_id]:
+            self.forfeit_timers.pop(key).cancel()
+        if self.game_id in self.game_loops:
+            self.game_loops.pop(self.game_id).cancel()
+        self.release_game()
+        await sync_to_async(checkpoint.delete)(self.game_id)
+
+    async def game_paused(self, event):
+        self.frames.push_control(json.dumps({
+            'status': 'game_paused',
+            'player': event['player'],
+            'grace': settings.GAME_RECONNECT_GRACE
+        }))
 
-            # Remove the game from the games dictionary
-            del self.games[self.game_id]
+    async def game_resumed(self, event):
+        self.frames.push_control(json.dumps({
+            'status': 'game_resumed'
+        }))
 
-        if self.game_id in self.game_loops:
-            self.game_loops[self.game_id].cancel()
-            del self.game_loops[self.game_id]
+    async def game_over(self, event):
+        self.frames.push_control(json.dumps({
+            'status': 'game_over',
+            'winner': event['winner'],
+            'reason': event.get('reason', 'normal')
+        }))
 
-        await self.channel_layer.group_discard(
-            self.room_name,
-            self.channel_name
-        )
+    async def send_game_over(self, winner, reason):
+        """
+        Announce the end of the game to its sockets.
 
-    async def send_game_over(self, winner=None, reason=None):
+        Args:
+            winner (Player | SocketUser | None): The winner, None if the game ended without one.
+            reason (str): 'normal' when a player won, or 'disconnection'.
+        """
         await self.channel_layer.group_send(
             self.room_name,
             {
@@ -87,35 +231,18 @@ class PongConsumer(AsyncWebsocketConsumer):
             }
         )
 
-    async def game_over(self, event):
-        await self.send(text_data=json.dumps({
-            'status': 'game_over',
-            'winner': event['winner'],
-            'reason': event.get('reason')
-        }))
-
     async def receive(self, text_data):
         if not self.player:
             return
+        keepalive.touch(self)
         if text_data in ['w', 's']:
             await self.update_paddle_position(text_data)
 
-    async def get_user_from_access_token(self, access_token):
-        from django.conf import settings
-        from pong_service.apps.authentication.models import Player
-        from jwt import InvalidTokenError
-        from rest_framework_simplejwt.exceptions import TokenError
-        try:
-            decoded_token = await sync_to_async(jwt_decode)(access_token, settings.SECRET_KEY, algorithms=['HS256'])
-            user_id = decoded_token.get('user_id')
-
-            if user_id is None:
-                return None
-
-            user = await sync_to_async(Player.objects.get)(id=user_id)
-            return user
-        except (TokenError, InvalidTokenError, Player.DoesNotExist):
-            return None
+    async def send_ping(self):
+        # answered by the client with "pong", which only keeps the socket alive
+        await self.send(text_data=json.dumps({
+            'status': 'ping'
+        }))
 
     async def check_if_game_ready(self):
         is_ready = await self.get_game_ready_status()
@@ -141,6 +268,8 @@ class PongConsumer(AsyncWebsocketConsumer):
 
         if self.game_id not in self.games:
             self.games[self.game_id] = PongGame(player1, player2)
+            self.game_clocks[self.game_id] = asyncio.Event()
+            self.game_clocks[self.game_id].set()
         self.game = self.games[self.game_id]
 
         if self.game_id not in self.game_loops:
@@ -148,61 +277,93 @@ class PongConsumer(AsyncWebsocketConsumer):
                 self.game_loop())
 
     async def game_loop(self):
+        """
+        Simulate the game in fixed steps at GAME_SIMULATION_RATE, and broadcast a
+        snapshot stamped with its tick every GAME_SNAPSHOT_RATE, so the clients
+        can interpolate between them. The simulation stops while the game is paused.
+        """
+        loop = asyncio.get_running_loop()
+        clock = self.game_clocks[self.game_id]
+        tick_interval = 1 / settings.GAME_SIMULATION_RATE
+        ticks_per_snapshot = max(1, round(settings.GAME_SIMULATION_RATE / settings.GAME_SNAPSHOT_RATE))
         try:
-            await self.send_game_state()
-            self.game.start_ball_movement()
+            if self.game.tick == 0:
+                await self.send_game_state(0)
+                self.game.start_ball_movement()
+            next_tick = self.game.last_update_time = loop.time()
             while True:
-                current_time = asyncio.get_event_loop().time()
-                game_over = self.game.update(current_time)
-                await self.send_game_state()
+                if not clock.is_set():
+                    # paused while a player is reconnecting
+                    await clock.wait()
+                    next_tick = self.game.last_update_time = loop.time()
+                self.game.tick += 1
+                tick = self.game.tick
+                next_tick += tick_interval
+                game_over = self.game.update(next_tick)
+                if game_over or tick % ticks_per_snapshot == 0:
+                    await self.send_game_state(tick)
                 if game_over:
                     # update game info in the database
-                    await self.update_game_status(winner=self.game.get_winner())
-                    await self.send_game_over()
+                    winner = self.game.get_winner()
+                    await self.update_game_status(winner=winner)
+                    await self.send_game_over(winner, 'normal')
                     break
-                await asyncio.sleep(1/60)
+                delay = next_tick - loop.time()
+                if delay < -MAX_SIMULATION_LAG:
+                    # too far behind to catch up, e.g. after a blocked loop: skip the missed ticks
+                    next_tick = loop.time()
+                await asyncio.sleep(max(0, delay))
         except asyncio.CancelledError:
             print("Game loop cancelled")
         finally:
             await self.update_game_status(disconnected=True)
-            await self.send_game_over()
+            # A won or forfeited game has already announced its winner
+            if self.games.get(self.game_id) is self.game and self.game.get_winner() is None:
+                await self.send_game_over(None, 'disconnection')
 
     async def game_start(self, event):
-        await self.send(text_data=json.dumps({
+        self.frames.push_control(json.dumps({
             'status': 'game_start',
             'game_id': event['game_id']
         }))
 
-    @database_sync_to_async
-    def get_player_info(self):
-        from pong_service.apps.pong.models import PongGame
-        from pong_service.apps.authentication.models import Player
-
-        game = PongGame.objects.get(id=self.game_id)
-        player1 = Player.objects.get(id=game.player1_id)
-        player2 = Player.objects.get(id=game.player2_id)
+    async def get_player_info(self):
+        # Kept for the game, so reconnecting players get it without a query
+        if self.game_id not in self.game_players:
+            self.game_players[self.game_id] = await self.get_game_players()
+        player1, player2 = self.game_players[self.game_id]
 
-        current_player = player1 if self.player == player1 else player2
-        opponent = player2 if self.player == player1 else player1
+        is_player1 = self.player.id == player1['id']
+        current_player, opponent = (player1, player2) if is_player1 else (player2, player1)
 
         return {
             "currentPlayer": {
-                "username": current_player.username,
-                "avatar": current_player.avatar_url,
-                "role": "player1" if current_player == player1 else "player2"
+                "username": current_player['username'],
+                "avatar": current_player['avatar'],
+                "role": "player1" if is_player1 else "player2"
             },
             "opponent": {
-                "username": opponent.username,
-                "avatar": opponent.avatar_url,
-                "role": "player2" if current_player == player1 else "player1"
+                "username": opponent['username'],
+                "avatar": opponent['avatar'],
+                "role": "player2" if is_player1 else "player1"
             }
         }
 
+    @database_sync_to_async
+    def get_game_players(self):
+        from pong_service.apps.pong.models import PongGame
+
+        game = PongGame.objects.select_related('player1', 'player2').get(id=self.game_id)
+        return tuple(
+            {'id': player.id, 'username': player.username, 'avatar': player.avatar_url}
+            for player in (game.player1, game.player2)
+        )
+
     @database_sync_to_async
     def get_game_ready_status(self):
         from pong_service.apps.pong.models import PongGame
         game = PongGame.objects.get(id=self.game_id)
-        self.player_role = 'player1' if game.player1 == self.player else 'player2'
+        self.player_role = 'player1' if game.player1_id == self.player.id else 'player2'
         self.player_username = self.player.username
         return bool(game.player1 and game.player2)
 
@@ -211,9 +372,9 @@ class PongConsumer(AsyncWebsocketConsumer):
         from pong_service.apps.pong.models import PongGame
         game, created = PongGame.objects.get_or_create(id=self.game_id)
         if created:
-            game.player1 = self.player
-        elif not game.player2 and game.player1 != self.player:
-            game.player2 = self.player
+            game.player1_id = self.player.id
+        elif not game.player2_id and game.player1_id != self.player.id:
+            game.player2_id = self.player.id
         game.save()
         return game
 
@@ -222,7 +383,7 @@ class PongConsumer(AsyncWebsocketConsumer):
         from pong_service.apps.authentication.models import Player
         return Player.objects.get(id=player_id)
 
-    async def send_game_state(self):
+    async def send_game_state(self, tick):
         state = self.game.get_state()
         game_state = BinaryProtocol.encode_game_state(
             state['ball_x'],
@@ -230,7 +391,8 @@ class PongConsumer(AsyncWebsocketConsumer):
             state['paddle1_y'],
             state['paddle2_y'],
             state['score1'],
-            state['score2']
+            state['score2'],
+            tick
         )
         await self.channel_layer.group_send(
             self.room_name,
@@ -241,28 +403,13 @@ class PongConsumer(AsyncWebsocketConsumer):
         )
 
     async def binary_game_state(self, event):
-        await self.send(bytes_data=event['game_state'])
+        # buffered latest-state-wins, a slow client gets the newest state instead of a backlog
+        self.frames.push_state(event['game_state'])
 
     async def update_paddle_position(self, key):
         direction = 'up' if key == 'w' else 'down'
         self.game.move_paddle(self.player.id, direction)
 
-    async def send_game_over(self):
-        winner = self.game.get_winner()
-        await self.channel_layer.group_send(
-            self.room_name,
-            {
-                'type': 'game_over',
-                'winner': self.game.player1.username if winner == self.game.player1 else self.game.player2.username
-            }
-        )
-
-    async def game_over(self, event):
-        await self.send(text_data=json.dumps({
-            'status': 'game_over',
-            'winner': event['winner']
-        }))
-
     async def end_game(self):
         try:
             # Update the game status in the database
@@ -294,10 +441,11 @@ class PongConsumer(AsyncWebsocketConsumer):
             game.player1_score = self.game.scores[self.game.player1.id]
             game.player2_score = self.game.scores[self.game.player2.id]
 
-            if winner:
-                game.winner = winner
+            # the players of a game restored from a checkpoint are not Player instances
             if not disconnected and not winner:
-                game.winner = self.game.get_winner()
+                winner = self.game.get_winner()
+            if winner:
+                game.winner_id = winner.id
 
             game.save()
 
@@ -314,10 +462,3 @@ class PongConsumer(AsyncWebsocketConsumer):
                 loser_player.losses += 1
                 winner_player.save()
                 loser_player.save()
-
-    async def game_over(self, event):
-        await self.send(text_data=json.dumps({
-            'status': 'game_over',
-            'winner': event['winner'],
-            'reason': event.get('reason', 'normal')
-        }))
@@ -1,8 +1,11 @@
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 import time
 import random
 import math
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
+
+# Bounces resolved within a single update, the ball stops at the last one past that
+MAX_BOUNCES_PER_UPDATE = 4
 
 
 @dataclass
@@ -46,6 +49,8 @@ class PongGame:
 
         self.scores = {player1.id: 0, player2.id: 0}
         self.last_update_time = time.time()
+        # simulation steps run so far
+        self.tick = 0
 
     def _create_paddle(self, x: float) -> Paddle:
         return Paddle(
@@ -96,11 +101,7 @@ class PongGame:
             return False
 
         if not self.ball.resetting:
-            self.ball.x += self.ball.dx * dt * 60
-            self.ball.y += self.ball.dy * dt * 60
-
-        if self.ball.y < self.grid or self.ball.y + self.grid > self.canvas_height - self.grid:
-            self.ball.dy *= -1
+            self._move_ball(dt * 60)
 
         if self.ball.x < 0 or self.ball.x > self.canvas_width:
             if self.ball.x < 0:
@@ -109,21 +110,82 @@ class PongGame:
                 self.scores[self.player1.id] += 1
             self.reset_ball()
 
-        self._handle_paddle_collisions()
-
         return max(self.scores.values()) >= 11
 
-    def _handle_paddle_collisions(self) -> None:
-        ball_dict = self.ball.__dict__
-        left_paddle_dict = self.left_paddle.__dict__
-        right_paddle_dict = self.right_paddle.__dict__
-
-        if self.collides(ball_dict, left_paddle_dict):
+    def _move_ball(self, frames: float) -> None:
+        """
+        Move the ball by `frames` frames of its velocity with swept collisions: the
+        time of impact with the walls and the paddle faces is found within the move,
+        the ball bounces there and travels the rest of the move, so a long step
+        cannot carry it through a paddle or leave it oscillating past a wall.
+        """
+        remaining = 1.0
+        for _ in range(MAX_BOUNCES_PER_UPDATE):
+            move_x = self.ball.dx * frames
+            move_y = self.ball.dy * frames
+            impact = self._first_impact(move_x, move_y, remaining)
+            if impact is None:
+                self.ball.x += move_x * remaining
+                self.ball.y += move_y * remaining
+                return
+            time, surface = impact
+            self.ball.x += move_x * time
+            self.ball.y += move_y * time
+            remaining -= time
+            self._bounce(surface)
+
+    def _first_impact(self, move_x: float, move_y: float, within: float) -> Optional[Tuple[float, str]]:
+        """
+        Find the first surface the ball hits while moving by (move_x, move_y).
+
+        Args:
+            move_x (float): Horizontal move of the whole update.
+            move_y (float): Vertical move of the whole update.
+            within (float): Fraction of the move left to travel.
+
+        Returns:
+            tuple | None: The (fraction of the move, surface) of the first impact,
+                or None if the ball hits nothing within the fraction left.
+        """
+        ball = self.ball
+        impacts = []
+
+        # A ball already past a wall, moving further out, bounces at once
+        if move_y < 0:
+            impacts.append((max(0.0, (self.grid - ball.y) / move_y), 'top'))
+        elif move_y > 0:
+            bottom = self.canvas_height - self.grid - ball.height
+            impacts.append((max(0.0, (bottom - ball.y) / move_y), 'bottom'))
+
+        # Paddles are hit on their face only, by a ball in front of it
+        if move_x < 0:
+            face = self.left_paddle.x + self.left_paddle.width
+            if ball.x >= face:
+                impacts.append(((face - ball.x) / move_x, 'left'))
+        elif move_x > 0:
+            face = self.right_paddle.x - ball.width
+            if ball.x <= face:
+                impacts.append(((face - ball.x) / move_x, 'right'))
+
+        hits = [(time, surface) for time, surface in impacts
+                if time <= within and self._hits_surface(surface, ball.y + move_y * time)]
+        return min(hits, default=None)
+
+    def _hits_surface(self, surface: str, ball_y: float) -> bool:
+        if surface not in ('left', 'right'):
+            return True
+        paddle = self.left_paddle if surface == 'left' else self.right_paddle
+        return ball_y < paddle.y + paddle.height and ball_y + self.ball.height > paddle.y
+
+    def _bounce(self, surface: str) -> None:
+        if surface == 'top':
+            self.ball.dy = abs(self.ball.dy)
+        elif surface == 'bottom':
+            self.ball.dy = -abs(self.ball.dy)
+        elif surface == 'left':
             self.ball.dx = abs(self.ball.dx)
-            self.ball.x = self.left_paddle.x + self.left_paddle.width
-        elif self.collides(ball_dict, right_paddle_dict):
+        else:
             self.ball.dx = -abs(self.ball.dx)
-            self.ball.x = self.right_paddle.x - self.ball.width
 
     def reset_ball(self) -> None:
         self.ball.resetting = True
@@ -151,6 +213,28 @@ class PongGame:
             return self.player2 if disconnected_player == self.player1.id else self.player1
         return None
 
+    def to_checkpoint(self) -> Dict:
+        """
+        The state of the game as plain JSON-serializable data, to resume it from.
+        """
+        return {
+            'scores': [self.scores[self.player1.id], self.scores[self.player2.id]],
+            'ball': asdict(self.ball),
+            'left_paddle': asdict(self.left_paddle),
+            'right_paddle': asdict(self.right_paddle),
+            'tick': self.tick,
+        }
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint: Dict, player1, player2) -> 'PongGame':
+        game = cls(player1, player2)
+        game.scores = dict(zip((player1.id, player2.id), checkpoint['scores']))
+        game.ball = Ball(**checkpoint['ball'])
+        game.left_paddle = Paddle(**checkpoint['left_paddle'])
+        game.right_paddle = Paddle(**checkpoint['right_paddle'])
+        game.tick = checkpoint['tick']
+        return game
+
     def get_state(self) -> Dict[str, float]:
         return {
             "ball_x": self.ball.x,
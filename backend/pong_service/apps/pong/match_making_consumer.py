@@ -1,68 +1,34 @@
-import json
 import random
-from channels.generic.websocket import AsyncWebsocketConsumer
 from asgiref.sync import sync_to_async, async_to_sync
 from channels.db import database_sync_to_async
-from jwt import decode as jwt_decode
+from pong_service.helpers import get_redis_client
+from pong_service.streams import SingleStreamConsumer
 
 active_connections = {}
 
 
-def get_redis_client():
-    from django.conf import settings
-    return settings.REDIS
+class MatchMakingStream:
+    """
+    The matchmaking stream: opening it puts the user in the game queue, and the
+    user is told the game id once matched. Closing it leaves the queue.
+    """
 
+    async def matchmaking_open(self, params):
+        print(f'Player {self.user.username} connected to matchmaking')
+        active_connections[str(self.user.id)] = self
+        await self.add_to_queue(str(self.user.id))
 
-class MatchMakingConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        from django.conf import settings
-        self.cookies = self.scope['cookies']
-        self.access = self.cookies.get(settings.AUTH_COOKIE)
+    async def matchmaking_close(self):
+        active_connections.pop(str(self.user.id), None)
+        await self.remove_from_queue(str(self.user.id))
 
-        if self.access:
-            self.player = await self.get_user_from_access_token(self.access)
-        else:
-            self.player = None
-
-        if not self.player or not self.player.is_authenticated:
-            print('Player not authenticated')
-            await self.close()
-        else:
-            print(f'Player {self.player.username} connected to matchmaking')
-            active_connections[str(self.player.id)] = self
-            await self.accept()
-            await self.add_to_queue(str(self.player.id))
-
-    async def get_user_from_access_token(self, access_token):
-        from django.conf import settings
-        from pong_service.apps.authentication.models import Player
-        from jwt import InvalidTokenError
-        from rest_framework_simplejwt.exceptions import TokenError
-        try:
-            decoded_token = await sync_to_async(jwt_decode)(access_token, settings.SECRET_KEY, algorithms=['HS256'])
-            user_id = decoded_token.get('user_id')
-
-            if user_id is None:
-                return None
-
-            user = await sync_to_async(Player.objects.get)(id=user_id)
-            return user
-        except (TokenError, InvalidTokenError, Player.DoesNotExist):
-            return None
-
-    async def disconnect(self, code):
-        if hasattr(self, 'player') and self.player:
-            active_connections.pop(str(self.player.id), None)
-            await self.remove_from_queue(str(self.player.id))
-
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    async def matchmaking_receive(self, data):
         if data.get('action') == 'cancel_matchmaking':
-            await self.remove_from_queue(str(self.player.id))
-            await self.send(text_data=json.dumps({
+            await self.remove_from_queue(str(self.user.id))
+            await self.send_stream('matchmaking', {
                 'status': 'cancelled',
                 'message': 'Matchmaking cancelled'
-            }))
+            })
 
     @database_sync_to_async
     def get_player(self, username):
@@ -123,9 +89,14 @@ class MatchMakingConsumer(AsyncWebsocketConsumer):
         for player_id in [player1_id, player2_id]:
             connection = await self.get_player_connection(player_id)
             if connection:
-                await connection.send(text_data=json.dumps({
+                await connection.send_stream('matchmaking', {
                     'status': 'matched',
                     'game_id': str(game_id)
-                }))
+                })
             else:
                 print(f"Warning: No active connection for player {player_id}")
+
+
+class MatchMakingConsumer(MatchMakingStream, SingleStreamConsumer):
+    stream = 'matchmaking'
+    ping_payload = {'status': 'ping'}
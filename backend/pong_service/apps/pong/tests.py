@@ -1,3 +1,231 @@
-from django.test import TestCase
+import asyncio
+import json
+import struct
+import uuid
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from pong_service.apps.authentication.models import Player
+from pong_service.apps.chat.tests import connect_socket
+from pong_service.apps.pong import checkpoint, models
+from pong_service.apps.pong.binproto import BinaryProtocol
+from pong_service.apps.pong.frame_buffer import FrameBuffer, match_frame_metrics
+from pong_service.apps.pong.game_consumer import PongConsumer
+from pong_service.apps.pong.game_logic import PongGame
+from pong_service.helpers import SocketUser
 
-# Create your tests here.
+
+def create_game():
+    return PongGame(SocketUser(uuid.uuid4(), 'alice'), SocketUser(uuid.uuid4(), 'bob'))
+
+
+class SlowConsumer:
+    """
+    A game socket whose writes wait until the test lets them through.
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.writable = asyncio.Event()
+
+    async def send(self, **frame):
+        await self.writable.wait()
+        self.sent.append(frame)
+
+
+class FrameBufferTests(SimpleTestCase):
+    async def test_waiting_state_frames_are_replaced_by_the_next_one(self):
+        consumer = SlowConsumer()
+        buffer = FrameBuffer(consumer, 'match')
+        buffer.push_state(b'1')
+        # the writer takes the first frame and waits on the client
+        await asyncio.sleep(0)
+
+        buffer.push_state(b'2')
+        buffer.push_state(b'3')
+        buffer.push_control('game_over')
+        buffer.push_state(b'4')
+        consumer.writable.set()
+        await buffer.writer
+
+        self.assertEqual(consumer.sent, [
+            {'bytes_data': b'1'},
+            {'bytes_data': b'3'},
+            {'text_data': 'game_over'},
+            {'bytes_data': b'4'},
+        ])
+        self.assertEqual(match_frame_metrics['match'], {'sent': 3, 'coalesced': 1, 'dropped': 0, 'connections': 1})
+        buffer.close()
+        self.assertNotIn('match', match_frame_metrics)
+
+    async def test_closing_drops_the_waiting_frames(self):
+        consumer = SlowConsumer()
+        buffer = FrameBuffer(consumer, 'match')
+        other_buffer = FrameBuffer(SlowConsumer(), 'match')
+        buffer.push_state(b'1')
+        await asyncio.sleep(0)
+        buffer.push_state(b'2')
+
+        buffer.close()
+        buffer.push_state(b'3')
+        await asyncio.sleep(0)
+
+        self.assertTrue(buffer.writer.cancelled())
+        self.assertEqual(consumer.sent, [])
+        self.assertEqual(match_frame_metrics['match'], {'sent': 0, 'coalesced': 0, 'dropped': 2, 'connections': 1})
+        other_buffer.close()
+
+
+class GameSnapshotTests(SimpleTestCase):
+    def test_snapshot_carries_its_tick(self):
+        frame = BinaryProtocol.encode_game_state(500.5, 300.25, 262.5, 100.0, 3, 7, 2 ** 32 - 1)
+
+        self.assertEqual(len(frame), struct.calcsize(BinaryProtocol.GAME_STATE_FORMAT))
+        self.assertEqual(BinaryProtocol.decode_game_state(frame), (500.5, 300.25, 262.5, 100.0, 3, 7, 2 ** 32 - 1))
+
+    def test_simulation_does_not_depend_on_its_rate(self):
+        positions = []
+        for rate in (60, 120, 240):
+            game = create_game()
+            game.ball.dx, game.ball.dy = 5, 2
+            game.left_paddle.dy = 6
+            game.last_update_time = 0
+            for tick in range(1, rate + 1):
+                game.update(tick / rate)
+            positions.append((game.ball.x, game.ball.y, game.left_paddle.y))
+
+        for position in positions[1:]:
+            for value, expected in zip(position, positions[0]):
+                self.assertAlmostEqual(value, expected)
+
+
+class SweptCollisionTests(SimpleTestCase):
+    def setUp(self):
+        self.game = create_game()
+        self.game.last_update_time = 0
+        self.paddle = self.game.right_paddle
+        self.face = self.paddle.x - self.game.ball.width
+
+    def serve(self, x, y, dx, dy):
+        self.game.ball.x, self.game.ball.y = x, y
+        self.game.ball.dx, self.game.ball.dy = dx, dy
+
+    def test_long_step_does_not_carry_the_ball_through_the_paddle(self):
+        # 300 pixels in one step, from 140 pixels in front of the paddle face
+        self.serve(self.face - 140, self.paddle.y + 10, 5, 0)
+
+        self.game.update(1)
+
+        self.assertEqual(self.game.ball.dx, -5)
+        self.assertAlmostEqual(self.game.ball.x, self.face - 160)
+        self.assertEqual(list(self.game.scores.values()), [0, 0])
+
+    def test_ball_missing_the_paddle_scores(self):
+        self.serve(self.face - 140, self.paddle.y + self.paddle.height + 10, 5, 0)
+
+        self.game.update(1)
+
+        self.assertEqual(self.game.scores[self.game.player1.id], 1)
+
+    def test_ball_bounces_off_the_walls_within_a_step(self):
+        # 240 pixels up, from 20 pixels below the top wall
+        self.serve(300, self.game.grid + 20, 0, -4)
+
+        self.game.update(1)
+
+        self.assertEqual(self.game.ball.dy, 4)
+        self.assertAlmostEqual(self.game.ball.y, self.game.grid + 220)
+
+
+async def receive_status(socket, status):
+    """
+    Receive the next control message of the given status, skipping the state frames.
+    """
+    while True:
+        output = await socket.receive_output(timeout=2)
+        if output['type'] == 'websocket.send' and output.get('text'):
+            data = json.loads(output['text'])
+            if data['status'] == status:
+                return data
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class GameReconnectTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = Player.objects.create(username='alice', avatar_url='alice.png')
+        self.bob = Player.objects.create(username='bob', avatar_url='bob.png')
+        self.game = models.PongGame.objects.create(player1=self.alice, player2=self.bob)
+        self.path = f'/ws/pong/{self.game.id}/'
+        self.addCleanup(checkpoint.delete, str(self.game.id))
+
+    async def join(self, player):
+        socket = connect_socket(player, self.path)
+        connected, _ = await socket.connect()
+        self.assertTrue(connected)
+        await receive_status(socket, 'player_info')
+        return socket
+
+    async def stop_games(self):
+        """
+        Stop the games of the process, as if it was restarted.
+        """
+        tasks = [*PongConsumer.forfeit_timers.values(), *PongConsumer.game_loops.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for games in (PongConsumer.games, PongConsumer.game_loops, PongConsumer.game_clocks,
+                      PongConsumer.connected_players, PongConsumer.game_players, PongConsumer.forfeit_timers):
+            games.clear()
+
+    async def test_game_is_paused_until_the_player_is_back(self):
+        alice = await self.join(self.alice)
+        bob = await self.join(self.bob)
+
+        await bob.disconnect()
+        self.assertEqual((await receive_status(alice, 'game_paused'))['player'], 'bob')
+        game = PongConsumer.games[str(self.game.id)]
+        tick = game.tick
+        await asyncio.sleep(0.05)
+        self.assertEqual(game.tick, tick)
+
+        bob = await self.join(self.bob)
+        await receive_status(alice, 'game_resumed')
+        await receive_status(bob, 'game_resumed')
+        await asyncio.sleep(0.05)
+        self.assertGreater(game.tick, tick)
+
+        await self.stop_games()
+
+    @override_settings(GAME_RECONNECT_GRACE=0.1)
+    async def test_game_is_forfeited_after_the_grace_window(self):
+        alice = await self.join(self.alice)
+        bob = await self.join(self.bob)
+
+        await bob.disconnect()
+
+        game_over = await receive_status(alice, 'game_over')
+        self.assertEqual((game_over['winner'], game_over['reason']), ('alice', 'disconnection'))
+        # The game loop stopped by the forfeit does not announce another end
+        while not await alice.receive_nothing(timeout=0.1):
+            output = await alice.receive_output()
+            self.assertNotIn('game_over', output.get('text') or '')
+        await self.game.arefresh_from_db()
+        self.assertEqual((self.game.status, self.game.winner_id), (models.PongGame.Status.FINISHED, self.alice.id))
+        await self.stop_games()
+
+    @override_settings(GAME_CHECKPOINT_REDIS=True)
+    async def test_game_is_restored_from_its_checkpoint(self):
+        await self.join(self.alice)
+        bob = await self.join(self.bob)
+        await bob.disconnect()
+        await asyncio.sleep(0.05)
+        await self.stop_games()
+        # The restored game shows the players from the checkpoint
+        await Player.objects.filter(id=self.alice.id).aupdate(avatar_url='new.png')
+
+        bob = connect_socket(self.bob, self.path)
+        await bob.connect()
+
+        player_info = (await receive_status(bob, 'player_info'))['data']
+        self.assertEqual(player_info['currentPlayer'], {'username': 'bob', 'avatar': 'bob.png', 'role': 'player2'})
+        self.assertEqual(player_info['opponent'], {'username': 'alice', 'avatar': 'alice.png', 'role': 'player1'})
+        self.assertIn((str(self.game.id), self.alice.id), PongConsumer.forfeit_timers)
+        await self.stop_games()
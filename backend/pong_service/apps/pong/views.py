@@ -2,13 +2,15 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework import status
+from django.db import transaction
 from django.db.models import Q
 from .models import PongGame, GameRequest
 from pong_service.apps.authentication.models import Player
 from django.shortcuts import get_object_or_404
-from django.conf import settings
 from pong_service.apps.chat.consumers import NotificationConsumer
+from pong_service.apps.chat import presence
 from pong_service.apps.pong.models import Tournament
+from pong_service.helpers import get_redis_client
 import django.utils.timezone as timezone
 
 import logging
@@ -37,7 +39,7 @@ class RequestGameView(APIView):
             }, status=status.HTTP_400_BAD_REQUEST)
 
         # check if player is already in queue
-        redis_client = settings.REDIS
+        redis_client = get_redis_client()
         queue = redis_client.lrange('game_queue', 0, -1)
         if str(player.id).encode('utf-8') in queue:
             return Response({
@@ -69,7 +71,7 @@ class RequestGameWithPlayerView(APIView):
         opponent = get_object_or_404(Player, username=opponent_username)
         
         # Check if opponent is online
-        if not opponent.online:
+        if not presence.is_online(opponent.id):
             return Response({
                 'status': 'error',
                 'message': 'Opponent is not online'
@@ -100,15 +102,16 @@ class RequestGameWithPlayerView(APIView):
                 'request_id': str(active_request.id)
             }, status=status.HTTP_400_BAD_REQUEST)
 
-        # Create a new game request
-        game_request = GameRequest.objects.create(
-            requester=player,
-            opponent=opponent,
-            status=GameRequest.Status.PENDING
-        )
+        with transaction.atomic():
+            # Create a new game request
+            game_request = GameRequest.objects.create(
+                requester=player,
+                opponent=opponent,
+                status=GameRequest.Status.PENDING
+            )
 
-        # Send a notification to the opponent
-        NotificationConsumer.sendGameRequestNotification(player, opponent.id, str(game_request.id))
+            # Send a notification to the opponent
+            NotificationConsumer.sendGameRequestNotification(player, opponent.id, str(game_request.id))
 
         return Response({
             'status': 'success',
@@ -133,19 +136,20 @@ class AcceptGameRequestView(APIView):
         game_request = get_object_or_404(
             GameRequest, id=request_id, opponent=player, status=GameRequest.Status.PENDING)
 
-        # Create a new game
-        game = PongGame.objects.create(
-            player1=game_request.requester,
-            player2=game_request.opponent,
-            status=PongGame.Status.PENDING
-        )
+        with transaction.atomic():
+            # Create a new game
+            game = PongGame.objects.create(
+                player1=game_request.requester,
+                player2=game_request.opponent,
+                status=PongGame.Status.PENDING
+            )
 
-        # Update the game request status
-        game_request.status = GameRequest.Status.ACCEPTED
-        game_request.save()
+            # Update the game request status
+            game_request.status = GameRequest.Status.ACCEPTED
+            game_request.save()
 
-        # Send a notification to the requester
-        NotificationConsumer.sendGameRequestResponseNotification(game_request.requester.id, str(game.id))
+            # Send a notification to the requester
+            NotificationConsumer.sendGameRequestResponseNotification(game_request.requester_id, str(game.id))
 
         return Response({
             'status': 'success',
@@ -169,12 +173,13 @@ class RejectGameRequestView(APIView):
         game_request = get_object_or_404(
             GameRequest, id=request_id, opponent=player, status=GameRequest.Status.PENDING)
 
-        # Update the game request status
-        game_request.status = GameRequest.Status.REJECTED
-        game_request.save()
+        with transaction.atomic():
+            # Update the game request status
+            game_request.status = GameRequest.Status.REJECTED
+            game_request.save()
 
-        # Send a notification to the requester
-        NotificationConsumer.sendGameRequestResponseNotification(game_request.requester.id, None)
+            # Send a notification to the requester
+            NotificationConsumer.sendGameRequestResponseNotification(game_request.requester_id, None)
 
         return Response({
             'status': 'success',
@@ -244,18 +249,19 @@ class TournamentCreateView(APIView):
         player3 = get_object_or_404(Player, username=player3_username)
         player4 = get_object_or_404(Player, username=player4_username)
 
-        # Create a new tournament
-        tournament = Tournament.objects.create(
-            player1=player,
-            player2=player2,
-            player3=player3,
-            player4=player4,
-        )
-        
-        # Notify all players
-        NotificationConsumer.sendTournamentNotification(player.username ,player2)
-        NotificationConsumer.sendTournamentNotification(player.username ,player3)
-        NotificationConsumer.sendTournamentNotification(player.username ,player4)
+        with transaction.atomic():
+            # Create a new tournament
+            tournament = Tournament.objects.create(
+                player1=player,
+                player2=player2,
+                player3=player3,
+                player4=player4,
+            )
+
+            # Notify all players
+            NotificationConsumer.sendTournamentNotification(player.username ,player2)
+            NotificationConsumer.sendTournamentNotification(player.username ,player3)
+            NotificationConsumer.sendTournamentNotification(player.username ,player4)
         
         players = self.construct_players(player, player2, player3, player4)
         return Response({
@@ -14,12 +14,13 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from pong_service.apps.chat.routing import websocket_urlpatterns as chat_websocket_urlpatterns
 from pong_service.apps.pong.routing import websocket_urlpatterns as pong_websocket_urlpatterns
+from pong_service.routing import websocket_urlpatterns as multiplex_websocket_urlpatterns
 
 application = ProtocolTypeRouter({
 	"http": get_asgi_application(),
 	"websocket": AuthMiddlewareStack(
 		URLRouter(
-			chat_websocket_urlpatterns + pong_websocket_urlpatterns
+			multiplex_websocket_urlpatterns + chat_websocket_urlpatterns + pong_websocket_urlpatterns
 		)
 	),
 })
@@ -0,0 +1,70 @@
+import json
+from pong_service import keepalive
+from pong_service.streams import StreamConsumer
+from pong_service.apps.chat.consumers import ChatStream, NotificationStream
+from pong_service.apps.pong.match_making_consumer import MatchMakingStream
+
+
+class MultiplexConsumer(ChatStream, NotificationStream, MatchMakingStream, StreamConsumer):
+    """
+    A single authenticated socket per client that carries the chat, notification
+    and matchmaking streams, instead of one socket, JWT decode and Player query
+    for each of them.
+
+    Every frame is an envelope naming its stream:
+    - {"stream": name, "open": true, "params": {...}} subscribes to a stream.
+    - {"stream": name, "close": true} unsubscribes from it.
+    - {"stream": name, "payload": {...}} carries a message of an open stream, both ways.
+
+    The server sends {"ping": true} to an idle socket, which the client answers
+    with {"pong": true}. Any frame keeps the socket alive.
+
+    Games keep their own binary socket, their frames are too frequent to be wrapped in JSON.
+    """
+    streams = ('chat', 'notification', 'matchmaking')
+
+    async def connect(self):
+        self.open_streams = set()
+        if not await self.authenticate():
+            return None
+        await self.accept()
+        keepalive.track(self)
+
+    async def disconnect(self, close_code):
+        keepalive.untrack(self)
+        if getattr(self, 'user', None) is None:
+            return None
+        for stream in list(self.open_streams):
+            self.open_streams.discard(stream)
+            await self.close_stream(stream)
+
+    async def receive(self, text_data):
+        keepalive.touch(self)
+        try:
+            data = json.loads(text_data)
+        except ValueError:
+            return
+        if not isinstance(data, dict) or data.get('stream') not in self.streams:
+            return
+
+        stream = data['stream']
+        if data.get('open'):
+            if stream not in self.open_streams:
+                self.open_streams.add(stream)
+                params = data.get('params')
+                await self.open_stream(stream, params if isinstance(params, dict) else {})
+        elif data.get('close'):
+            if stream in self.open_streams:
+                self.open_streams.discard(stream)
+                await self.close_stream(stream)
+        elif stream in self.open_streams and isinstance(data.get('payload'), dict):
+            await self.receive_stream(stream, data['payload'])
+
+    async def send_ping(self):
+        await self.send(text_data=json.dumps({'ping': True}))
+
+    async def send_stream(self, stream, payload):
+        await self.send(text_data=json.dumps({
+            'stream': stream,
+            'payload': payload
+        }))
@@ -1,19 +1,67 @@
+from collections import namedtuple
+from functools import lru_cache
 
-async def get_user_from_access_token(access_token):
+
+# What a websocket keeps of its user for the lifetime of the connection,
+# instead of a full Player instance
+SocketUser = namedtuple('SocketUser', ['id', 'username'])
+
+
+async def get_socket_user_from_access_token(access_token):
+    """
+    Authenticate a websocket from its access token, loading only the id and
+    username of the player.
+
+    Returns:
+        SocketUser | None: The user, or None if the token is missing or invalid.
+    """
     from django.conf import settings
     from pong_service.apps.authentication.models import Player
     from jwt import InvalidTokenError
-    from rest_framework_simplejwt.exceptions import TokenError
     from jwt import decode as jwt_decode
     from asgiref.sync import sync_to_async
+    if not access_token:
+        return None
     try:
         decoded_token = await sync_to_async(jwt_decode)(access_token, settings.SECRET_KEY, algorithms=['HS256'])
-        user_id = decoded_token.get('user_id')
+    except InvalidTokenError:
+        return None
+    user_id = decoded_token.get('user_id')
+    if user_id is None:
+        return None
 
-        if user_id is None:
-            return None
+    row = await sync_to_async(
+        Player.objects.filter(id=user_id).values_list('id', 'username').first)()
+    return SocketUser(*row) if row else None
 
-        user = await sync_to_async(Player.objects.get)(id=user_id)
-        return user
-    except (TokenError, InvalidTokenError, Player.DoesNotExist):
-        return None
+
+@lru_cache(maxsize=None)
+def get_redis_client():
+    """
+    Return the process-wide Redis client, created on first use so importing
+    the settings does not pull in or configure redis.
+    """
+    import redis
+    from django.conf import settings
+    return redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+
+
+@lru_cache(maxsize=None)
+def get_gs_credentials():
+    """
+    Load the Google Cloud service account credentials on first use, so a missing
+    credentials file only fails the requests that talk to the bucket.
+    """
+    from google.oauth2 import service_account
+    from django.conf import settings
+    return service_account.Credentials.from_service_account_file(settings.GS_CREDENTIALS_FILE)
+
+
+@lru_cache(maxsize=None)
+def get_gs_client():
+    """
+    Return the process-wide Google Cloud Storage client, created on first use.
+    """
+    from google.cloud import storage
+    from django.conf import settings
+    return storage.Client(credentials=get_gs_credentials(), project=settings.GS_PROJECT_ID)
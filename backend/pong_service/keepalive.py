@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import time
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# consumer -> time its last frame was received, of the websockets served by this process
+_last_seen = {}
+# consumers pinged but never closed as idle, as their clients do not answer pings
+_ping_only = set()
+_reaper = None
+
+
+def track(consumer, reap_idle=True):
+    """
+    Watch an accepted websocket, and start the reaper of the process on the
+    running event loop if it is not running yet.
+
+    The consumer must implement `send_ping()`, sent once it has been idle for
+    WEBSOCKET_PING_INTERVAL seconds. Clients answer with any frame, and a socket
+    idle for WEBSOCKET_IDLE_TIMEOUT seconds is considered dead and closed, unless
+    `reap_idle` is False: the socket is then only pinged every interval.
+    """
+    global _reaper
+
+    _last_seen[consumer] = time.monotonic()
+    if not reap_idle:
+        _ping_only.add(consumer)
+    if _reaper is None or _reaper.done():
+        _reaper = asyncio.get_running_loop().create_task(_reaper_loop())
+
+
+def touch(consumer):
+    if consumer in _last_seen:
+        _last_seen[consumer] = time.monotonic()
+
+
+def untrack(consumer):
+    _last_seen.pop(consumer, None)
+    _ping_only.discard(consumer)
+
+
+async def _ping_or_reap(consumer, idle):
+    if consumer in _ping_only:
+        # no answer is coming, the ping itself restarts the interval
+        _last_seen[consumer] = time.monotonic()
+        await consumer.send_ping()
+    elif idle >= settings.WEBSOCKET_IDLE_TIMEOUT:
+        untrack(consumer)
+        await consumer.close(code=4408)
+    else:
+        await consumer.send_ping()
+
+
+async def reap_idle_connections():
+    """
+    Ping the idle websockets and close the ones that did not answer in time.
+
+    Returns:
+        int: The number of websockets closed.
+    """
+    now = time.monotonic()
+    idle_consumers = [(consumer, now - last_seen) for consumer, last_seen in _last_seen.items()
+                      if now - last_seen >= settings.WEBSOCKET_PING_INTERVAL]
+    results = await asyncio.gather(
+        *(_ping_or_reap(consumer, idle) for consumer, idle in idle_consumers),
+        return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f'Failed to ping a websocket: {result}')
+    return sum(1 for consumer, idle in idle_consumers
+               if idle >= settings.WEBSOCKET_IDLE_TIMEOUT and consumer not in _ping_only)
+
+
+async def _reaper_loop():
+    while True:
+        await asyncio.sleep(settings.WEBSOCKET_PING_INTERVAL / 2)
+        try:
+            reaped = await reap_idle_connections()
+            if reaped:
+                logger.info(f'Closed {reaped} idle websockets, {len(_last_seen)} still open')
+        except Exception as e:
+            logger.error(f'Websocket reaper failed: {e}')
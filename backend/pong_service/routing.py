@@ -0,0 +1,6 @@
+from django.urls import re_path
+from pong_service.consumers import MultiplexConsumer
+
+websocket_urlpatterns = [
+	re_path(r'ws/$', MultiplexConsumer.as_asgi()),
+]
@@ -13,8 +13,6 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 from datetime import timedelta
 from os import getenv
 from pathlib import Path
-from google.oauth2 import service_account
-import redis
 import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -26,7 +24,17 @@ REDIS_HOST = os.environ.get('REDIS_HOST')
 REDIS_PORT = os.environ.get('REDIS_PORT')
 REDIS_DB = os.environ.get('REDIS_DB')
 
-REDIS = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+# The Redis client itself is created lazily, see pong_service.helpers.get_redis_client
+
+# Cache, also used as the session store so pending 2FA logins never touch Postgres
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': f'redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB or 0}',
+    }
+}
+
+SESSION_ENGINE = 'django.contrib.sessions.backends.cache'
 
 # 42 API
 UID = os.environ.get('UID')
@@ -62,6 +70,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'pong_service.apps.authentication',
     'pong_service.apps.chat',
@@ -94,6 +103,11 @@ AUTH_COOKIE_PATH = '/'
 AUTH_COOKIE_SAMESITE = 'Strict'
 TOKEN_REFRESH_THRESHOLD = 2
 
+# 2FA
+TWO_FACTOR_CHALLENGE_TTL = 60 * 5
+TWO_FACTOR_MAX_ATTEMPTS = 5
+TWO_FACTOR_QR_CACHE_TTL = 60 * 10
+
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
@@ -140,6 +154,47 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Seconds read receipts sent over the chat websocket are buffered before being written
+CHAT_READ_RECEIPT_FLUSH_INTERVAL = 2
+
+# Write-behind buffer of messages sent over the chat websocket
+CHAT_MESSAGE_FLUSH_INTERVAL = 0.05
+CHAT_MESSAGE_BATCH_SIZE = 100
+# How long a client message id is remembered to ignore resends
+CHAT_CLIENT_ID_TTL = 60 * 60
+# Presence of the notification sockets: each process refreshes its sockets every
+# heartbeat interval, a socket not refreshed within the ttl is considered closed
+PRESENCE_HEARTBEAT_INTERVAL = 10
+PRESENCE_TTL = 30
+# How often Player.online is synced from the presence in Redis
+PRESENCE_PERSIST_INTERVAL = 60
+# Online status changes are debounced for this long before being sent to friends
+PRESENCE_FANOUT_DEBOUNCE = 1
+# Notifications kept in each user's inbox, and replayed at most on reconnect
+NOTIFICATION_INBOX_SIZE = 100
+NOTIFICATION_REPLAY_LIMIT = 100
+# A user whose last notification socket closed is cleaned up, and announced as
+# offline, only if they have not reconnected within the grace window
+NOTIFICATION_DISCONNECT_GRACE = 10
+NOTIFICATION_CLEANUP_INTERVAL = 2
+# Idle websockets are pinged after this many seconds, and closed as dead
+# if nothing was received from them within the idle timeout
+WEBSOCKET_PING_INTERVAL = 20
+WEBSOCKET_IDLE_TIMEOUT = 60
+# Ticks per second of the game simulation, and snapshots per second sent to the players
+GAME_SIMULATION_RATE = 120
+GAME_SNAPSHOT_RATE = 30
+# Seconds a running game stays paused for a disconnected player to come back
+# before they forfeit it, and whether paused games are also checkpointed to Redis
+GAME_RECONNECT_GRACE = 10
+GAME_CHECKPOINT_REDIS = getenv('GAME_CHECKPOINT_REDIS', 'False') == 'True'
+# How long a user's cached friend and block sets live in Redis
+SOCIAL_GRAPH_CACHE_TTL = 60 * 60
+
+# Websocket events recorded by sync views are delivered by the dispatch_outbox command
+OUTBOX_POLL_INTERVAL = 0.1
+OUTBOX_BATCH_SIZE = 200
+
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
@@ -192,9 +247,9 @@ STATIC_URL = '/static/'
 STATIC_ROOT = '/app/static/'
 
 # setting for link google cloud storage with django
+# The credentials are loaded lazily, see pong_service.helpers.get_gs_credentials
 
-GS_CREDENTIALS = service_account.Credentials.from_service_account_file(
-    os.path.join(BASE_DIR, '.env'))
+GS_CREDENTIALS_FILE = os.path.join(BASE_DIR, '.env')
 DEFAULT_FILE_STORAGE = 'pong_service.apps.authentication.gcloud.GoogleCloudMediaStorage'
 GS_PROJECT_ID = 'transcendencestorage'
 GS_BUCKET_NAME = 'avatars_ft_tran'
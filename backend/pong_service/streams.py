@@ -0,0 +1,86 @@
+import json
+from urllib.parse import parse_qs
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from pong_service import keepalive
+from pong_service.helpers import get_socket_user_from_access_token
+
+
+class StreamConsumer(AsyncWebsocketConsumer):
+    """
+    Base of the sockets that carry streams.
+
+    A stream is a mixin that implements `<stream>_open(params)`, `<stream>_close()`
+    and `<stream>_receive(data)`, and sends its messages with
+    `self.send_stream(stream, payload)`. The same stream can then be served on its
+    own socket or multiplexed with others on a single socket, which wraps the
+    payloads in envelopes.
+    """
+
+    async def authenticate(self):
+        """
+        Authenticate the socket from the access token cookie, once per connection.
+        Only the user's id and username are kept, and the cookies and headers are
+        dropped from the scope, as they are not needed once connected.
+
+        Returns:
+            bool: True if the user is authenticated, the socket is closed otherwise.
+        """
+        self.user = await get_socket_user_from_access_token(self.scope['cookies'].get(settings.AUTH_COOKIE))
+        self.scope.pop('cookies', None)
+        self.scope.pop('headers', None)
+        if self.user is None:
+            await self.close()
+            return False
+        return True
+
+    async def open_stream(self, stream, params):
+        await getattr(self, f'{stream}_open')(params)
+
+    async def close_stream(self, stream):
+        await getattr(self, f'{stream}_close')()
+
+    async def receive_stream(self, stream, data):
+        await getattr(self, f'{stream}_receive')(data)
+
+    async def send_stream(self, stream, payload):
+        await self.send(text_data=json.dumps(payload))
+
+
+class SingleStreamConsumer(StreamConsumer):
+    """
+    A socket that carries a single stream in its own wire format: the stream's
+    messages are sent and received as is, and its params are the query string.
+
+    These are the sockets of older clients, which neither expect nor answer pings.
+    Idle sockets are sent `ping_payload`, a frame of the stream that its clients
+    ignore, so a dead peer fails the write, but they are never closed as idle.
+    """
+    stream = None
+    ping_payload = {}
+
+    async def connect(self):
+        if not await self.authenticate():
+            return None
+        await self.accept()
+        keepalive.track(self, reap_idle=False)
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        await self.open_stream(self.stream, {key: values[0] for key, values in query.items()})
+
+    async def disconnect(self, close_code):
+        keepalive.untrack(self)
+        if getattr(self, 'user', None) is None:
+            return None
+        await self.close_stream(self.stream)
+
+    async def receive(self, text_data):
+        keepalive.touch(self)
+        try:
+            data = json.loads(text_data)
+        except ValueError:
+            return
+        if isinstance(data, dict):
+            await self.receive_stream(self.stream, data)
+
+    async def send_ping(self):
+        await self.send_stream(self.stream, self.ping_payload)
@@ -10,6 +10,10 @@ export class ChatMessage extends BaseHTMLElement {
       newConversation: null,
     });
     this._conversation = { id: 0, IsBlockedByMe: false, IsBlockedByOtherPlayer: false ,player: null };
+    this.olderMessagesCursor = null;
+    // messages sent over the chat socket waiting for their ack, by client id
+    this.pendingMessages = {};
+    this.loadingOlderMessages = false;
     this.state = state;
     this.registerUpdate = registerUpdate;
     this.registerLocalFunctions();
@@ -28,6 +32,7 @@ export class ChatMessage extends BaseHTMLElement {
 
     this.handleProfileClick();
     this.handleDropdown();
+    this.loadOlderMessagesOnScroll();
     this.updateMessageInputUIBasedOnBlockStatus();
     this.updateOnlineStatus(this._conversation.player.online);
   }
@@ -44,6 +49,15 @@ export class ChatMessage extends BaseHTMLElement {
     this.registerUpdate("newConversation", this.addNewConversation.bind(this));
   }
 
+  messagesUrl(query = "") {
+    return "/api/conversations/" + this._conversation.id + "/messages" + query;
+  }
+
+  // the server returns pages newest first, keep only the cursor of the next (older) page
+  cursorOf(nextUrl) {
+    return nextUrl ? new URL(nextUrl).search : null;
+  }
+
   getMessages(conversation) {
     app.api
       .get("/api/conversations/" + conversation.id + "/messages")
@@ -52,10 +66,83 @@ export class ChatMessage extends BaseHTMLElement {
           displayRequestStatus("error", response.data)
           return;
         }
-        this.state.messages = response.data;
+        this.olderMessagesCursor = this.cursorOf(response.data.next);
+        this.state.messages = response.data.results.reverse();
+        this.markMessagesAsRead();
       })
   }
 
+  markMessagesAsRead() {
+    const lastMessage = this.state.messages[this.state.messages.length - 1];
+    if (!lastMessage) {
+      return;
+    }
+    app.api.post("/api/conversations/" + this._conversation.id + "/read", {
+      message_id: lastMessage.messageID,
+    });
+  }
+
+  loadOlderMessagesOnScroll() {
+    // the scroll container is flex-column-reverse, so its top is reached when
+    // scrollTop goes down to -(scrollHeight - clientHeight)
+    const scrollContainer = this.querySelector(".chat_messages").parentElement;
+    scrollContainer.addEventListener("scroll", () => {
+      const distanceToTop =
+        scrollContainer.scrollHeight - scrollContainer.clientHeight + scrollContainer.scrollTop;
+      if (distanceToTop < 50) {
+        this.loadOlderMessages();
+      }
+    });
+  }
+
+  loadOlderMessages() {
+    if (!this.olderMessagesCursor || this.loadingOlderMessages) {
+      return;
+    }
+    this.loadingOlderMessages = true;
+    app.api.get(this.messagesUrl(this.olderMessagesCursor)).then((response) => {
+      this.loadingOlderMessages = false;
+      if (response.status >= 400) {
+        displayRequestStatus("error", response.data)
+        return;
+      }
+      this.olderMessagesCursor = this.cursorOf(response.data.next);
+      const olderMessages = response.data.results.reverse();
+      const messageContainer = this.querySelector(".chat_messages");
+      messageContainer.insertAdjacentHTML(
+        "afterbegin",
+        olderMessages.map((message) => this.createMessageElement(message)).join("")
+      );
+      // update the messages without triggering a full re-render
+      this.state.messages.unshift(...olderMessages);
+    });
+  }
+
+  // fetch only the messages sent after the last one we have, e.g. after a reconnect
+  syncNewMessages() {
+    if (!this._conversation.id) {
+      return;
+    }
+    const lastMessage = this.state.messages[this.state.messages.length - 1];
+    if (!lastMessage) {
+      this.getMessages(this._conversation);
+      return;
+    }
+    app.api.get(this.messagesUrl("?since=" + lastMessage.messageID)).then((response) => {
+      if (response.status >= 400) {
+        displayRequestStatus("error", response.data)
+        return;
+      }
+      // add them one by one, the UI only appends the last message on each update
+      response.data.results.forEach((message) => {
+        this.state.messages = [...this.state.messages, message];
+      });
+      if (response.data.has_more) {
+        this.syncNewMessages();
+      }
+    });
+  }
+
   updateUIMessages() {
     const messageContainer = this.querySelector(".chat_messages");
 
@@ -113,6 +200,17 @@ export class ChatMessage extends BaseHTMLElement {
   }
 
   postNewMessage(message) {
+    const chatSocket = document.querySelector("chat-page").chatSocket;
+    if (chatSocket && chatSocket.readyState === WebSocket.OPEN) {
+      const clientId = crypto.randomUUID();
+      this.pendingMessages[clientId] = {
+        conversation_id: this._conversation.id,
+        content: message.content,
+      };
+      this.sendPendingMessage(chatSocket, clientId);
+      return;
+    }
+
     app.api
       .post(
         "/api/conversations/" + this._conversation.id + "/messages",
@@ -128,6 +226,34 @@ export class ChatMessage extends BaseHTMLElement {
       });
   }
 
+  sendPendingMessage(chatSocket, clientId) {
+    chatSocket.send(JSON.stringify({
+      type: "message",
+      client_id: clientId,
+      ...this.pendingMessages[clientId],
+    }));
+  }
+
+  // resend the messages that were not acked before the socket dropped, the server ignores duplicates
+  resendPendingMessages(chatSocket) {
+    Object.keys(this.pendingMessages).forEach((clientId) => {
+      this.sendPendingMessage(chatSocket, clientId);
+    });
+  }
+
+  handleAck(ack) {
+    if (!(ack.client_id in this.pendingMessages)) {
+      return;
+    }
+    delete this.pendingMessages[ack.client_id];
+    if (ack.error) {
+      displayRequestStatus("error", ack.error);
+      return;
+    }
+    this.state.messages = [...this.state.messages, ack.message];
+    this.moveConversationToTop();
+  }
+
   addNewConversation() {
     const chatPage = document.querySelector("chat-page");
     // update the last message of the conversation
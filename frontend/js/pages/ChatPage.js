@@ -1,6 +1,7 @@
 import BaseHTMLElement from "./BaseHTMLElement.js";
 import { createState } from "../utils/stateManager.js";
 import { displayRequestStatus } from "../utils/errorManagement.js";
+import { getMultiplexSocket } from "../utils/MultiplexSocket.js";
 
 export class ChatPage extends BaseHTMLElement {
   constructor() {
@@ -40,16 +41,29 @@ export class ChatPage extends BaseHTMLElement {
   }
 
   setupWebsocket() {
-    this.chatSocket = new WebSocket(
-      "wss://" + window.location.host + "/ws/chat/"
-    );
+    // the multiplexed socket reconnects on its own and reopens the stream
+    this.chatSocket = getMultiplexSocket().openStream("chat");
 
     this.chatSocket.onopen = (e) => {
       console.log("Chat socket open");
+      // catch up on the messages missed while the socket was down
+      const chatMessage = this.querySelector("chat-message");
+      if (chatMessage) {
+        chatMessage.syncNewMessages();
+        chatMessage.resendPendingMessages(this.chatSocket);
+      }
     };
 
     this.chatSocket.onmessage = (e) => {
       const data = JSON.parse(e.data);
+      if (data.ack) {
+        // ack of a message we sent over the socket
+        const chatMessage = this.querySelector("chat-message");
+        if (chatMessage) {
+          chatMessage.handleAck(data.ack);
+        }
+        return;
+      }
       const conversation = this.state.conversations.find(
         (conversation) =>
           conversation.conversationID === data.message.conversation_id
@@ -80,8 +94,12 @@ export class ChatPage extends BaseHTMLElement {
           data.message.data,
         ];
 
-        // mark message as read if the conversation is opened
-        app.api.patch("/api/conversations/" + conversation.conversationID + "/messages/" + data.message.data.messageID + "/mark_as_read/")
+        // mark message as read if the conversation is opened, the server batches these receipts
+        this.chatSocket.send(JSON.stringify({
+          type: "read",
+          conversation_id: data.message.conversation_id,
+          message_id: data.message.data.messageID,
+        }));
         // return;
       }
 
@@ -94,12 +112,6 @@ export class ChatPage extends BaseHTMLElement {
     };
 
     this.chatSocket.onclose = (e) => {
-      // reconnect the websocket if the parent page is still open
-      if (!this.isDisconnected) {
-        console.log("Reconnecting chat socket...");
-        this.setupWebsocket();
-        return;
-      }
       console.log("Chat socket closed");
     };
   }
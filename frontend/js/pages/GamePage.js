@@ -1,4 +1,5 @@
 import BaseHTMLElement from "./BaseHTMLElement.js";
+import { getMultiplexSocket } from "../utils/MultiplexSocket.js";
 
 export class GamePage extends BaseHTMLElement {
   constructor() {
@@ -74,7 +75,7 @@ export class GamePage extends BaseHTMLElement {
 
       if (response.ok) {
         this.updateStatus("Connecting to matchmaking...");
-        this.connectToMatchmaking(data.websocket_url);
+        this.connectToMatchmaking();
       } else {
         this.updateStatus(`Error: ${data.message}`, "error");
       }
@@ -83,11 +84,9 @@ export class GamePage extends BaseHTMLElement {
     }
   }
 
-  connectToMatchmaking(websocketUrl) {
-    websocketUrl = websocketUrl.replace(/\/$/, "");
-    this.matchmakingSocket = new WebSocket(
-      `wss://${window.location.host}${websocketUrl}/`
-    );
+  connectToMatchmaking() {
+    // matchmaking is a stream of the multiplexed socket, opening it joins the queue
+    this.matchmakingSocket = getMultiplexSocket().openStream("matchmaking");
 
     this.matchmakingSocket.onopen = () => {
       this.updateStatus("Waiting for opponent...", "waiting");
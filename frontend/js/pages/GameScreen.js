@@ -1,5 +1,9 @@
 import BaseHTMLElement from "./BaseHTMLElement.js";
 
+// The server keeps a game paused for this long after a player drops, retry within it
+const RECONNECT_WINDOW = 10000;
+const RECONNECT_DELAY = 1000;
+
 export class GameScreen extends BaseHTMLElement {
   constructor() {
     super();
@@ -11,12 +15,23 @@ export class GameScreen extends BaseHTMLElement {
     this.canvas = null;
     this.ctx = null;
     this.gameOver = false;
+    // the last two snapshots received, the game is drawn interpolating between them
+    this.previousSnapshot = null;
+    this.latestSnapshot = null;
+    this.renderFrame = null;
+    // set while reconnecting after the socket dropped
+    this.reconnectDeadline = null;
+    this.leaving = false;
   }
 
   connectedCallback() {
     this.render();
   }
 
+  disconnectedCallback() {
+    this.stopRendering();
+  }
+
   render() {
     this.innerHTML = `
       <div id="gameScreen" class="flex flex-col items-center justify-center h-screen bg-gray-100" style="display: flex; flex-direction: column; align-items: center; justify-content: center;">
@@ -76,6 +91,7 @@ export class GameScreen extends BaseHTMLElement {
 
     ws.onopen = () => {
       console.log("Connected to game server");
+      this.reconnectDeadline = null;
     };
 
     ws.onmessage = (e) => {
@@ -88,9 +104,17 @@ export class GameScreen extends BaseHTMLElement {
 
     ws.onclose = () => {
       console.log("Disconnected from game server");
-      if (!this.gameOver) {
-        this.handleUnexpectedDisconnection();
+      if (this.gameOver || this.leaving || !this.isConnected) return;
+
+      // the game waits for us on the server, get back to it within the window
+      if (this.reconnectDeadline === null) {
+        this.reconnectDeadline = Date.now() + RECONNECT_WINDOW;
+      }
+      if (Date.now() < this.reconnectDeadline) {
+        setTimeout(() => this.connectToGameServer(), RECONNECT_DELAY);
+        return;
       }
+      this.handleUnexpectedDisconnection();
     };
 
     this.gameSocket = ws;
@@ -99,13 +123,21 @@ export class GameScreen extends BaseHTMLElement {
   handleJsonMessage(data) {
     try {
       const jsonData = JSON.parse(data);
-      if (jsonData.status === "player_info") {
+      if (jsonData.status === "ping") {
+        // keep the socket alive while idle, e.g. waiting for the opponent
+        this.gameSocket.send("pong");
+      } else if (jsonData.status === "player_info") {
         this.setPlayerInfo(jsonData.data);
       } else if (jsonData.status === "game_start") {
         console.log("Game is starting!");
         this.gameOver = false;
         this.gameOverOverlay.classList.add("hidden");
         this.updateMatchInfo();
+      } else if (jsonData.status === "game_paused") {
+        this.gameOverMessage.textContent = `${jsonData.player} disconnected, waiting ${jsonData.grace}s for them to come back...`;
+        this.gameOverOverlay.classList.remove("hidden");
+      } else if (jsonData.status === "game_resumed") {
+        this.gameOverOverlay.classList.add("hidden");
       } else if (jsonData.status === "game_over") {
         this.handleGameOver(jsonData.winner, jsonData.reason);
       }
@@ -132,6 +164,7 @@ export class GameScreen extends BaseHTMLElement {
     }
     this.gameOverMessage.textContent = message;
     this.gameOverOverlay.classList.remove("hidden");
+    this.stopRendering();
     console.log(message);
     this.gameSocket.close();
   }
@@ -140,14 +173,52 @@ export class GameScreen extends BaseHTMLElement {
     if (data instanceof Blob) {
       data.arrayBuffer().then((buffer) => {
         this.decodeGameState(buffer);
-        this.drawGame();
+        this.startRendering();
       });
     } else if (data instanceof ArrayBuffer) {
       this.decodeGameState(data);
-      this.drawGame();
+      this.startRendering();
     }
   }
 
+  // Snapshots arrive at the server's snapshot rate, lower than the display's,
+  // so the game is drawn every animation frame between the last two of them
+  startRendering() {
+    if (this.renderFrame) return;
+    const render = () => {
+      this.renderFrame = requestAnimationFrame(render);
+      this.gameState = this.interpolateSnapshots();
+      this.drawGame();
+    };
+    this.renderFrame = requestAnimationFrame(render);
+  }
+
+  stopRendering() {
+    if (this.renderFrame) cancelAnimationFrame(this.renderFrame);
+    this.renderFrame = null;
+  }
+
+  interpolateSnapshots() {
+    const previous = this.previousSnapshot;
+    const latest = this.latestSnapshot;
+    if (!previous) return latest;
+
+    // drawn one snapshot interval behind, reaching the latest snapshot as the next one is due
+    const interval = latest.receivedAt - previous.receivedAt;
+    const t = interval > 0 ? Math.min(1, (performance.now() - latest.receivedAt) / interval) : 1;
+    const lerp = (from, to) => from + (to - from) * t;
+    // the ball is put back in the center after a point, it is not interpolated across
+    const ballReset = Math.abs(latest.ballX - previous.ballX) > this.canvas.width / 2;
+
+    return {
+      ...latest,
+      ballX: ballReset ? latest.ballX : lerp(previous.ballX, latest.ballX),
+      ballY: ballReset ? latest.ballY : lerp(previous.ballY, latest.ballY),
+      player1Y: lerp(previous.player1Y, latest.player1Y),
+      player2Y: lerp(previous.player2Y, latest.player2Y),
+    };
+  }
+
   setPlayerInfo(data) {
     this.currentPlayer = data.currentPlayer;
     this.opponent = data.opponent;
@@ -190,20 +261,29 @@ export class GameScreen extends BaseHTMLElement {
 
   startNewGame() {
     // close the game socket and redirect to the home page
+    this.leaving = true;
     this.gameSocket.close();
     app.router.go("/");
   }
 
   decodeGameState(arrayBuffer) {
     const view = new DataView(arrayBuffer);
-    this.gameState = {
+    const snapshot = {
       ballX: view.getFloat32(0),
       ballY: view.getFloat32(4),
       player1Y: view.getFloat32(8),
       player2Y: view.getFloat32(12),
       score1: view.getUint32(16),
       score2: view.getUint32(20),
+      tick: view.getUint32(24),
+      receivedAt: performance.now(),
     };
+    // skip snapshots older than the latest one, by server tick
+    if (this.latestSnapshot && snapshot.tick <= this.latestSnapshot.tick) return;
+
+    this.previousSnapshot = this.latestSnapshot;
+    this.latestSnapshot = snapshot;
+    this.gameState = snapshot;
     this.updateScores();
   }
 
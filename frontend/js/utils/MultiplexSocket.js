@@ -0,0 +1,115 @@
+// One websocket per client, carrying the chat, notification and matchmaking streams.
+// Frames are {stream, payload} envelopes, a stream is opened with {stream, open, params}
+// and closed with {stream, close}. The socket reconnects on its own and reopens
+// every stream still in use, so pages only deal with their stream.
+// The server pings idle sockets with {ping}, answered with {pong}.
+
+const RECONNECT_DELAY = 1000;
+
+// WebSocket-like handle on a single stream of the multiplexed socket
+class StreamSocket {
+  constructor(mux, name, getParams) {
+    this.mux = mux;
+    this.name = name;
+    this.getParams = getParams;
+    this.onopen = null;
+    this.onmessage = null;
+    this.onclose = null;
+  }
+
+  get readyState() {
+    return this.mux.socket.readyState;
+  }
+
+  send(data) {
+    this.mux.sendFrame({ stream: this.name, payload: JSON.parse(data) });
+  }
+
+  close() {
+    this.mux.closeStream(this);
+  }
+}
+
+class MultiplexSocket {
+  constructor() {
+    this.streams = {};
+    this.connect();
+  }
+
+  connect() {
+    const socket = new WebSocket("wss://" + window.location.host + "/ws/");
+    let opened = false;
+    this.socket = socket;
+
+    socket.onopen = () => {
+      opened = true;
+      Object.values(this.streams).forEach((stream) => this.openOnServer(stream));
+    };
+
+    socket.onmessage = (event) => {
+      const frame = JSON.parse(event.data);
+      if (frame.ping) {
+        socket.send(JSON.stringify({ pong: true }));
+        return;
+      }
+      const stream = this.streams[frame.stream];
+      if (stream && stream.onmessage) {
+        stream.onmessage({ data: JSON.stringify(frame.payload) });
+      }
+    };
+
+    socket.onclose = () => {
+      // a socket refused at connection, e.g. when logged out, is not retried
+      if (!opened) return;
+      console.log("Multiplexed socket closed, reconnecting...");
+      setTimeout(() => this.connect(), RECONNECT_DELAY);
+    };
+  }
+
+  openOnServer(stream) {
+    this.sendFrame({ stream: stream.name, open: true, params: stream.getParams() });
+    if (stream.onopen) stream.onopen();
+  }
+
+  // Open a stream, getParams returns the params sent each time the stream is (re)opened
+  openStream(name, getParams = () => ({})) {
+    if (this.streams[name]) {
+      this.closeStream(this.streams[name]);
+    }
+    if (this.socket.readyState === WebSocket.CLOSED) {
+      this.connect();
+    }
+
+    const stream = new StreamSocket(this, name, getParams);
+    this.streams[name] = stream;
+    // let the caller set the handlers before the stream is opened
+    Promise.resolve().then(() => {
+      if (this.streams[name] === stream && this.socket.readyState === WebSocket.OPEN) {
+        this.openOnServer(stream);
+      }
+    });
+    return stream;
+  }
+
+  closeStream(stream) {
+    if (this.streams[stream.name] !== stream) return;
+    delete this.streams[stream.name];
+    this.sendFrame({ stream: stream.name, close: true });
+    if (stream.onclose) stream.onclose();
+  }
+
+  sendFrame(frame) {
+    if (this.socket.readyState === WebSocket.OPEN) {
+      this.socket.send(JSON.stringify(frame));
+    }
+  }
+}
+
+let multiplexSocket = null;
+
+export function getMultiplexSocket() {
+  if (!multiplexSocket) {
+    multiplexSocket = new MultiplexSocket();
+  }
+  return multiplexSocket;
+}
@@ -1,13 +1,30 @@
 import { GameRequestPopup } from "../utils/PlayerGameRequest.js";
 import { displayRequestStatus } from "./errorManagement.js";
+import { getMultiplexSocket } from "./MultiplexSocket.js";
+
+const LAST_NOTIFICATION_ID_KEY = "lastNotificationId";
+
+// Inbox ids are "<milliseconds>-<sequence>" Redis Stream ids
+function isNewerNotificationId(id, lastId) {
+    if (!lastId) return true;
+    const [ms, seq] = id.split("-").map(Number);
+    const [lastMs, lastSeq] = lastId.split("-").map(Number);
+    return ms > lastMs || (ms === lastMs && seq > lastSeq);
+}
 
 // Handle websocket connection to notification server
 export function connectToNotificationServer() {
-    const wss = new WebSocket("wss://" + window.location.host + "/ws/notification/");
+    // Resume from the last notification seen, the server replays the ones missed while offline
+    const wss = getMultiplexSocket().openStream("notification", () => {
+      const lastId = localStorage.getItem(LAST_NOTIFICATION_ID_KEY);
+      return lastId ? { last_id: lastId } : {};
+    });
     app.socket = wss;
   
     wss.onopen = function () {
       console.log("Connected to notification server");
+      // Receive the status changes of friends as one digest instead of one message each
+      wss.send(JSON.stringify({ type: "presence_digest", enabled: true }));
     };
   
     wss.onmessage = function (event) {
@@ -15,6 +32,17 @@ export function connectToNotificationServer() {
       const data = parsedData.message;
       console.log(data);
 
+      if (data.type === "inbox_position") {
+        localStorage.setItem(LAST_NOTIFICATION_ID_KEY, data.id);
+        return;
+      }
+
+      // Inbox notifications have an id, skip the ones already handled
+      if (data.id) {
+        if (!isNewerNotificationId(data.id, localStorage.getItem(LAST_NOTIFICATION_ID_KEY))) return;
+        localStorage.setItem(LAST_NOTIFICATION_ID_KEY, data.id);
+      }
+
       /* Handle different types of notifications */
 
       // Update online status of friends
@@ -25,6 +53,15 @@ export function connectToNotificationServer() {
         }
       }
 
+      if (data.type === "presence_digest") {
+        const chatPage = document.querySelector("chat-page");
+        if (chatPage) {
+          data.statuses.forEach((status) => {
+            chatPage.updateOnlineStatusOfFriends(status.username, status.online);
+          });
+        }
+      }
+
       // Show game request popup
       if (data.type === "game_request") {
         GameRequestPopup.show({requesterName: data.requester_name, avatarUrl: data.avatar_url, requestId: data.request_id});